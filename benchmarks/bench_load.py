@@ -0,0 +1,297 @@
+"""
+Load test of every route and method on a seeded database.
+
+Requests go straight to the WSGI app in this process, or with --server over
+real keep-alive connections to a waitress or uvicorn subprocess. Each
+scenario reports req/s, p50/p95/p99 latency and the peak RSS of the process
+serving it. --output saves the results as JSON and --compare prints the
+change against an earlier run, e.g. one saved on the previous commit.
+
+    python -m benchmarks.bench_load --contacts 100000 --output before.json
+    python -m benchmarks.bench_load --contacts 100000 --compare before.json
+    python -m benchmarks.bench_load --contacts 1000000 --db /tmp/1m.db --server waitress --connections 16
+"""
+from __future__ import print_function
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import falcon.testing
+from sqlalchemy import create_engine, func, select
+
+from benchmarks.common import CITIES, COMPANIES, SERVERS, contact, keep_alive_client, peak_rss_mb, percentile, seed, split_body, start_server
+from inkit_project.models import Contact
+
+BULK_SIZE = 100
+EXPORT_SIZE = 1000
+
+
+def get(path_format, count):
+    while True:
+        number = random.randint(1, count)
+        yield 'GET', path_format.format(
+            id=number,
+            last_name=number - 1,
+            prefix='contact{0}'.format(number % 1000),
+            city=random.choice(CITIES),
+            company=random.choice(COMPANIES[:-1]),
+        ), None, 200
+
+
+def post_contact(count):
+    for number in itertools.count():
+        yield 'POST', '/contacts', json.dumps(unique_contact(number)).encode('utf-8'), 201
+
+
+def post_bulk(count):
+    for number in itertools.count(step=BULK_SIZE):
+        docs = [unique_contact(number + offset) for offset in range(BULK_SIZE)]
+        yield 'POST', '/contacts', json.dumps(docs).encode('utf-8'), 201
+
+
+def upsert_bulk(count):
+    # Existing contacts, so every one is an update.
+    while True:
+        start = random.randint(0, max(count - BULK_SIZE, 0))
+        docs = [contact(number) for number in range(start, min(start + BULK_SIZE, count))]
+        yield 'POST', '/contacts?__upsert=true', json.dumps(docs).encode('utf-8'), 200
+
+
+def export(export_format, count):
+    # A window of ids, so a request costs the same at any --contacts.
+    while True:
+        since = random.randint(0, max(count - EXPORT_SIZE, 0))
+        yield 'GET', '/contacts/export?format={0}&since={1}&id__lte={2}'.format(export_format, since, since + EXPORT_SIZE), None, 200
+
+
+def import_contacts(count):
+    # Existing contacts upserted, so the table doesn't grow. Only accepting
+    # the upload is measured; the import itself runs in the background.
+    while True:
+        start = random.randint(0, max(count - BULK_SIZE, 0))
+        lines = ''.join(json.dumps(contact(number)) + '\n' for number in range(start, min(start + BULK_SIZE, count)))
+        yield 'POST', '/contacts/import?format=ndjson&__upsert=true', ('application/x-ndjson', lines.encode('utf-8')), 202
+
+
+def put_contact(count):
+    while True:
+        number = random.randint(1, count)
+        yield 'PUT', '/contacts/{0}'.format(number), json.dumps(contact(number - 1)).encode('utf-8'), 200
+
+
+def patch_contact(count):
+    while True:
+        body = {'notes': 'Patched at {0}'.format(time.time())}
+        yield 'PATCH', '/contacts/{0}'.format(random.randint(1, count)), json.dumps(body).encode('utf-8'), 200
+
+
+def patch_bulk(count):
+    while True:
+        ids = ','.join(str(random.randint(1, count)) for _ in range(BULK_SIZE))
+        body = {'notes': 'Patched at {0}'.format(time.time())}
+        yield 'PATCH', '/contacts?id__in={0}'.format(ids), json.dumps(body).encode('utf-8'), 200
+
+
+def delete_contact(count, max_id):
+    # Only deletes what the POST scenarios created, so the seeded rows survive
+    # and the database can be reused with --db.
+    for number in range(max_id, count, -1):
+        yield 'DELETE', '/contacts/{0}'.format(number), None, 200
+
+
+def delete_bulk(count, max_id):
+    for number in range(max_id, count, -BULK_SIZE):
+        yield 'DELETE', '/contacts?id__gt={0}&id__lte={1}'.format(max(number - BULK_SIZE, count), number), None, 200
+
+
+def unique_contact(number):
+    doc = contact(number)
+    doc['email'] = 'bench{0}-{1}@example.com'.format(int(time.time() * 1000), number)
+    return doc
+
+
+SCENARIOS = [
+    ('GET /contacts',                   lambda count: get('/contacts?__limit=50', count)),
+    ('GET /contacts?fields=',           lambda count: get('/contacts?fields=id,first_name,last_name,email&__limit=50', count)),
+    ('GET /contacts?company=',          lambda count: get('/contacts?company={company}&__limit=50', count)),
+    ('GET /contacts?last_name=',        lambda count: get('/contacts?last_name={last_name}', count)),
+    ('GET /contacts?email__startswith=', lambda count: get('/contacts?email__startswith={prefix}&__limit=50', count)),
+    ('GET /contacts/search',            lambda count: get('/contacts/search?q={last_name}', count)),
+    ('GET /contacts/changes',           lambda count: get('/contacts/changes?since={id}&__limit=50', count)),
+    ('GET /contacts/export',            lambda count: export('ndjson', count)),
+    ('GET /contacts/export?format=csv', lambda count: export('csv', count)),
+    ('GET /contacts/{id}',              lambda count: get('/contacts/{id}', count)),
+    ('GET /contacts/{id}/address',      lambda count: get('/contacts/{id}/address', count)),
+    ('GET /addresses?city=',            lambda count: get('/addresses?city={city}&__limit=50', count)),
+    ('GET /addresses/{id}',             lambda count: get('/addresses/{id}', count)),
+    ('GET /addresses/stats',            lambda count: get('/addresses/stats', count)),
+    ('POST /contacts',                  post_contact),
+    ('POST /contacts (bulk)',           post_bulk),
+    ('POST /contacts?__upsert (bulk)',  upsert_bulk),
+    ('PUT /contacts/{id}',              put_contact),
+    ('PATCH /contacts/{id}',            patch_contact),
+    ('PATCH /contacts (bulk)',          patch_bulk),
+    ('DELETE /contacts/{id}',           delete_contact),
+    ('DELETE /contacts (bulk)',         delete_bulk),
+    # Last, so the imports still running in the background don't slow the other scenarios.
+    ('POST /contacts/import',           import_contacts),
+]
+
+# Scenarios that delete the rows the POSTs created, above the seeded ones.
+DELETES = (delete_contact, delete_bulk)
+
+
+def run_in_process(app, requests):
+    latencies, errors = [], []
+    for method, path, body, expected in requests:
+        path, _, query_string = path.partition('?')
+        content_type, body = split_body(body)
+        environ = falcon.testing.create_environ(path=path, query_string=query_string, method=method, body=body or b'',
+                                                headers={'Accept': 'application/json', 'Content-Type': content_type})
+        status = []
+        started = time.perf_counter()
+        result = app(environ, lambda s, headers, exc_info=None: status.append(int(s.split(' ', 1)[0])))
+        for _ in result:
+            pass
+        if hasattr(result, 'close'):
+            result.close()
+        latencies.append(time.perf_counter() - started)
+        if status[0] != expected:
+            errors.append(status[0])
+    return latencies, errors
+
+
+def run_over_socket(port, requests, connections):
+    latencies, errors = [], []
+    # The clients share one iterator, so the requests are spread between them.
+    requests = iter(requests)
+    clients = [keep_alive_client(port, requests, latencies, errors) for _ in range(connections)]
+    asyncio.get_event_loop().run_until_complete(asyncio.gather(*clients))
+    return latencies, errors
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    previous = dict((result['scenario'], result) for result in baseline['results'])
+    print('\nchange against {0} ({1})'.format(baseline.get('commit'), baseline.get('created')))
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        print('{0:<36} req/s {1:>+7.1%}   p95 {2:>+7.1%}'.format(
+            result['scenario'],
+            result['req_per_s'] / before['req_per_s'] - 1,
+            result['p95_ms'] / before['p95_ms'] - 1,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contacts', type=int, default=1000, help='contacts (with addresses) to seed, e.g. 1000 to 1000000')
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per scenario')
+    parser.add_argument('--db', help='database file to seed or reuse (default: a temporary file)')
+    parser.add_argument('--server', choices=sorted(SERVERS), help='serve over a socket instead of in-process')
+    parser.add_argument('--connections', type=int, default=8, help='concurrent keep-alive connections with --server')
+    parser.add_argument('--threads', type=int, default=4, help='worker threads (and pooled connections) with --server')
+    parser.add_argument('--only', help='run only scenarios containing this text')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.abspath(options.db) if options.db else os.path.join(directory, 'contacts.db')
+    url = 'sqlite:///' + path
+    try:
+        # Seeding in a child process keeps it out of the peak RSS below.
+        started = time.time()
+        seeder = multiprocessing.Process(target=seed, args=(url, options.contacts))
+        seeder.start()
+        seeder.join()
+        print('seeded {0} contacts in {1:.1f}s'.format(options.contacts, time.time() - started))
+
+        if options.server:
+            process, port = start_server(options.server, url, options.threads)
+            pid = process.pid
+            run = lambda requests: run_over_socket(port, requests, options.connections)
+        else:
+            os.environ['CONTACTS_DB_URL'] = url
+            from inkit_project.app import app
+            process, pid = None, 'self'
+            run = lambda requests: run_in_process(app, requests)
+
+        db_engine = create_engine(url)
+        results = []
+        print('{0:<36} {1:>9} {2:>9} {3:>9} {4:>9} {5:>7} {6:>9}'.format(
+            'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'RSS MB'))
+        try:
+            for name, scenario in SCENARIOS:
+                if options.only and options.only not in name:
+                    continue
+                if scenario in DELETES:
+                    max_id = db_engine.execute(select([func.max(Contact.id)])).scalar()
+                    requests = scenario(options.contacts, max_id)
+                else:
+                    requests = scenario(options.contacts)
+                run(itertools.islice(requests, options.warmup))
+
+                started = time.perf_counter()
+                latencies, errors = run(itertools.islice(requests, options.requests))
+                seconds = time.perf_counter() - started
+                latencies.sort()
+                result = {
+                    'scenario':     name,
+                    'requests':     len(latencies),
+                    'seconds':      seconds,
+                    'req_per_s':    len(latencies) / seconds if seconds else None,
+                    'p50_ms':       percentile(latencies, 0.50) * 1000,
+                    'p95_ms':       percentile(latencies, 0.95) * 1000,
+                    'p99_ms':       percentile(latencies, 0.99) * 1000,
+                    'errors':       len(errors),
+                    'peak_rss_mb':  peak_rss_mb(pid),
+                }
+                results.append(result)
+                print('{scenario:<36} {req_per_s:>9.0f} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} {errors:>7} {peak_rss_mb:>9.1f}'.format(**result))
+        finally:
+            db_engine.dispose()
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+        report = {
+            'commit':       git_commit(),
+            'created':      datetime.datetime.utcnow().isoformat() + 'Z',
+            'python':       platform.python_version(),
+            'contacts':     options.contacts,
+            'mode':         options.server or 'in-process',
+            'connections':  options.connections if options.server else 1,
+            'results':      results,
+        }
+        if options.output:
+            with open(options.output, 'w') as output:
+                json.dump(report, output, indent=2)
+        if options.compare:
+            with open(options.compare) as baseline:
+                compare(results, json.load(baseline))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Cost of reading and serializing a page of contacts for GET /contacts.
+
+Compares the previous ORM path, which loaded Contact instances with their
+addresses and called as_dict() on each, with the Core select and positional
+serialization ContactCollectionResource uses now. Both must produce the same
+bytes.
+
+    python -m benchmarks.bench_serialization --contacts 10000 --page 1000
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import timeit
+
+from sqlalchemy.orm import joinedload, sessionmaker
+
+from benchmarks.common import seed
+from inkit_project.db import make_engine
+from inkit_project.models import Address, Contact
+from inkit_project.resources import AddressCollectionResource, ContactCollectionResource
+
+
+def orm_page(session, model, size):
+    query = session.query(model)
+    if model is Contact:
+        query = query.options(joinedload(Contact.address))
+    body = json.dumps([resource.as_dict() for resource in query.order_by(model.id).limit(size)])
+    # Each request used a new session, so nothing is left in the identity map.
+    session.expunge_all()
+    return body
+
+
+def core_page(session, resource, size):
+    projection = resource.full_projection
+    order = [(resource.model.__table__.c.id, False)]
+    query = session.query(*projection.columns(order)).select_from(resource.model)
+    for name, relationship, fields, position in projection.nested:
+        query = query.outerjoin(relationship)
+    rows = session.execute(query.order_by(resource.model.id).limit(size).statement)
+    return json.dumps([projection.serialize(row) for row in rows])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contacts', type=int, default=10000, help='contacts in the seeded database')
+    parser.add_argument('--page', type=int, default=1000, help='rows per page')
+    parser.add_argument('--number', type=int, default=20, help='pages read per run')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///' + os.path.join(directory, 'contacts.db')
+    try:
+        seed(url, options.contacts)
+        db_engine = make_engine(url=url)
+        session = sessionmaker(bind=db_engine)()
+
+        for model, resource in [(Contact, ContactCollectionResource(db_engine)), (Address, AddressCollectionResource(db_engine))]:
+            # Identical bodies, or the comparison means nothing.
+            assert orm_page(session, model, options.page) == core_page(session, resource, options.page)
+            for name, page in [('ORM + as_dict()', lambda: orm_page(session, model, options.page)),
+                               ('Core + projection', lambda: core_page(session, resource, options.page))]:
+                seconds = min(timeit.repeat(page, number=options.number, repeat=5)) / options.number
+                print('{0:<10} {1:<20} {2:10.1f} ms/page {3:10.1f} us/row'.format(
+                    model.__tablename__, name, seconds * 1000, seconds / options.page * 1e6))
+
+        session.close()
+        db_engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Throughput and latency of the waitress (WSGI) and uvicorn (ASGI) deployments
+under many concurrent keep-alive connections.
+
+Each server is started as a subprocess on a freshly seeded database and
+driven by an asyncio client that keeps every connection open and issues
+requests back to back for the given duration.
+
+    pip install uvicorn
+    python -m benchmarks.bench_servers --contacts 10000 --connections 10,500 --duration 10
+"""
+from __future__ import print_function
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import SERVERS, keep_alive_client, percentile, seed, start_server
+
+
+def random_requests(paths):
+    while True:
+        yield 'GET', random.choice(paths), None, 200
+
+
+def run_load(port, connections, duration, contacts):
+    paths = ['/contacts/{0}'.format(random.randint(1, contacts)) for _ in range(1000)]
+    paths += ['/addresses/{0}'.format(random.randint(1, contacts)) for _ in range(1000)]
+    paths += ['/contacts?__limit=20&last_name={0}'.format(random.randint(0, contacts - 1)) for _ in range(500)]
+    latencies, errors = [], []
+    deadline = time.time() + duration
+    loop = asyncio.get_event_loop()
+    clients = [keep_alive_client(port, random_requests(paths), latencies, errors, deadline) for _ in range(connections)]
+    loop.run_until_complete(asyncio.gather(*clients))
+    latencies.sort()
+    return len(latencies) / float(duration), percentile(latencies, 0.5), percentile(latencies, 0.99), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contacts', type=int, default=10000, help='contacts in the seeded database')
+    parser.add_argument('--connections', default='10,500', help='comma separated concurrent connection counts')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--threads', type=int, default=4, help='worker threads (and pooled connections) per server')
+    parser.add_argument('--servers', default='waitress,uvicorn', help='comma separated: ' + ', '.join(sorted(SERVERS)))
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///' + os.path.join(directory, 'contacts.db')
+    try:
+        seed(url, options.contacts)
+        print('{0:<10} {1:>12} {2:>10} {3:>10} {4:>10} {5:>8}'.format('server', 'connections', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+        for name in options.servers.split(','):
+            process, port = start_server(name, url, options.threads)
+            try:
+                for connections in [int(c) for c in options.connections.split(',')]:
+                    rate, p50, p99, errors = run_load(port, connections, options.duration, options.contacts)
+                    print('{0:<10} {1:>12} {2:>10.0f} {3:>10.1f} {4:>10.1f} {5:>8}'.format(
+                        name, connections, rate, p50 * 1000, p99 * 1000, errors))
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Per-document cost of validating POST bodies against post_schema.json.
+
+Compares the previous implementation, which called jsonschema.validate() for
+every document, with the validators compiled once in inkit_project.resources.
+
+    python -m benchmarks.bench_validation --number 2000 --bulk 1000
+"""
+from __future__ import print_function
+import argparse
+import timeit
+
+import jsonschema
+
+from inkit_project.resources import post_schema, validate_json
+
+CONTACT = {
+    "first_name": "Juan David",
+    "last_name": "Garrido",
+    "email": "jgarrido@macalester.edu",
+    "phone_number": "7632830994",
+    "company": "Inkit",
+    "address": {
+        "street_address": "1600 Grand Avenue",
+        "unit_number": "Macalester College",
+        "city": "St. Paul",
+        "state": "MN",
+        "country": "Colombia",
+        "post_code": "55105"
+    },
+    "notes": "This is a difficult project"
+}
+
+
+def validate_per_call(instance):
+    jsonschema.validate(instance, post_schema, format_checker=jsonschema.FormatChecker())
+
+
+def report(name, statement, number, documents):
+    seconds = min(timeit.repeat(statement, number=number, repeat=5))
+    print('{0:<40} {1:10.1f} us/document'.format(name, seconds / number / documents * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000, help='single documents validated per run')
+    parser.add_argument('--bulk', type=int, default=1000, help='contacts in the bulk array')
+    options = parser.parse_args()
+
+    bulk = [CONTACT] * options.bulk
+    bulk_runs = max(1, options.number // options.bulk)
+
+    report('single, jsonschema.validate per call', lambda: validate_per_call(CONTACT), options.number, 1)
+    report('single, precompiled validator', lambda: validate_json(CONTACT), options.number, 1)
+    # The old schema accepted any array without looking at its items, so the
+    # per-item baseline below is what validating them used to require.
+    report('bulk, jsonschema.validate per item', lambda: [validate_per_call(c) for c in bulk], bulk_runs, len(bulk))
+    report('bulk, precompiled validator', lambda: validate_json(bulk), bulk_runs, len(bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from inkit_project.db import make_engine
+from inkit_project.migrations import upgrade
+from inkit_project.models import Contact
+from inkit_project.resources import insert_contacts
+
+CITIES = ['St. Paul', 'Minneapolis', 'Bogota', 'Washington', 'Chicago', 'Madison', 'Denver', 'Austin']
+COMPANIES = ['Inkit', 'Macalester', 'Acme', 'Initech', None]
+
+SERVERS = {
+    'waitress':  lambda port, threads: ['-m', 'waitress', '--port={0}'.format(port), '--threads={0}'.format(threads),
+                                        'inkit_project.app:app'],
+    'uvicorn':   lambda port, threads: ['-m', 'uvicorn', '--port', str(port), '--no-access-log', '--log-level', 'warning',
+                                        'inkit_project.app:asgi_app'],
+}
+
+
+def contact(number):
+    city = CITIES[number % len(CITIES)]
+    return {
+        'first_name': 'Contact',
+        'last_name': str(number),
+        'email': 'contact{0}@macalester.edu'.format(number),
+        'phone_number': '555{0:07d}'.format(number),
+        'company': COMPANIES[number % len(COMPANIES)],
+        'notes': 'Seeded contact number {0} from {1}'.format(number, city),
+        'address': {
+            'street_address': '{0} Grand Avenue'.format(number),
+            'city': city,
+            'state': 'MN',
+            'post_code': '{0:05d}'.format(number % 100000),
+        },
+    }
+
+
+def seed(url, count, chunk_size=5000):
+    db_engine = make_engine(url=url)
+    upgrade(db_engine)
+    with db_engine.begin() as connection:
+        existing = connection.execute(Contact.__table__.count()).scalar()
+        for start in range(existing, count, chunk_size):
+            insert_contacts(connection, [contact(number) for number in range(start, min(count, start + chunk_size))])
+    db_engine.dispose()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(name, url, threads):
+    port = free_port()
+    env = dict(os.environ, CONTACTS_DB_URL=url, CONTACTS_THREADS=str(threads))
+    process = subprocess.Popen([sys.executable] + SERVERS[name](port, threads), env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{0} did not start'.format(name))
+
+
+def peak_rss_mb(pid='self'):
+    # VmHWM is the high water mark of the resident set size, in kB.
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def split_body(body):
+    # A request body is JSON bytes, or a (content type, bytes) pair.
+    if isinstance(body, tuple):
+        return body
+    return 'application/json', body
+
+
+async def fetch(reader, writer, method, path, body=None):
+    head = '{0} {1} HTTP/1.1\r\nHost: localhost\r\nAccept: application/json\r\n'.format(method, path)
+    if body is not None:
+        content_type, body = split_body(body)
+        head += 'Content-Type: {0}\r\nContent-Length: {1}\r\n'.format(content_type, len(body))
+    writer.write(head.encode('latin-1') + b'\r\n' + (body or b''))
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length, chunked, close = 0, False, False
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'transfer-encoding':
+            chunked = b'chunked' in value
+        elif name == b'connection':
+            close = value == b'close'
+    if not chunked:
+        await reader.readexactly(length)
+        return status, close
+    # Streamed responses, e.g. exports, come in chunks and end with an empty one.
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+        await reader.readexactly(size + 2)
+        if size == 0:
+            return status, close
+
+
+async def keep_alive_client(port, requests, latencies, errors, deadline=None):
+    """
+    Issues requests, an iterator of (method, path, body, expected status),
+    back to back over one connection until it runs out or deadline passes.
+    See split_body() for the body. The connection is reopened if the server
+    closes it.
+    """
+    writer = None
+    try:
+        for method, path, body, expected in requests:
+            if deadline is not None and time.time() >= deadline:
+                break
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            started = time.time()
+            status, close = await fetch(reader, writer, method, path, body)
+            latencies.append(time.time() - started)
+            if status != expected:
+                errors.append(status)
+            if close:
+                # waitress closes the connection after a streamed response.
+                writer.close()
+                writer = None
+    except (OSError, asyncio.IncompleteReadError) as e:
+        errors.append(type(e).__name__)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -1,16 +1,74 @@
-from sqlalchemy import create_engine
+import os
+
 import falcon
 from falcon_autocrud.middleware import Middleware
-from .resources import ContactCollectionResource, ContactResource, AddressResource, AddressCollectionResource
+from .asgi import AsgiAdapter
+from .cache import make_cache
+from .compression import CompressionMiddleware
+from .db import engine_config, make_engines
+from .imports import ImportJobs
+from .metrics import Metrics, MetricsMiddleware
+from .migrations import upgrade
+from .resources import ContactChangesResource, ContactCollectionResource, ContactExportResource, ContactImportResource, ContactResource, ContactSearchResource, AddressResource, AddressCollectionResource, AddressStatsResource, CacheStatsResource, ImportJobResource, MetricsResource
+from .shards import add_sharded_routes, make_shards
+from .writes import WriteQueue
+
+cache = make_cache()
+metrics = Metrics()
+
+# Opt-in group commit of single-contact writes, e.g. CONTACTS_WRITE_BATCH=64.
+write_batch = int(os.environ.get('CONTACTS_WRITE_BATCH', 0))
+if write_batch > 0 and engine_config()['shards']:
+    raise ValueError('CONTACTS_WRITE_BATCH is not supported with CONTACTS_SHARDS; unset one of them')
+shards = make_shards() if engine_config()['shards'] else None
+
+if shards is None:
+    db_engine, read_engine = make_engines()
+    upgrade(db_engine)
+    jobs = ImportJobs(db_engine, cache=cache)
 
-db_engine = create_engine('sqlite:///contacts.db')
+    write_queue = None
+    if write_batch > 0:
+        write_queue = WriteQueue(db_engine, max_batch=write_batch, max_delay=float(os.environ.get('CONTACTS_WRITE_DELAY_MS', 2)) / 1000)
 
 app = falcon.API(
-    middleware=[Middleware()],
+    middleware=[
+        MetricsMiddleware(metrics, *(shards.all_engines() if shards is not None else [db_engine, read_engine])),
+        CompressionMiddleware(minimum_size=int(os.environ.get('CONTACTS_COMPRESSION_MIN_SIZE', 1024))),
+        Middleware(),
+    ],
 )
 
-app.add_route('/contacts', ContactCollectionResource(db_engine))
-app.add_route('/contacts/{id}', ContactResource(db_engine))
-app.add_route('/contacts/{id}/address', AddressResource(db_engine))
-app.add_route('/addresses', AddressCollectionResource(db_engine))
-app.add_route('/addresses/{id}', AddressResource(db_engine))
+if shards is None:
+    app.add_route('/contacts', ContactCollectionResource(db_engine, cache=cache, read_engine=read_engine, write_queue=write_queue))
+    app.add_route('/contacts/search', ContactSearchResource(db_engine, read_engine=read_engine))
+    app.add_route('/contacts/export', ContactExportResource(db_engine, read_engine=read_engine))
+    app.add_route('/contacts/changes', ContactChangesResource(db_engine, read_engine=read_engine))
+    app.add_route('/contacts/import', ContactImportResource(jobs))
+    app.add_route('/contacts/import/{job_id}', ImportJobResource(jobs))
+    app.add_route('/contacts/{id}', ContactResource(db_engine, cache=cache, read_engine=read_engine, write_queue=write_queue))
+    app.add_route('/contacts/{id}/address', AddressResource(db_engine, cache=cache, read_engine=read_engine))
+    app.add_route('/addresses', AddressCollectionResource(db_engine, read_engine=read_engine))
+    app.add_route('/addresses/stats', AddressStatsResource(db_engine, read_engine=read_engine))
+    app.add_route('/addresses/{id}', AddressResource(db_engine, cache=cache, read_engine=read_engine))
+else:
+    add_sharded_routes(app, shards, cache=cache)
+if cache is not None:
+    app.add_route('/cache/stats', CacheStatsResource(cache))
+app.add_route('/metrics', MetricsResource(metrics))
+
+
+def dispose():
+    if shards is not None:
+        shards.dispose()
+        return
+    if write_queue is not None:
+        write_queue.close()
+    # The writer closes last, so it can checkpoint and remove the WAL.
+    if read_engine is not None:
+        read_engine.dispose()
+    db_engine.dispose()
+
+
+# uvicorn inkit_project.app:asgi_app
+asgi_app = AsgiAdapter(app, max_workers=engine_config()['pool_size'], on_shutdown=dispose)
@@ -0,0 +1,111 @@
+import asyncio
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Python 3.6 has no get_running_loop(), but get_event_loop() returns the
+# running loop when called from a coroutine.
+get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD':       scope['method'],
+        'SCRIPT_NAME':          scope.get('root_path', ''),
+        # WSGI strings are bytes decoded as latin-1.
+        'PATH_INFO':            scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING':         scope['query_string'].decode('latin-1'),
+        'SERVER_NAME':          server_name,
+        'SERVER_PORT':          str(server_port),
+        'SERVER_PROTOCOL':      'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR':          client[0],
+        'wsgi.version':         (1, 0),
+        'wsgi.url_scheme':      scope.get('scheme', 'http'),
+        'wsgi.input':           body,
+        'wsgi.errors':          sys.stderr,
+        'wsgi.multithread':     True,
+        'wsgi.multiprocess':    False,
+        'wsgi.run_once':        False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+class AsgiAdapter(object):
+    """
+    Serves a WSGI app from an asyncio server. The event loop holds the
+    connections, and only requests that are actually being handled take one
+    of max_workers threads, each of which can use a pooled SQLite connection.
+    """
+
+    def __init__(self, wsgi_app, max_workers=4, on_shutdown=None, max_memory_body=1024 * 1024):
+        self.wsgi_app = wsgi_app
+        self.max_memory_body = max_memory_body
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.on_shutdown = on_shutdown
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown()
+                if self.on_shutdown is not None:
+                    self.on_shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        # Bodies past max_memory_body, such as imports, go to a temporary file.
+        body = tempfile.SpooledTemporaryFile(max_size=self.max_memory_body)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await self.respond(scope, body, send)
+        finally:
+            body.close()
+
+    async def respond(self, scope, body, send):
+        loop = get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        environ = build_environ(scope, body)
+        result = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        try:
+            # Streamed bodies do their database work while being iterated, so
+            # every chunk is pulled on the executor too.
+            chunks = iter(result)
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .db import engine_config
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of serialized responses whose entries expire after ttl
+    seconds. Entries can be put in a group (the owning contact's id) so all
+    responses derived from one contact are invalidated together.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Re-insert to mark the entry as most recently used.
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def token(self):
+        with self.lock:
+            return self.generation
+
+    def set(self, key, value, token, group=None):
+        with self.lock:
+            # Something was invalidated while the value was being read, so it
+            # may already be stale.
+            if token != self.generation:
+                return
+
+            self._remove(key)
+            self.entries[key] = (value, self.clock() + self.ttl, group)
+            if group is not None:
+                self.groups.setdefault(group, set()).add(key)
+
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *groups):
+        with self.lock:
+            self.generation += 1
+            for group in groups:
+                for key in list(self.groups.get(group, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.groups.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size':             len(self.entries),
+                'max_size':         self.max_size,
+                'ttl':              self.ttl,
+                'hits':             self.hits,
+                'misses':           self.misses,
+                'evictions':        self.evictions,
+                'expirations':      self.expirations,
+                'invalidations':    self.invalidations,
+            }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            keys = self.groups[entry[2]]
+            keys.discard(key)
+            if not keys:
+                del self.groups[entry[2]]
+
+
+def make_cache(environ=None, **overrides):
+    config = engine_config(environ, **overrides)
+    if config['cache_entries'] <= 0:
+        return None
+    return ResponseCache(max_size=config['cache_entries'], ttl=config['cache_ttl'])
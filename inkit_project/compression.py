@@ -0,0 +1,131 @@
+import itertools
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BrotliCompressor(object):
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+# Encoding, compressor factory and default level, in order of preference.
+ENCODINGS = [
+    ('br',      BrotliCompressor, 4),
+    ('zstd',    lambda level: zstandard.ZstdCompressor(level=level).compressobj(), 3),
+    ('gzip',    lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS), 6),
+]
+AVAILABLE = {'br': brotli is not None, 'zstd': zstandard is not None, 'gzip': True}
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def accepted_encodings(header):
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    return accepted
+
+
+class CompressionMiddleware(object):
+    """
+    Compresses response bodies of at least minimum_size bytes with the best
+    encoding the client accepts. Resources can override the levels with a
+    compression_levels attribute, e.g. {'gzip': 1}. List it after
+    MetricsMiddleware and before the autocrud Middleware, so it sees the
+    serialized body and the metrics see the compressed size.
+    """
+
+    def __init__(self, minimum_size=1024, levels=None):
+        self.minimum_size = minimum_size
+        self.encodings = [(name, factory, (levels or {}).get(name, level))
+                          for name, factory, level in ENCODINGS if AVAILABLE[name]]
+
+    def choose(self, req, resource):
+        accepted = accepted_encodings(req.get_header('Accept-Encoding') or '')
+        levels = getattr(resource, 'compression_levels', None) or {}
+        for name, factory, level in self.encodings:
+            if accepted.get(name, accepted.get('*', 0)) > 0:
+                return name, factory, levels.get(name, level)
+        return None
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not resp.status.startswith('2') or resp.get_header('Content-Encoding') is not None:
+            return
+        # Falcon only fills in its default JSON media type after the middleware.
+        if resp.content_type is not None and not resp.content_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        body = resp.body if resp.body is not None else resp.data
+        if body is None and resp.stream is None:
+            return
+
+        resp.append_header('Vary', 'Accept-Encoding')
+        encoding = self.choose(req, resource)
+        if encoding is None:
+            return
+        name, factory, level = encoding
+
+        if body is not None:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            if len(body) < self.minimum_size:
+                return
+            compressor = factory(level)
+            resp.body = None
+            resp.data = compressor.compress(body) + compressor.flush()
+        else:
+            # Read just enough of the stream to tell whether it's worth it.
+            stream = resp.stream
+            chunks = iter(stream)
+            head = []
+            size = 0
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= self.minimum_size:
+                    break
+            if size < self.minimum_size:
+                resp.stream = head
+                return
+            resp.stream = self.compress_stream(stream, itertools.chain(head, chunks), factory(level))
+
+        resp.set_header('Content-Encoding', name)
+        # The compressed bytes differ from the identity ones, so a strong
+        # validator would be wrong; the weak one still matches If-None-Match.
+        etag = resp.get_header('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            resp.set_header('ETag', 'W/' + etag)
+
+    def compress_stream(self, stream, chunks, compressor):
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
@@ -0,0 +1,106 @@
+import os
+import sqlite3
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+DB_URI = 'sqlite:///' + os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'contacts.db')
+
+# Environment variable, default. Every value can also be passed to make_engine().
+SETTINGS = {
+    'url':              ('CONTACTS_DB_URL', DB_URI),
+    # A replica to read from. SQLite reads the primary's file read-only without one.
+    'read_url':         ('CONTACTS_DB_READ_URL', ''),
+    'journal_mode':     ('CONTACTS_DB_JOURNAL_MODE', 'wal'),
+    'synchronous':      ('CONTACTS_DB_SYNCHRONOUS', 'normal'),
+    'busy_timeout':     ('CONTACTS_DB_BUSY_TIMEOUT', 5000),
+    'cache_size':       ('CONTACTS_DB_CACHE_SIZE', -64000),
+    'mmap_size':        ('CONTACTS_DB_MMAP_SIZE', 256 * 1024 * 1024),
+    'foreign_keys':     ('CONTACTS_DB_FOREIGN_KEYS', 'on'),
+    # waitress-serve runs 4 threads unless told otherwise.
+    'pool_size':        ('CONTACTS_THREADS', 4),
+    # SQLite takes one writer at a time, so more writer connections would only
+    # wait on its lock instead of the pool.
+    'write_pool_size':  ('CONTACTS_DB_WRITE_POOL_SIZE', 2),
+    'pool_timeout':     ('CONTACTS_DB_POOL_TIMEOUT', 30),
+    # Sharded storage: CONTACTS_SHARDS databases named by formatting shard_url.
+    'shards':           ('CONTACTS_SHARDS', 0),
+    'shard_url':        ('CONTACTS_SHARD_URL', DB_URI[:-len('.db')] + '-{shard}.db'),
+    # The in-process cache of single contact and address GETs; 0 turns it off.
+    'cache_entries':    ('CONTACTS_CACHE_SIZE', 10000),
+    'cache_ttl':        ('CONTACTS_CACHE_TTL', 60),
+}
+
+
+def engine_config(environ=None, **overrides):
+    environ = os.environ if environ is None else environ
+    config = {}
+    for name, (variable, default) in SETTINGS.items():
+        value = overrides.get(name, environ.get(variable, default))
+        config[name] = type(default)(value)
+    return config
+
+
+def set_pragmas(dbapi_connection, config, read_only=False):
+    cursor = dbapi_connection.cursor()
+    for pragma in ['busy_timeout', 'foreign_keys', 'synchronous', 'cache_size', 'mmap_size']:
+        cursor.execute('PRAGMA {0} = {1}'.format(pragma, config[pragma]))
+    # journal_mode is stored in the file, but setting it again is a no-op.
+    # Read-only connections can't change it and get it from the writer.
+    if not read_only:
+        cursor.execute('PRAGMA journal_mode = {0}'.format(config['journal_mode']))
+    cursor.close()
+
+
+def make_engines(environ=None, **overrides):
+    """
+    Returns a writer engine and an engine for reads, or None for the latter
+    when there is nothing to read from but the writer: an in-memory SQLite
+    database, or another backend without a read_url. With a separate reader,
+    the writer's pool shrinks to write_pool_size connections.
+    """
+    read_engine = make_engine(environ, read_only=True, **overrides)
+    if read_engine is None:
+        return make_engine(environ, **overrides), None
+    config = engine_config(environ, **overrides)
+    overrides['pool_size'] = config['write_pool_size']
+    return make_engine(environ, **overrides), read_engine
+
+
+def make_engine(environ=None, read_only=False, **overrides):
+    config = engine_config(environ, **overrides)
+    url = make_url(config['read_url'] or config['url'] if read_only else config['url'])
+    if url.get_backend_name() != 'sqlite':
+        if read_only and not config['read_url']:
+            return None
+        return create_engine(url, pool_size=config['pool_size'], pool_timeout=config['pool_timeout'])
+    if read_only and (not url.database or url.database == ':memory:'):
+        return None
+
+    kwargs = {}
+    if url.database and url.database != ':memory:':
+        # pysqlite defaults file databases to NullPool, which reconnects (and
+        # reruns the pragmas) on every request. Keep one connection per thread.
+        kwargs = dict(
+            poolclass=QueuePool,
+            pool_size=config['pool_size'],
+            max_overflow=0,
+            pool_timeout=config['pool_timeout'],
+            connect_args={'check_same_thread': False, 'timeout': config['busy_timeout'] / 1000.0},
+        )
+        if read_only:
+            # mode=ro needs a URI filename, which SQLAlchemy can't pass on here.
+            uri = 'file:{0}?mode=ro'.format(quote(os.path.abspath(url.database)))
+            kwargs['creator'] = lambda: sqlite3.connect(uri, uri=True, **kwargs['connect_args'])
+    else:
+        # An in-memory database only lives in its connection and can't use WAL.
+        config['journal_mode'] = 'memory'
+    engine = create_engine(url, **kwargs)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        set_pragmas(dbapi_connection, config, read_only)
+
+    return engine
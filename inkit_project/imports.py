@@ -0,0 +1,176 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from inkit_project.resources import first_error, insert_chunk, insert_contacts, item_validator, upsert_contacts
+
+# Written by GET /contacts/export but assigned by the server, so ignored on the way back in.
+SERVER_FIELDS = ['id', 'address.id', 'address.contact_id']
+
+
+def read_ndjson(path):
+    with io.open(path, encoding='utf-8') as lines:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                doc = json.loads(line)
+            except ValueError:
+                yield number, None, 'Malformed JSON'
+                continue
+            if isinstance(doc, dict):
+                doc.pop('id', None)
+                if isinstance(doc.get('address'), dict):
+                    doc['address'].pop('id', None)
+                    doc['address'].pop('contact_id', None)
+            yield number, doc, None
+
+
+def read_csv(path):
+    with io.open(path, encoding='utf-8', newline='') as lines:
+        reader = csv.DictReader(lines)
+        for record in reader:
+            if None in record:
+                yield reader.line_num, None, 'The row has more fields than the header'
+                continue
+            doc = {}
+            for name, value in record.items():
+                # Empty cells are missing values, as are the cells short rows lack.
+                if name in SERVER_FIELDS or value is None or value == '':
+                    continue
+                prefix, _, field = name.partition('.')
+                if field:
+                    doc.setdefault(prefix, {})[field] = value
+                else:
+                    doc[name] = value
+            yield reader.line_num, doc, None
+
+
+READERS = {'ndjson': read_ndjson, 'csv': read_csv}
+
+
+class ImportJob(object):
+
+    def __init__(self, job_id, import_format, chunk_size, max_errors, upsert=False):
+        self.lock = threading.Lock()
+        self.id = job_id
+        self.format = import_format
+        self.chunk_size = chunk_size
+        self.upsert = upsert
+        self.max_errors = max_errors
+        self.status = 'queued'
+        self.created = time.time()
+        self.finished = None
+        self.records = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.message = None
+
+    def add_error(self, line, description):
+        with self.lock:
+            self.failed += 1
+            if len(self.errors) < self.max_errors:
+                self.errors.append({'line': line, 'description': description})
+
+    def as_dict(self):
+        with self.lock:
+            result = {
+                'id':           self.id,
+                'status':       self.status,
+                'format':       self.format,
+                'upsert':       self.upsert,
+                'records':      self.records,
+                'imported':     self.imported,
+                'failed':       self.failed,
+                'errors':       list(self.errors),
+                'created':      self.created,
+                'finished':     self.finished,
+            }
+            if self.message is not None:
+                result['message'] = self.message
+            return result
+
+
+class ImportJobs(object):
+    """
+    Runs uploads spooled to disk through validation and chunked inserts on a
+    background thread, and keeps the status of the last max_jobs of them.
+    Jobs only live in this process and are lost on restart.
+    """
+
+    def __init__(self, db_engine, cache=None, max_workers=1, max_jobs=100, max_errors=1000):
+        self.db_engine = db_engine
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.max_jobs = max_jobs
+        self.max_errors = max_errors
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def start(self, path, import_format, chunk_size, upsert=False):
+        job = ImportJob(uuid.uuid4().hex, import_format, chunk_size, self.max_errors, upsert)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.executor.submit(self.run, job, path)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self, job, path):
+        with job.lock:
+            job.status = 'running'
+        try:
+            records = READERS[job.format](path)
+            for chunk in batches(records, job.chunk_size):
+                self.import_chunk(job, chunk)
+            status, message = 'done', None
+        except Exception as e:
+            status, message = 'failed', '{0}: {1}'.format(type(e).__name__, e)
+        finally:
+            os.remove(path)
+        with job.lock:
+            job.status = status
+            job.message = message
+            job.finished = time.time()
+
+    def import_chunk(self, job, chunk):
+        pending = []
+        for line, doc, error in chunk:
+            if error is None:
+                error = first_error(item_validator, doc)
+            if error is None:
+                pending.append((line, doc))
+            else:
+                job.add_error(line, error)
+
+        write = upsert_contacts if job.upsert else insert_contacts
+        created, failed = insert_chunk(self.db_engine, pending, write) if pending else ([], [])
+        for line in failed:
+            job.add_error(line, 'Unique constraint violated')
+        if self.cache is not None and created:
+            self.cache.invalidate(*[contact['id'] for contact in created])
+        with job.lock:
+            job.records += len(chunk)
+            job.imported += len(created)
+
+
+def batches(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
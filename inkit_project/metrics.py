@@ -0,0 +1,199 @@
+import bisect
+import threading
+import time
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+REQUEST_LABELS = ('route', 'method')
+
+
+def format_labels(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{0}="{1}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, buckets, label_names=REQUEST_LABELS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label_names = label_names
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            # Per-bucket counts, the last one being +Inf, then the sum.
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield '# HELP {0} {1}'.format(self.name, self.help)
+        yield '# TYPE {0} histogram'.format(self.name)
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(self.name, format_labels(self.label_names + ('le',), labels + (bound,)), cumulative)
+            yield '{0}_sum{1} {2}'.format(self.name, format_labels(self.label_names, labels), total)
+            yield '{0}_count{1} {2}'.format(self.name, format_labels(self.label_names, labels), cumulative)
+
+
+class Counter(object):
+
+    def __init__(self, name, help, label_names=(), kind='counter'):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.kind = kind
+        self.series = {}
+
+    def inc(self, labels=(), value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        yield '# HELP {0} {1}'.format(self.name, self.help)
+        yield '# TYPE {0} {1}'.format(self.name, self.kind)
+        for labels, value in sorted(self.series.items()):
+            yield '{0}{1} {2}'.format(self.name, format_labels(self.label_names, labels), value)
+
+
+class Metrics(object):
+    """
+    Request and SQL metrics rendered in the Prometheus text format. Every
+    update happens under one lock, once per request or statement.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter('http_requests_total', 'Requests handled.', REQUEST_LABELS + ('status',))
+        self.in_flight = Counter('http_requests_in_flight', 'Requests being handled.', kind='gauge')
+        self.in_flight.inc((), 0)
+        self.latency = Histogram('http_request_duration_seconds', 'Time to handle a request, including streaming the body.', LATENCY_BUCKETS)
+        self.size = Histogram('http_response_size_bytes', 'Size of response bodies.', SIZE_BUCKETS)
+        self.statements = Histogram('db_statements_per_request', 'SQL statements executed per request.', STATEMENT_BUCKETS)
+        self.statement_time = Histogram('db_statement_seconds_per_request', 'Total time spent in SQL statements per request.', LATENCY_BUCKETS)
+        self.statements_total = Counter('db_statements_total', 'SQL statements executed.')
+        self.statement_seconds_total = Counter('db_statement_seconds_total', 'Time spent in SQL statements.')
+
+    def start_request(self):
+        with self.lock:
+            self.in_flight.inc((), 1)
+
+    def finish_request(self, route, method, status, seconds, size, statements, statement_seconds):
+        labels = (route, method)
+        with self.lock:
+            self.in_flight.inc((), -1)
+            self.requests.inc(labels + (status,))
+            self.latency.observe(labels, seconds)
+            self.size.observe(labels, size)
+            self.statements.observe(labels, statements)
+            self.statement_time.observe(labels, statement_seconds)
+
+    def record_statement(self, seconds):
+        with self.lock:
+            self.statements_total.inc()
+            self.statement_seconds_total.inc((), seconds)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in [self.requests, self.in_flight, self.latency, self.size,
+                           self.statements, self.statement_time, self.statements_total, self.statement_seconds_total]:
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats(object):
+    __slots__ = ['started', 'statements', 'statement_seconds']
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.statement_seconds = 0
+
+
+class MetricsMiddleware(object):
+    """
+    Records per-route metrics for every request and counts the SQL statements
+    the db_engines execute on its behalf. List it before the autocrud Middleware
+    so its process_response sees the serialized body.
+    """
+
+    def __init__(self, metrics, *db_engines):
+        self.metrics = metrics
+        self.local = threading.local()
+        for db_engine in db_engines:
+            if db_engine is None:
+                continue
+            event.listen(db_engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(db_engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.local.statement_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - self.local.statement_started
+        self.metrics.record_statement(seconds)
+        stats = getattr(self.local, 'stats', None)
+        if stats is not None:
+            stats.statements += 1
+            stats.statement_seconds += seconds
+
+    def process_request(self, req, resp):
+        self.metrics.start_request()
+        self.local.stats = req.context['metrics'] = RequestStats()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        self.local.stats = None
+        stats = req.context.get('metrics')
+        if stats is None:
+            return
+
+        if resp.stream is not None:
+            # Streamed bodies run their queries while the server iterates them.
+            resp.stream = self.observe_stream(resp.stream, req, resp, stats)
+            return
+
+        body = resp.body if resp.body is not None else resp.data
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.finish(req, resp, stats, len(body) if body is not None else 0)
+
+    def observe_stream(self, stream, req, resp, stats):
+        size = 0
+        try:
+            chunks = iter(stream)
+            while True:
+                self.local.stats = stats
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    self.local.stats = None
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+            self.finish(req, resp, stats, size)
+
+    def finish(self, req, resp, stats, size):
+        self.metrics.finish_request(
+            req.uri_template or 'unmatched',
+            req.method,
+            resp.status.split(' ', 1)[0],
+            time.perf_counter() - stats.started,
+            size,
+            stats.statements,
+            stats.statement_seconds,
+        )
@@ -0,0 +1,172 @@
+import argparse
+import sys
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+from inkit_project.db import make_engine
+from inkit_project.models import Base, CHANGE_SEQ, CHANGE_SEQ_DDL, CONTACTS_FTS_DDL, COUNTED_COLUMNS, NORMALIZED_EMAIL, ROW_COUNT_DDL, \
+    TABLE_VERSION_DDL, TABLE_VERSIONS_SEED
+
+
+def add_columns(connection):
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(
+                    table.name, CreateColumn(column).compile(dialect=connection.dialect)
+                ))
+
+
+def add_indexes(connection):
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = dict((index['name'], bool(index['unique'])) for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing and existing[index.name] != index.unique:
+                # e.g. an index that has since been made unique.
+                index.drop(connection)
+            elif index.name in existing:
+                continue
+            index.create(connection)
+
+
+DUPLICATE_CONTACTS = 'SELECT id FROM contacts WHERE id NOT IN (SELECT min(id) FROM contacts GROUP BY {0})'.format(NORMALIZED_EMAIL)
+DUPLICATE_ADDRESSES = 'SELECT id FROM addresses WHERE contact_id IS NOT NULL AND id NOT IN (SELECT min(id) FROM addresses GROUP BY contact_id)'
+
+
+def unique_indexes(connection):
+    return dict((index['name'], bool(index['unique'])) for table in ['contacts', 'addresses']
+                for index in inspect(connection).get_indexes(table))
+
+
+def check_duplicates(connection):
+    # Emails were not unique before, and neither was an address per contact.
+    # add_indexes can't create the unique indexes over duplicates, and which
+    # ones to delete is not for a server start to decide.
+    indexes = unique_indexes(connection)
+    found = []
+    if not indexes.get('ix_contacts_email_normalized') and connection.execute(DUPLICATE_CONTACTS + ' LIMIT 1').scalar():
+        found.append('contacts with the same email')
+    if not indexes.get('ix_addresses_contact_id') and connection.execute(DUPLICATE_ADDRESSES + ' LIMIT 1').scalar():
+        found.append('contacts with more than one address')
+    if found:
+        raise ValueError('{0} has {1}; remove them with python -m inkit_project.migrations --dedupe'.format(
+            connection.engine.url, ' and '.join(found)))
+
+
+def dedupe_contacts(connection):
+    """
+    Deletes every contact but the oldest for each email, and every address
+    but the oldest for each contact, along with the addresses of the deleted
+    contacts. Returns the number of contacts and of addresses deleted.
+    """
+    # The addresses go first, so the count includes those ON DELETE CASCADE would remove.
+    addresses = connection.execute('DELETE FROM addresses WHERE contact_id IN ({0})'.format(DUPLICATE_CONTACTS)).rowcount
+    contacts = connection.execute('DELETE FROM contacts WHERE id IN ({0})'.format(DUPLICATE_CONTACTS)).rowcount
+    addresses += connection.execute('DELETE FROM addresses WHERE id IN ({0})'.format(DUPLICATE_ADDRESSES)).rowcount
+    return contacts, addresses
+
+
+def rebuild_search_index(connection):
+    connection.execute("INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')")
+
+
+def add_search_index(connection):
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'contacts_fts'").scalar()
+    for statement in CONTACTS_FTS_DDL:
+        connection.execute(statement)
+    if not exists:
+        rebuild_search_index(connection)
+
+
+def add_table_versions(connection):
+    connection.execute(TABLE_VERSIONS_SEED)
+    for statements in TABLE_VERSION_DDL.values():
+        for statement in statements:
+            connection.execute(statement)
+
+
+def add_change_feed(connection):
+    # Contacts written before the change feed existed are stamped in id order,
+    # after anything already stamped, and their addresses along with them.
+    if connection.execute('SELECT 1 FROM contacts WHERE change_seq IS NULL LIMIT 1').scalar():
+        connection.execute('UPDATE contacts SET change_seq = id + {0} WHERE change_seq IS NULL'.format(CHANGE_SEQ))
+        connection.execute("UPDATE table_versions SET version = (SELECT max(change_seq) FROM contacts) WHERE name = 'changes'")
+        connection.execute('UPDATE addresses SET change_seq = (SELECT change_seq FROM contacts WHERE contacts.id = addresses.contact_id) '
+                           'WHERE change_seq IS NULL')
+    for statements in CHANGE_SEQ_DDL.values():
+        for statement in statements:
+            connection.execute(statement)
+
+
+def rebuild_counts(connection):
+    connection.execute('DELETE FROM row_counts')
+    for table, columns in COUNTED_COLUMNS.items():
+        connection.execute("INSERT INTO row_counts (table_name, dimension, value, count) "
+                           "SELECT '{0}', '', '', count(*) FROM {0}".format(table))
+        for name in columns:
+            connection.execute("INSERT INTO row_counts (table_name, dimension, value, count) "
+                               "SELECT '{0}', '{1}', {1}, count(*) FROM {0} GROUP BY {1}".format(table, name))
+
+
+def add_row_counts(connection):
+    # Triggers keep the counts once they exist, so the tables are only
+    # counted when row_counts is new.
+    if not connection.execute('SELECT 1 FROM row_counts LIMIT 1').scalar():
+        rebuild_counts(connection)
+    for statements in ROW_COUNT_DDL.values():
+        for statement in statements:
+            connection.execute(statement)
+
+
+# Every migration must be idempotent: upgrade() runs all of them each time
+# the application starts.
+MIGRATIONS = [
+    add_columns,
+    check_duplicates,
+    add_indexes,
+    add_search_index,
+    add_table_versions,
+    add_change_feed,
+    add_row_counts,
+]
+
+
+def upgrade(engine):
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            migration(connection)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Upgrade the schema of a contacts database.')
+    parser.add_argument('--db', help='database URI (default: $CONTACTS_DB_URL or contacts.db)')
+    parser.add_argument('--rebuild-search', action='store_true', help='rebuild the full-text search index')
+    parser.add_argument('--rebuild-counts', action='store_true', help='recount the rows behind X-Total-Count and /addresses/stats')
+    parser.add_argument('--dedupe', action='store_true', help='first delete duplicate contacts and addresses, keeping the oldest')
+    parser.add_argument('--dry-run', action='store_true', help='with --dedupe, only count what would be deleted')
+    options = parser.parse_args()
+
+    engine = make_engine(url=options.db) if options.db else make_engine()
+    if options.dedupe:
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            contacts, addresses = dedupe_contacts(connection)
+            if options.dry_run:
+                transaction.rollback()
+            else:
+                transaction.commit()
+        print('{0} {1} duplicate contacts and {2} addresses'.format(
+            'Would delete' if options.dry_run else 'Deleted', contacts, addresses))
+        if options.dry_run:
+            sys.exit()
+    upgrade(engine)
+    if options.rebuild_search:
+        with engine.begin() as connection:
+            rebuild_search_index(connection)
+    if options.rebuild_counts:
+        with engine.begin() as connection:
+            rebuild_counts(connection)
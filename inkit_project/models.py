@@ -1,10 +1,11 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+import string
+
+from sqlalchemy import Column, Index, Integer, String, ForeignKey, DDL, event, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from inkit_project.db import make_engine
 
 Base = declarative_base()
-DB_URI = 'sqlite:///contacts.db'
 
 
 class Address(Base):
@@ -13,16 +14,19 @@ class Address(Base):
     id = Column(Integer, primary_key=True)
     street_address = Column(String(250), nullable=False)
     unit_number = Column(String(250), nullable=True)
-    city = Column(String(50), nullable=False)
+    city = Column(String(50), nullable=False, index=True)
     state = Column(String(50), nullable=False)
-    post_code = Column(String(50), nullable=False)
+    post_code = Column(String(50), nullable=False, index=True)
     country = Column(String(50), nullable=False, default="US")
 
-    contact_id = Column(Integer, ForeignKey('contacts.id',  ondelete="CASCADE"))
+    contact_id = Column(Integer, ForeignKey('contacts.id',  ondelete="CASCADE"), index=True, unique=True)
     contact = relationship("Contact", back_populates="address")
 
+    version = Column(Integer, nullable=False, default=1, server_default='1', onupdate=text('version + 1'), info={'hidden': True})
+    change_seq = Column(Integer, nullable=True, info={'hidden': True})
+
     def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return {name: getattr(self, name) for name in ADDRESS_FIELDS}
 
 
 class Contact(Base):
@@ -30,21 +34,183 @@ class Contact(Base):
 
     id = Column(Integer, primary_key=True)
     first_name = Column(String(50), nullable=False)
-    last_name = Column(String(50), nullable=False)
-    email = Column(String(50), nullable=False)
+    last_name = Column(String(50), nullable=False, index=True)
+    email = Column(String(50), nullable=False, index=True)
     phone_number = Column(String(50), nullable=True)
-    company = Column(String(50), nullable=True)
+    company = Column(String(50), nullable=True, index=True)
     notes = Column(String(500), nullable=True)
 
     address = relationship("Address", uselist=False, back_populates="contact", passive_deletes=True)
 
+    # Bumped in the UPDATE itself rather than used as an optimistic lock, so
+    # set-based writes in between don't make a PUT or PATCH fail.
+    version = Column(Integer, nullable=False, default=1, server_default='1', onupdate=text('version + 1'), info={'hidden': True})
+    change_seq = Column(Integer, nullable=True, index=True, info={'hidden': True})
+
     def as_dict(self):
-        contact = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        contact = {name: getattr(self, name) for name in CONTACT_FIELDS}
         contact.update({'address': self.address.as_dict()})
         return contact
 
 
+# Emails are unique regardless of case and surrounding spaces. Upserts name
+# NORMALIZED_EMAIL as their conflict target, so it must match the index.
+NORMALIZED_EMAIL = 'lower(trim(email))'
+Index('ix_contacts_email_normalized', func.lower(func.trim(Contact.email)), unique=True)
+ASCII_LOWERCASE = dict((ord(upper), ord(lower)) for upper, lower in zip(string.ascii_uppercase, string.ascii_lowercase))
+
+
+def normalize_email(email):
+    # What SQLite's lower(trim(email)) computes: only spaces are trimmed and
+    # only ASCII letters are lowercased.
+    return email.strip(' ').translate(ASCII_LOWERCASE)
+
+
+# __startswith filters are case-insensitive, so their index ranges are read
+# off NOCASE indexes; the BINARY ones above serve exact matches.
+for prefix_column in [Contact.last_name, Contact.email, Contact.company, Address.city, Address.post_code]:
+    Index('ix_{0}_{1}_nocase'.format(prefix_column.table.name, prefix_column.name), prefix_column.collate('NOCASE'))
+
+
+class TableVersion(Base):
+    __tablename__ = 'table_versions'
+
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class RowCount(Base):
+    __tablename__ = 'row_counts'
+
+    # ('contacts', '', '') counts the whole table, ('addresses', 'state', 'MN') the rows with that value.
+    table_name = Column(String(50), primary_key=True)
+    dimension = Column(String(50), primary_key=True)
+    value = Column(String(50), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ContactTombstone(Base):
+    __tablename__ = 'contact_tombstones'
+
+    contact_id = Column(Integer, primary_key=True, autoincrement=False)
+    change_seq = Column(Integer, nullable=False, index=True)
+
+
+# Hidden columns are bookkeeping and are left out of API responses.
+ADDRESS_FIELDS = [c.name for c in Address.__table__.columns if not c.info.get('hidden')]
+CONTACT_FIELDS = [c.name for c in Contact.__table__.columns if not c.info.get('hidden')]
+
+# Every write to contacts or addresses bumps the table's row in
+# table_versions, which collection ETags are derived from.
+TABLE_VERSIONS_SEED = "INSERT OR IGNORE INTO table_versions (name, version) VALUES ('contacts', 0), ('addresses', 0), ('changes', 0)"
+TABLE_VERSION_DDL = dict((table, [
+    "CREATE TRIGGER IF NOT EXISTS {table}_version_{operation} AFTER {operation} ON {table} BEGIN "
+    "UPDATE table_versions SET version = version + 1 WHERE name = '{table}'; END".format(table=table, operation=operation)
+    for operation in ['insert', 'update', 'delete']
+]) for table in ['contacts', 'addresses'])
+
+event.listen(TableVersion.__table__, 'after_create', DDL(TABLE_VERSIONS_SEED).execute_if(dialect='sqlite'))
+for model in [Contact, Address]:
+    for statement in TABLE_VERSION_DDL[model.__tablename__]:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+# The 'changes' row of table_versions is a sequence shared by both tables.
+# Every insert or update stamps the row with the next value, a change to an
+# address stamps its contact too, and deleting a contact leaves a tombstone,
+# so GET /contacts/changes can read what changed since a value off the
+# change_seq indexes.
+NEXT_CHANGE_SEQ = "UPDATE table_versions SET version = version + 1 WHERE name = 'changes'; "
+CHANGE_SEQ = "(SELECT version FROM table_versions WHERE name = 'changes')"
+# Setting change_seq itself must not count as another change.
+CONTACT_CHANGE_COLUMNS = ', '.join(c.name for c in Contact.__table__.columns if c.name not in ('id', 'change_seq'))
+ADDRESS_CHANGE_COLUMNS = ', '.join(c.name for c in Address.__table__.columns if c.name not in ('id', 'change_seq'))
+CHANGE_SEQ_DDL = {
+    'contacts': [
+        "CREATE TRIGGER IF NOT EXISTS contacts_change_insert AFTER INSERT ON contacts BEGIN " + NEXT_CHANGE_SEQ +
+        "UPDATE contacts SET change_seq = {0} WHERE id = new.id; "
+        "DELETE FROM contact_tombstones WHERE contact_id = new.id; END".format(CHANGE_SEQ),
+        "CREATE TRIGGER IF NOT EXISTS contacts_change_update AFTER UPDATE OF {0} ON contacts BEGIN ".format(CONTACT_CHANGE_COLUMNS) +
+        NEXT_CHANGE_SEQ + "UPDATE contacts SET change_seq = {0} WHERE id = new.id; END".format(CHANGE_SEQ),
+        "CREATE TRIGGER IF NOT EXISTS contacts_change_delete AFTER DELETE ON contacts BEGIN " + NEXT_CHANGE_SEQ +
+        "INSERT OR REPLACE INTO contact_tombstones (contact_id, change_seq) VALUES (old.id, {0}); END".format(CHANGE_SEQ),
+    ],
+    'addresses': [
+        "CREATE TRIGGER IF NOT EXISTS addresses_change_insert AFTER INSERT ON addresses BEGIN " + NEXT_CHANGE_SEQ +
+        "UPDATE addresses SET change_seq = {0} WHERE id = new.id; "
+        "UPDATE contacts SET change_seq = {0} WHERE id = new.contact_id; END".format(CHANGE_SEQ),
+        "CREATE TRIGGER IF NOT EXISTS addresses_change_update AFTER UPDATE OF {0} ON addresses BEGIN ".format(ADDRESS_CHANGE_COLUMNS) +
+        NEXT_CHANGE_SEQ + "UPDATE addresses SET change_seq = {0} WHERE id = new.id; "
+        "UPDATE contacts SET change_seq = {0} WHERE id IN (old.contact_id, new.contact_id); END".format(CHANGE_SEQ),
+        "CREATE TRIGGER IF NOT EXISTS addresses_change_delete AFTER DELETE ON addresses BEGIN " + NEXT_CHANGE_SEQ +
+        "UPDATE contacts SET change_seq = {0} WHERE id = old.contact_id; END".format(CHANGE_SEQ),
+    ],
+}
+
+for model in [Contact, Address]:
+    for statement in CHANGE_SEQ_DDL[model.__tablename__]:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+# Counted columns per table. row_counts is kept in step by triggers, in the
+# same transaction as the write, so totals never need a COUNT(*) scan.
+COUNTED_COLUMNS = {'contacts': [], 'addresses': ['country', 'state']}
+
+
+def count_statements(table, row, change, total=True):
+    dimensions = [("''", "''")] if total else []
+    dimensions += [("'{0}'".format(name), '{0}.{1}'.format(row, name)) for name in COUNTED_COLUMNS[table]]
+    return ''.join(
+        "INSERT INTO row_counts (table_name, dimension, value, count) VALUES ('{0}', {1}, {2}, {3}) "
+        "ON CONFLICT (table_name, dimension, value) DO UPDATE SET count = count + excluded.count; ".format(table, dimension, value, change)
+        for dimension, value in dimensions
+    )
+
+
+ROW_COUNT_DDL = dict((table, [
+    "CREATE TRIGGER IF NOT EXISTS {0}_count_insert AFTER INSERT ON {0} BEGIN {1}END".format(table, count_statements(table, 'new', 1)),
+    "CREATE TRIGGER IF NOT EXISTS {0}_count_delete AFTER DELETE ON {0} BEGIN {1}END".format(table, count_statements(table, 'old', -1)),
+] + ([
+    "CREATE TRIGGER IF NOT EXISTS {0}_count_update AFTER UPDATE OF {1} ON {0} BEGIN {2}{3}END".format(
+        table, ', '.join(columns), count_statements(table, 'old', -1, False), count_statements(table, 'new', 1, False)),
+] if columns else [])) for table, columns in COUNTED_COLUMNS.items())
+
+for model in [Contact, Address]:
+    for statement in ROW_COUNT_DDL[model.__tablename__]:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+SEARCH_COLUMNS = ['first_name', 'last_name', 'company', 'email', 'notes']
+SEARCH_WEIGHTS = [10.0, 10.0, 5.0, 5.0, 1.0]
+
+# contacts_fts is an external-content FTS5 index over contacts, kept in step
+# by triggers. The prefix indexes make type-ahead (prefix) queries cheap and
+# the stored rank function weighs names above free-text notes.
+CONTACTS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5({columns}, "
+    "content='contacts', content_rowid='id', prefix='2 3')",
+    "INSERT INTO contacts_fts(contacts_fts, rank) VALUES ('rank', 'bm25({weights})')",
+    "CREATE TRIGGER IF NOT EXISTS contacts_fts_insert AFTER INSERT ON contacts BEGIN "
+    "INSERT INTO contacts_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+    "CREATE TRIGGER IF NOT EXISTS contacts_fts_delete AFTER DELETE ON contacts BEGIN "
+    "INSERT INTO contacts_fts(contacts_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+    "CREATE TRIGGER IF NOT EXISTS contacts_fts_update AFTER UPDATE OF {columns} ON contacts BEGIN "
+    "INSERT INTO contacts_fts(contacts_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+    "INSERT INTO contacts_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+]
+CONTACTS_FTS_DDL = [statement.format(
+    columns=', '.join(SEARCH_COLUMNS),
+    weights=', '.join(str(weight) for weight in SEARCH_WEIGHTS),
+    new=', '.join('new.' + c for c in SEARCH_COLUMNS),
+    old=', '.join('old.' + c for c in SEARCH_COLUMNS),
+) for statement in CONTACTS_FTS_DDL]
+
+for statement in CONTACTS_FTS_DDL:
+    event.listen(Contact.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Contact.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS contacts_fts').execute_if(dialect='sqlite'))
+
+
 if __name__ == "__main__":
-    engine = create_engine(DB_URI)
+    engine = make_engine()
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
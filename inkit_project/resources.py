@@ -1,24 +1,77 @@
 from __future__ import absolute_import
-from falcon_autocrud.resource import CollectionResource, SingleResource
+from falcon_autocrud.db_session import session_scope
+from falcon_autocrud.resource import BaseResource, CollectionResource, SingleResource
 from inkit_project.models import *
+import base64
+import csv
+import hashlib
+import io
+import itertools
 import json
+import os
+import re
+import shutil
+import tempfile
 
 import falcon
+import falcon.util
 import jsonschema
+import sqlalchemy.exc
+import sqlalchemy.orm.exc
+from sqlalchemy import and_, column, false, func, or_, select, table, text
+from sqlalchemy.orm import joinedload
 
 
-json1_file = open('inkit_project/post_schema.json')
+json1_file = open(os.path.join(os.path.dirname(__file__), 'post_schema.json'))
 json1_str = json1_file.read()
 post_schema = json.loads(json1_str)
 
+# jsonschema.validate() checks the schema and builds a new validator and
+# format checker on every call, so both validators are compiled once here.
+PostValidator = jsonschema.validators.validator_for(post_schema)
+PostValidator.check_schema(post_schema)
+post_validator = PostValidator(post_schema, format_checker=jsonschema.FormatChecker())
+item_validator = PostValidator(dict(post_schema, type='object'), format_checker=jsonschema.FormatChecker())
 
-def validate_json(instance):
-    try:
-        jsonschema.validate(instance, post_schema, format_checker=jsonschema.FormatChecker())
-    except jsonschema.ValidationError as e:
+# PATCH /contacts sets any of the POST fields on every selected contact.
+patch_schema = dict(post_schema, type='object', minProperties=1)
+patch_schema.pop('required')
+patch_schema['properties'] = dict(post_schema['properties'])
+patch_schema['properties']['address'] = dict(post_schema['properties']['address'], additionalProperties=False, minProperties=1)
+patch_schema['properties']['address'].pop('required')
+patch_validator = PostValidator(patch_schema, format_checker=jsonschema.FormatChecker())
+
+
+def first_error(validator, instance):
+    for error in validator.iter_errors(instance):
+        return error.message
+    return None
+
+
+def validate_items(instances):
+    errors = []
+    for index, instance in enumerate(instances):
+        message = first_error(item_validator, instance)
+        if message is not None:
+            errors.append({'index': index, 'description': message})
+    return errors
+
+
+def describe_item_errors(errors):
+    return '; '.join('Item {0}: {1}'.format(e['index'], e['description']) for e in errors)
+
+
+def validate_json(instance, validator=post_validator):
+    message = first_error(validator, instance)
+    if message is None and isinstance(instance, list):
+        errors = validate_items(instance)
+        if errors:
+            message = describe_item_errors(errors)
+
+    if message is not None:
         raise falcon.HTTPBadRequest(
             'Failed data validation',
-            description=e.message
+            description=message
         )
 
 
@@ -27,57 +80,1022 @@ def validate_content_type(req, resp, resource, params):
         raise falcon.HTTPUnsupportedMediaType('This API supports only JSON-encoded requests. Make sure the '
                                               'Content-Type header is set appropiately')
 
-    if req.method in ['POST', 'PUT']:
-        validate_json(req.context['doc'])
+    if req.method == 'PUT':
+        validate_json(req.context['doc'], item_validator)
+
+    elif req.method == 'POST':
+        # Array items are checked here in a single pass but not rejected yet:
+        # the bulk path decides whether an invalid item fails the whole array.
+        message = first_error(post_validator, req.context['doc'])
+        if message is not None:
+            raise falcon.HTTPBadRequest('Failed data validation', description=message)
+        if isinstance(req.context['doc'], list):
+            req.context['item_errors'] = validate_items(req.context['doc'])
+
+
+CONTACT_COLUMNS = [Contact.__table__.c[name] for name in CONTACT_FIELDS if name != 'id']
+ADDRESS_COLUMNS = [Address.__table__.c[name] for name in ADDRESS_FIELDS if name not in ('id', 'contact_id')]
+
+
+def column_default(column):
+    return column.default.arg if column.default is not None else None
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def insert_contacts(connection, docs):
+    contact_rows = [{c.name: doc.get(c.name) for c in CONTACT_COLUMNS} for doc in docs]
+    connection.execute(Contact.__table__.insert(), contact_rows)
+
+    # executemany does not report generated keys, but while this transaction
+    # holds the SQLite write lock new rowids are allocated as max(id) + 1, so
+    # the chunk occupies the contiguous range ending at the current max(id).
+    last_id = connection.execute(select([func.max(Contact.__table__.c.id)])).scalar()
+    first_id = last_id - len(contact_rows) + 1
+
+    address_rows = []
+    for offset, doc in enumerate(docs):
+        address = doc['address']
+        row = {c.name: address.get(c.name, column_default(c)) for c in ADDRESS_COLUMNS}
+        row['contact_id'] = first_id + offset
+        address_rows.append(row)
+    connection.execute(Address.__table__.insert(), address_rows)
+
+    for offset, row in enumerate(contact_rows):
+        row['id'] = first_id + offset
+    return contact_rows
+
+
+# SQLite's limit on parameters in one statement since 3.32.
+SQLITE_MAX_VARIABLES = 32766
+
+
+def upsert_sql(table, names, conflict_target, count, returning=None):
+    statement = 'INSERT INTO {0} ({1}) VALUES {2} ON CONFLICT ({3}) DO UPDATE SET {4}, version = {0}.version + 1'.format(
+        table,
+        ', '.join(names),
+        ', '.join(['(' + ', '.join(['?'] * len(names)) + ')'] * count),
+        conflict_target,
+        ', '.join('{0} = excluded.{0}'.format(name) for name in names),
+    )
+    if returning is not None:
+        statement += ' RETURNING ' + returning
+    return statement
+
+
+def upsert_contacts(connection, docs):
+    """
+    insert_contacts() for syncs: a contact whose normalized email already
+    exists is replaced, address included, instead of being duplicated. Each
+    table takes one statement per SQLITE_MAX_VARIABLES parameters. Needs
+    SQLite 3.35 for RETURNING.
+    """
+    names = [c.name for c in CONTACT_COLUMNS]
+    contact_rows = [dict((name, doc.get(name)) for name in names) for doc in docs]
+    ids = {}
+    for batch in chunks(contact_rows, SQLITE_MAX_VARIABLES // len(names)):
+        values = tuple(itertools.chain.from_iterable([row[name] for name in names] for row in batch))
+        result = connection.execute(upsert_sql('contacts', names, NORMALIZED_EMAIL, len(batch), 'id, email'), values)
+        # RETURNING rows come in no particular order.
+        ids.update((normalize_email(email), contact_id) for contact_id, email in result)
+    for row in contact_rows:
+        row['id'] = ids[normalize_email(row['email'])]
+
+    names = [c.name for c in ADDRESS_COLUMNS] + ['contact_id']
+    address_rows = [[doc['address'].get(c.name, column_default(c)) for c in ADDRESS_COLUMNS] + [row['id']]
+                    for doc, row in zip(docs, contact_rows)]
+    for batch in chunks(address_rows, SQLITE_MAX_VARIABLES // len(names)):
+        connection.execute(upsert_sql('addresses', names, 'contact_id', len(batch)), tuple(itertools.chain.from_iterable(batch)))
+    return contact_rows
+
+
+def insert_chunk(db_engine, pending, write=insert_contacts):
+    """
+    Inserts (key, doc) pairs in one transaction, retrying them one by one if
+    that fails so a bad contact only costs itself. Returns the created rows
+    and the keys of the docs that violated a constraint. write can be
+    upsert_contacts instead.
+    """
+    try:
+        with db_engine.begin() as connection:
+            return write(connection, [doc for key, doc in pending]), []
+    except sqlalchemy.exc.IntegrityError:
+        pass
+
+    created, failed = [], []
+    for key, doc in pending:
+        try:
+            with db_engine.begin() as connection:
+                created.extend(write(connection, [doc]))
+        except sqlalchemy.exc.IntegrityError:
+            failed.append(key)
+    return created, failed
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def is_cursor_value(value):
+    # Cursors hold column values; anything else can't be bound to a comparison.
+    return value is None or isinstance(value, (str, int, float))
+
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        values = None
+    if not isinstance(values, list) or len(values) != length or not all(is_cursor_value(value) for value in values):
+        raise falcon.HTTPBadRequest('Invalid parameter', 'The "__cursor" parameter is invalid')
+    return values
+
+
+def set_next_cursor(req, resp, values):
+    cursor = encode_cursor(values)
+    params = dict(req.params)
+    params['__cursor'] = cursor
+    resp.set_header('X-Next-Cursor', cursor)
+    resp.add_link(req.path + falcon.util.to_query_str(params), 'next')
+
+
+def etag_matches(req, etag):
+    header = req.get_header('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # If-None-Match uses the weak comparison, which ignores the W/ prefix.
+    tags = [tag.strip() for tag in header.split(',')]
+    return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def read_your_writes(req):
+    return bool(req.get_param_as_bool('__read_your_writes'))
+
+
+def reader(resource, req):
+    # GETs read from the read-only pool, unless the client asked to see its
+    # own writes, which a replica may not have yet.
+    if resource.read_engine is None or read_your_writes(req):
+        return resource.db_engine
+    return resource.read_engine
+
+
+def queue_write(resource, handler, *args, **kwargs):
+    # Runs an autocrud handler on the group commit writer when there is one.
+    # Its sessions join the writer's batch through WriteQueue.sessionmaker.
+    if resource.write_queue is None:
+        return handler(*args, **kwargs)
+    return resource.write_queue.submit(lambda connection: handler(*args, **kwargs))
+
+
+def invalidate_cache(resource, *groups):
+    if resource.cache is None:
+        return
+    if resource.write_queue is not None:
+        # Not before the batch commits, or a read could cache the old row again.
+        resource.write_queue.after_commit(resource.cache.invalidate, *groups)
+    else:
+        resource.cache.invalidate(*groups)
+
+
+def keyset_clause(order, values):
+    # SQLite sorts nulls first, so they come after every value in descending
+    # order, and every value comes after them in ascending order.
+    clauses = []
+    for position, (column, descending) in enumerate(order):
+        equal = [c.is_(None) if v is None else c == v for (c, d), v in zip(order[:position], values)]
+        value = values[position]
+        if not descending:
+            after = column.isnot(None) if value is None else column > value
+        elif value is None:
+            after = false()
+        else:
+            after = or_(column < value, column.is_(None)) if column.nullable else column < value
+        clauses.append(and_(*(equal + [after])))
+    return or_(*clauses)
+
+
+def match_expression(query):
+    # Every term is quoted so user input cannot inject FTS5 syntax, and the
+    # last one matches as a prefix for type-ahead.
+    terms = ['"{0}"'.format(term.replace('"', '""')) for term in query.split()]
+    return ' '.join(terms) + '*'
+
+
+def prefix_upper_bound(prefix):
+    # The first string after every string that starts with prefix, or None.
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xD800 <= last <= 0xDFFF:
+        # Surrogates can't be encoded for SQLite.
+        last = 0xE000
+    return prefix[:-1] + chr(last)
+
+
+def prefix_clause(column, prefix):
+    # autocrud's __startswith is a LIKE, which SQLite only turns into an
+    # index range for literal patterns, not bound ones. The part of the prefix
+    # before any wildcard is matched against the NOCASE index as well.
+    literal = re.split('[%_]', prefix, 1)[0].translate(ASCII_LOWERCASE)
+    clauses = [column.like(prefix + '%')]
+    if literal:
+        clauses.append(column.collate('NOCASE') >= literal)
+        upper = prefix_upper_bound(literal)
+        if upper is not None:
+            clauses.append(column.collate('NOCASE') < upper)
+    return and_(*clauses)
+
+
+def read_in_batches(resource, req, query, order, batch_size, limit=None):
+    """
+    The rows of query(db_session), at most limit of them, read batch_size at a
+    time. Each batch has its own session and continues after the last row of
+    the one before, so a streamed response only holds a pooled connection
+    while a batch is read, not while a slow client downloads it. The first
+    batch is read before this returns, so a bad filter still gets an error
+    response. Rows written between batches may or may not be included.
+    """
+    def read(values, count):
+        with session_scope(reader(resource, req), sessionmaker_=resource.sessionmaker, **resource.sessionmaker_kwargs) as db_session:
+            resources = query(db_session)
+            if values is not None:
+                # __offset only skips rows before the first batch.
+                resources = resources.offset(None).filter(keyset_clause(order, values))
+            return db_session.execute(resources.limit(count).statement).fetchall()
+
+    def rows(batch, remaining):
+        while True:
+            for row in batch:
+                yield row
+            if remaining is not None:
+                remaining -= len(batch)
+            if len(batch) < batch_size or remaining == 0:
+                return
+            batch = read([getattr(batch[-1], column.key) for column, descending in order], min(batch_size, remaining or batch_size))
+
+    return rows(read(None, min(batch_size, limit or batch_size)), limit)
+
+
+def stream_json(rows, batch_size, serialize):
+    yield b'['
+    separator = ''
+    batch = []
+    for row in rows:
+        batch.append(separator + json.dumps(serialize(row)))
+        separator = ', '
+        if len(batch) == batch_size:
+            yield ''.join(batch).encode('utf-8')
+            batch = []
+    yield (''.join(batch) + ']').encode('utf-8')
+
+
+def stream_ndjson(rows, batch_size, projection):
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(projection.serialize(row)) + '\n')
+        if len(batch) == batch_size:
+            yield ''.join(batch).encode('utf-8')
+            batch = []
+    yield ''.join(batch).encode('utf-8')
+
+
+def stream_csv(rows, batch_size, projection):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(projection.flat_fields())
+    for count, row in enumerate(rows, 1):
+        writer.writerow(projection.flatten(row))
+        if count % batch_size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class Projection(object):
+    """
+    The columns a collection GET returns: every visible field by default, or
+    the ones named by ?fields=, e.g. first_name,email,address.city. Rows are
+    read with a Core select and serialized by position, in the same key order
+    as as_dict(), without building ORM instances.
+    """
+
+    def __init__(self, model, fields, nested):
+        self.model = model
+        self.fields = list(fields)
+        self.nested = []
+        position = len(self.fields)
+        for name, (relationship, related_fields) in nested.items():
+            # The related id comes first, to tell a missing row from one whose fields are all null.
+            self.nested.append((name, relationship, list(related_fields), position))
+            position += len(related_fields) + 1
+
+    def columns(self, order):
+        columns = [self.model.__table__.c[name] for name in self.fields]
+        for name, relationship, fields, position in self.nested:
+            related = relationship.property.mapper.class_.__table__
+            columns += [related.c[field].label('{0}__{1}'.format(name, field)) for field in ['id'] + fields]
+        # The sort columns go last: the next cursor is read from them by name.
+        return columns + [column for column, descending in order if column.name not in self.fields]
+
+    def serialize(self, row):
+        result = dict(zip(self.fields, row))
+        for name, relationship, fields, position in self.nested:
+            if row[position] is None:
+                result[name] = None
+            else:
+                result[name] = dict(zip(fields, row[position + 1:position + 1 + len(fields)]))
+        return result
+
+    def flat_fields(self):
+        names = list(self.fields)
+        for name, relationship, fields, position in self.nested:
+            names += ['{0}.{1}'.format(name, field) for field in fields]
+        return names
+
+    def flatten(self, row):
+        # A missing related row leaves its columns null.
+        values = list(row[:len(self.fields)])
+        for name, relationship, fields, position in self.nested:
+            values += row[position + 1:position + 1 + len(fields)]
+        return values
+
+
+class ModelCollectionResource(CollectionResource):
+    default_limit = 100
+    max_limit = 1000
+    stream_batch_size = 500
+    # Relationships serialized inside each item, e.g. {'address': (Contact.address, ADDRESS_FIELDS)}.
+    nested_fields = {}
+    # Query parameters that aren't column filters.
+    control_params = ('fields',)
+    # Columns whose exact-match filter row_counts has totals for.
+    counted_filters = ()
+
+    def __init__(self, db_engine, read_engine=None, **kwargs):
+        super(ModelCollectionResource, self).__init__(db_engine, **kwargs)
+        self.read_engine = read_engine
+        self.full_projection = Projection(self.model, self.response_fields, self.nested_fields)
+
+    def on_get(self, req, resp, *args, **kwargs):
+        if 'GET' not in self.methods:
+            raise falcon.HTTPMethodNotAllowed(self.methods)
+
+        etag = self.collection_etag(req)
+        resp.set_header('ETag', etag)
+        if etag_matches(req, etag):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            return
+
+        if req.get_param_as_bool('__stream'):
+            self.stream_collection(req, resp, *args, **kwargs)
+            return
+
+        limit = req.get_param_as_int('__limit', min=1, max=self.max_limit) or self.default_limit
+        order = self.sort_order(req)
+        projection = self.projection(req)
+
+        with session_scope(reader(self, req), sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            self.set_total_count(req, resp, db_session)
+            resources = self.collection_query(db_session, req, resp, order, projection, *args, **kwargs)
+            resources = resources.limit(limit + 1)
+
+            page = db_session.execute(resources.statement).fetchall()
+            if len(page) > limit:
+                page = page[:limit]
+                set_next_cursor(req, resp, [getattr(page[-1], column.key) for column, descending in order])
+
+            resp.status = falcon.HTTP_OK
+            req.context['result'] = [projection.serialize(row) for row in page]
+
+    def stream_collection(self, req, resp, *args, **kwargs):
+        limit = req.get_param_as_int('__limit', min=1)
+        order = self.sort_order(req)
+        projection = self.projection(req)
+
+        with session_scope(reader(self, req), sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            self.set_total_count(req, resp, db_session)
+        rows = read_in_batches(self, req, lambda db_session: self.collection_query(db_session, req, resp, order, projection, *args, **kwargs),
+                               order, self.stream_batch_size, limit)
+
+        resp.status = falcon.HTTP_OK
+        resp.stream = stream_json(rows, self.stream_batch_size, projection.serialize)
+
+    def collection_etag(self, req):
+        # Any write to either table changes its version, and the query string
+        # distinguishes the different views of the same versions.
+        with reader(self, req).connect() as connection:
+            versions = dict(connection.execute(select([TableVersion.name, TableVersion.version])).fetchall())
+        digest = hashlib.sha1(req.query_string.encode('utf-8')).hexdigest()[:16]
+        return '"{0}-{1}-{2}"'.format(versions.get('contacts'), versions.get('addresses'), digest)
+
+    def set_total_count(self, req, resp, db_session):
+        count = self.total_count(req, db_session)
+        if count is not None:
+            resp.set_header('X-Total-Count', str(count))
+
+    def total_count(self, req, db_session):
+        # Only totals row_counts already holds are reported: the whole table,
+        # or one exact counted_filters match. Anything else would need a scan.
+        filters = [key for key in req.params if not key.startswith('__') and key not in self.control_params]
+        if not filters:
+            dimension, value = '', ''
+        elif len(filters) == 1 and filters[0] in self.counted_filters and not isinstance(req.params[filters[0]], list):
+            dimension, value = filters[0], req.params[filters[0]]
+        else:
+            return None
+        count = db_session.execute(select([RowCount.count]).where(and_(
+            RowCount.table_name == self.model.__tablename__, RowCount.dimension == dimension, RowCount.value == value,
+        ))).scalar()
+        return count or 0
+
+    def projection(self, req):
+        names = req.get_param_as_list('fields')
+        if names is None:
+            return self.full_projection
+
+        fields, nested = [], {}
+        for name in names:
+            prefix, _, field = name.partition('.')
+            if prefix in self.nested_fields:
+                relationship, available = self.nested_fields[prefix]
+                if field and field not in available:
+                    raise falcon.HTTPBadRequest('Invalid parameter', 'The "fields" parameter has an unknown field: ' + name)
+                selected = nested.setdefault(prefix, (relationship, []))[1]
+                for field in [field] if field else available:
+                    if field not in selected:
+                        selected.append(field)
+            elif not field and name in self.response_fields:
+                if name not in fields:
+                    fields.append(name)
+            else:
+                raise falcon.HTTPBadRequest('Invalid parameter', 'The "fields" parameter has an unknown field: ' + name)
+        return Projection(self.model, fields, nested)
 
+    def collection_query(self, db_session, req, resp, order, projection, *args, **kwargs):
+        # The query is only used to build the statement: filters and the
+        # cursor go through the ORM API, but rows are read with Core.
+        resources = db_session.query(*projection.columns(order)).select_from(self.model)
+        for name, relationship, fields, position in projection.nested:
+            resources = resources.outerjoin(relationship)
+        resources = self.apply_arg_filter(req, resp, resources, kwargs)
+        resources = self.filter_by_params(resources, req.params)
+        resources = resources.order_by(*[column.desc() if descending else column for column, descending in order])
 
-class ContactCollectionResource(CollectionResource):
+        if req.get_param('__cursor'):
+            resources = resources.filter(keyset_clause(order, decode_cursor(req.get_param('__cursor'), len(order))))
+        if req.get_param_as_int('__offset'):
+            resources = resources.offset(req.get_param_as_int('__offset'))
+        return resources
+
+    def filter_by_params(self, resources, params):
+        # autocrud has no __in, and its __startswith can't use an index.
+        operators = dict((key, value) for key, value in params.items() if key.endswith(('__startswith', '__in')))
+        resources = super(ModelCollectionResource, self).filter_by_params(
+            resources,
+            dict((key, value) for key, value in params.items() if key not in operators and key not in self.control_params)
+        )
+        for key, value in operators.items():
+            name, _, operator = key.rpartition('__')
+            column = self.model.__table__.columns.get(name)
+            if column is None:
+                raise falcon.HTTPBadRequest('Invalid attribute', 'An attribute provided for filtering is invalid')
+            if operator == 'startswith':
+                # A prefix with a comma is parsed as a list.
+                resources = resources.filter(prefix_clause(column, ','.join(value) if isinstance(value, list) else value))
+            else:
+                resources = resources.filter(column.in_(value if isinstance(value, list) else value.split(',')))
+        return resources
+
+    def sort_order(self, req):
+        columns = self.model.__table__.columns
+        order = []
+        for field_name in req.get_param_as_list('__sort') or []:
+            column = columns.get(field_name.lstrip('-'))
+            if column is None:
+                raise falcon.HTTPBadRequest('Invalid attribute', 'An attribute provided for sorting is invalid')
+            order.append((column, field_name.startswith('-')))
+
+        # The primary key breaks ties, so every row has a unique position for the cursor.
+        primary_key = self.model.__table__.c.id
+        if primary_key not in [column for column, descending in order]:
+            order.append((primary_key, False))
+        return order
+
+
+class ContactCollectionResource(ModelCollectionResource):
     model = Contact
     allow_subresources = True
-    methods = ['GET', 'POST']
+    methods = ['GET', 'POST', 'PATCH', 'DELETE']
+    response_fields = CONTACT_FIELDS
+    nested_fields = {'address': (Contact.address, ADDRESS_FIELDS)}
+    bulk_chunk_size = 500
+    bulk_atomic = True
+
+    def __init__(self, db_engine, cache=None, write_queue=None, **kwargs):
+        if write_queue is not None:
+            kwargs['sessionmaker_'] = write_queue.sessionmaker
+        super(ContactCollectionResource, self).__init__(db_engine, **kwargs)
+        self.cache = cache
+        self.write_queue = write_queue
 
     @falcon.before(validate_content_type)
     def on_post(self, req, resp, *args, **kwargs):
         if isinstance(req.context['doc'], list):
-            contacts = req.context['doc']
-            for contact in contacts:
-                req.context['doc'] = contact
-                super(ContactCollectionResource, self).on_post(req, resp, *args, **kwargs)
+            self.bulk_post(req, resp)
+        elif req.get_param_as_bool('__upsert'):
+            self.upsert(req, resp)
+        else:
+            queue_write(self, super(ContactCollectionResource, self).on_post, req, resp, *args, **kwargs)
+
+    def upsert(self, req, resp):
+        contact = self.insert_atomic([req.context['doc']], 1, upsert_contacts)[0]
+        if self.cache is not None:
+            self.cache.invalidate(contact['id'])
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = {'data': contact}
+
+    def bulk_post(self, req, resp):
+        chunk_size = req.get_param_as_int('__chunk_size', min=1) or self.bulk_chunk_size
+        atomic = req.get_param_as_bool('__atomic')
+        if atomic is None:
+            atomic = self.bulk_atomic
+        write = upsert_contacts if req.get_param_as_bool('__upsert') else insert_contacts
 
+        docs = req.context['doc']
+        errors = list(req.context['item_errors'])
+        if errors and atomic:
+            raise falcon.HTTPBadRequest('Failed data validation', description=describe_item_errors(errors))
+
+        invalid = set(e['index'] for e in errors)
+        pending = [(index, doc) for index, doc in enumerate(docs) if index not in invalid]
+
+        if atomic:
+            created = self.insert_atomic([doc for index, doc in pending], chunk_size, write)
         else:
-            super(ContactCollectionResource, self).on_post(req, resp, *args, **kwargs)
+            created = self.insert_per_chunk(pending, chunk_size, errors, write)
+
+        if self.cache is not None:
+            self.cache.invalidate(*[contact['id'] for contact in created])
+
+        # Upserts may not have created anything.
+        resp.status = falcon.HTTP_OK if write is upsert_contacts else falcon.HTTP_CREATED
+        if errors and not created:
+            # Nothing was written, but the errors still say which items failed and why.
+            resp.status = falcon.HTTP_BAD_REQUEST
+        req.context['result'] = {'data': created}
+        if not atomic:
+            req.context['result']['errors'] = sorted(errors, key=lambda e: e['index'])
+
+    def insert_atomic(self, docs, chunk_size, write=insert_contacts):
+        created = []
+        try:
+            with self.db_engine.begin() as connection:
+                for chunk in chunks(docs, chunk_size):
+                    created.extend(write(connection, chunk))
+        except sqlalchemy.exc.IntegrityError:
+            raise falcon.HTTPConflict('Conflict', 'Unique constraint violated')
+        return created
+
+    def insert_per_chunk(self, pending, chunk_size, errors, write=insert_contacts):
+        created = []
+        for chunk in chunks(pending, chunk_size):
+            inserted, failed = insert_chunk(self.db_engine, chunk, write)
+            created.extend(inserted)
+            errors.extend({'index': index, 'description': 'Unique constraint violated'} for index in failed)
+        return created
+
+    def after_post(self, req, resp, resource):
+        invalidate_cache(self, resource.id)
+
+    @falcon.before(validate_content_type)
+    def on_patch(self, req, resp, *args, **kwargs):
+        updated = self.bulk_update(req)
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = {'updated': updated}
+
+    def on_delete(self, req, resp, *args, **kwargs):
+        deleted = self.bulk_delete(req)
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = {'deleted': deleted}
+
+    def bulk_update(self, req):
+        changes = req.context['doc']
+        validate_json(changes, patch_validator)
+        contact_values = dict((getattr(Contact, name), value) for name, value in changes.items() if name != 'address')
+        contact_values[Contact.version] = Contact.version + 1
+
+        with session_scope(self.db_engine, sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            selected = self.bulk_selection(db_session, req)
+            try:
+                if 'address' in changes:
+                    # Before the contacts, whose update may change the columns they're selected by.
+                    address_values = dict((getattr(Address, name), value) for name, value in changes['address'].items())
+                    address_values[Address.version] = Address.version + 1
+                    db_session.query(Address).filter(
+                        Address.contact_id.in_(selected.with_entities(Contact.id).statement)
+                    ).update(address_values, synchronize_session=False)
+                updated = selected.update(contact_values, synchronize_session=False)
+                db_session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                db_session.rollback()
+                raise falcon.HTTPConflict('Conflict', 'Unique constraint violated')
+
+        self.invalidate_selection(req)
+        return updated
+
+    def bulk_delete(self, req):
+        with session_scope(self.db_engine, sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            # Addresses go with their contacts through ON DELETE CASCADE.
+            deleted = self.bulk_selection(db_session, req).delete(synchronize_session=False)
+            db_session.commit()
+
+        self.invalidate_selection(req)
+        return deleted
+
+    def bulk_selection(self, db_session, req):
+        if not [key for key in req.params if not key.startswith('__') and key not in self.control_params]:
+            raise falcon.HTTPBadRequest('Invalid parameter', 'Updating or deleting every contact needs a filter, e.g. id__in=1,2,3')
+        return self.filter_by_params(db_session.query(Contact), req.params)
+
+    def invalidate_selection(self, req):
+        if self.cache is None:
+            return
+        # Nothing outside an id filter was touched; any other filter could have hit any contact.
+        ids = req.get_param_as_list('id__in') or req.get_param_as_list('id')
+        try:
+            groups = [int(contact_id) for contact_id in ids or ()]
+        except ValueError:
+            groups = None
+        if groups:
+            self.cache.invalidate(*groups)
+        else:
+            self.cache.clear()
+
+
+class ContactExportResource(ModelCollectionResource):
+    """
+    Every contact with its address, or those matching the filters, streamed
+    in id order as NDJSON or CSV. since=<id> only exports contacts created
+    after that one, for incremental exports.
+    """
+
+    model = Contact
+    methods = ['GET']
+    response_fields = CONTACT_FIELDS
+    nested_fields = {'address': (Contact.address, ADDRESS_FIELDS)}
+    control_params = ('fields', 'format', 'since')
+    formats = {
+        'ndjson':   ('application/x-ndjson', stream_ndjson),
+        'csv':      ('text/csv; charset=utf-8', stream_csv),
+    }
+    export_batch_size = 1000
+
+    def on_get(self, req, resp, *args, **kwargs):
+        export_format = req.get_param('format') or 'ndjson'
+        if export_format not in self.formats:
+            raise falcon.HTTPBadRequest('Invalid parameter', 'The "format" parameter must be one of: ' + ', '.join(sorted(self.formats)))
+        content_type, stream = self.formats[export_format]
+        since = req.get_param_as_int('since', min=0)
+        order = [(Contact.__table__.c.id, False)]
+        projection = self.projection(req)
+
+        def query(db_session):
+            resources = self.collection_query(db_session, req, resp, order, projection, *args, **kwargs)
+            if since is not None:
+                resources = resources.filter(Contact.id > since)
+            return resources
+
+        rows = read_in_batches(self, req, query, order, self.export_batch_size)
+        resp.status = falcon.HTTP_OK
+        resp.content_type = content_type
+        resp.stream = stream(rows, self.export_batch_size, projection)
+
+
+class CachedResource(SingleResource):
+    """
+    Single-item GETs with strong ETags, served from a ResponseCache of
+    serialized bodies when one is configured. Cache entries are grouped by
+    contact id, which is what writes invalidate.
+    """
+
+    # Single items are small and requested often, so they're compressed fast.
+    compression_levels = {'gzip': 1, 'br': 1, 'zstd': 1}
+
+    def __init__(self, db_engine, cache=None, read_engine=None, write_queue=None, **kwargs):
+        if write_queue is not None:
+            kwargs['sessionmaker_'] = write_queue.sessionmaker
+        super(CachedResource, self).__init__(db_engine, **kwargs)
+        self.cache = cache
+        self.read_engine = read_engine
+        self.write_queue = write_queue
+
+    def on_get(self, req, resp, *args, **kwargs):
+        if 'GET' not in self.methods:
+            raise falcon.HTTPMethodNotAllowed(self.methods)
+
+        key = (self.model.__tablename__, kwargs['id'])
+        # Entries may have been filled from a replica, so they're skipped too.
+        entry = self.cache.get(key) if self.cache is not None and not read_your_writes(req) else None
+        if entry is None:
+            entry = self.load(req, resp, key, *args, **kwargs)
+
+        etag, body = entry
+        resp.set_header('ETag', etag)
+        if etag_matches(req, etag):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            return
+
+        resp.status = falcon.HTTP_OK
+        resp.body = body
+
+    def load(self, req, resp, key, *args, **kwargs):
+        token = self.cache.token() if self.cache is not None else None
+        with session_scope(reader(self, req), sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            resources = self.apply_arg_filter(req, resp, db_session.query(self.model), kwargs)
+            try:
+                resource = self.get_filter(req, resp, resources, *args, **kwargs).one()
+            except sqlalchemy.orm.exc.NoResultFound:
+                raise falcon.HTTPNotFound()
+
+            etag = self.etag(resource)
+            if etag_matches(req, etag):
+                # Not worth serializing (or caching) a body the client already has.
+                return etag, None
+
+            result = resource.as_dict()
+
+        entry = (etag, json.dumps(result))
+        if self.cache is not None:
+            self.cache.set(key, entry, token, self.cache_group(result))
+        return entry
 
-    def after_get(self, req, resp, collection, *args, **kwargs):
-        req.context['result'] = [resource.as_dict() for resource in collection]
+    def invalidate(self, resource):
+        invalidate_cache(self, resource.id)
 
 
-class ContactResource(SingleResource):
+class ContactResource(CachedResource):
     model = Contact
     methods = ['GET', 'PATCH', 'DELETE', 'PUT']
+    response_fields = CONTACT_FIELDS
 
     @falcon.before(validate_content_type)
     def on_put(self, req, resp, *args, **kwargs):
-        super(ContactResource, self).on_put(req, resp, *args, **kwargs)
+        queue_write(self, super(ContactResource, self).on_put, req, resp, *args, **kwargs)
 
     @falcon.before(validate_content_type)
     def on_patch(self, req, resp, *args, **kwargs):
-        super(ContactResource, self).on_patch(req, resp, *args, **kwargs)
+        queue_write(self, super(ContactResource, self).on_patch, req, resp, *args, **kwargs)
 
-    def after_get(self, req, resp, resource, *args, **kwargs):
-        req.context['result'] = resource.as_dict()
+    def on_delete(self, req, resp, *args, **kwargs):
+        queue_write(self, super(ContactResource, self).on_delete, req, resp, *args, **kwargs)
 
+    def get_filter(self, req, resp, query, *args, **kwargs):
+        return query.options(joinedload(Contact.address))
 
-class AddressCollectionResource(CollectionResource):
+    def etag(self, resource):
+        address_version = resource.address.version if resource.address is not None else 0
+        return '"{0}-{1}-{2}"'.format(resource.id, resource.version, address_version)
+
+    def cache_group(self, result):
+        return result['id']
+
+    def after_put(self, req, resp, resource, *args, **kwargs):
+        self.invalidate(resource)
+
+    def after_patch(self, req, resp, resource, *args, **kwargs):
+        self.invalidate(resource)
+
+    def after_delete(self, req, resp, resource, *args, **kwargs):
+        self.invalidate(resource)
+
+
+class AddressCollectionResource(ModelCollectionResource):
     model = Address
     methods = ['GET']
+    response_fields = ADDRESS_FIELDS
+    counted_filters = ('country', 'state')
+
 
-    def after_get(self, req, resp, collection, *args, **kwargs):
-        req.context['result'] = [resource.as_dict() for resource in collection]
+class ReadOnlyResource(BaseResource):
+    """
+    A resource that only serves GETs, from read_engine when there is one.
+    """
 
+    def __init__(self, db_engine, read_engine=None, **kwargs):
+        super(ReadOnlyResource, self).__init__(db_engine, **kwargs)
+        self.read_engine = read_engine
 
-class AddressResource(SingleResource):
+
+class AddressStatsResource(ReadOnlyResource):
+    """
+    Address totals, overall and per country and state, read from row_counts
+    rather than counted, so the cost doesn't grow with the table.
+    """
+
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = self.stats(req)
+
+    def stats(self, req):
+        stats = {'total': 0}
+        stats.update((dimension, {}) for dimension in COUNTED_COLUMNS['addresses'])
+        counts = select([RowCount.dimension, RowCount.value, RowCount.count]) \
+            .where(and_(RowCount.table_name == 'addresses', RowCount.count > 0)) \
+            .order_by(RowCount.dimension, RowCount.value)
+        with session_scope(reader(self, req), sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            for dimension, value, count in db_session.execute(counts):
+                if dimension:
+                    stats[dimension][value] = count
+                else:
+                    stats['total'] = count
+        return stats
+
+
+class AddressResource(CachedResource):
     model = Address
     methods = ['GET']
 
-    def after_get(self, req, resp, resource, *args, **kwargs):
-        req.context['result'] = resource.as_dict()
+    def etag(self, resource):
+        return '"{0}-{1}"'.format(resource.id, resource.version)
+
+    def cache_group(self, result):
+        return result['contact_id']
+
+
+class CacheStatsResource(object):
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = self.cache.stats()
+
+
+class ContactImportResource(object):
+    """
+    Accepts an NDJSON or CSV file of contacts, in the shape GET
+    /contacts/export writes them, and imports it in the background.
+    The upload is spooled to disk, so its size doesn't matter.
+    """
+
+    formats = {
+        'application/x-ndjson': 'ndjson',
+        'text/csv':             'csv',
+    }
+    spool_chunk_size = 64 * 1024
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def on_post(self, req, resp):
+        import_format = req.get_param('format')
+        if import_format is None:
+            media_type = (req.content_type or '').split(';', 1)[0].strip().lower()
+            import_format = self.formats.get(media_type)
+            if import_format is None:
+                raise falcon.HTTPUnsupportedMediaType('Imports must be sent as ' + ' or '.join(sorted(self.formats)))
+        elif import_format not in self.formats.values():
+            raise falcon.HTTPBadRequest('Invalid parameter', 'The "format" parameter must be one of: ' + ', '.join(sorted(self.formats.values())))
+        chunk_size = req.get_param_as_int('__chunk_size', min=1, max=10000) or 1000
+        upsert = req.get_param_as_bool('__upsert') or False
+
+        upload = tempfile.NamedTemporaryFile(prefix='contacts-import-', delete=False)
+        try:
+            with upload:
+                shutil.copyfileobj(req.bounded_stream, upload, self.spool_chunk_size)
+        except Exception:
+            os.remove(upload.name)
+            raise
+        job = self.jobs.start(upload.name, import_format, chunk_size, upsert)
+
+        resp.status = falcon.HTTP_ACCEPTED
+        resp.location = '/contacts/import/{0}'.format(job.id)
+        req.context['result'] = job.as_dict()
+
+
+class ImportJobResource(object):
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def on_get(self, req, resp, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound()
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = job.as_dict()
+
+
+class MetricsResource(object):
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_OK
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.body = self.metrics.render()
+
+
+contacts_fts = table('contacts_fts', column('rowid'), column('rank'))
+
+
+class ContactSearchResource(ReadOnlyResource):
+    default_limit = 20
+    max_limit = 100
+
+    def on_get(self, req, resp):
+        terms, limit, offset = self.search_params(req)
+        with session_scope(reader(self, req), sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            found = self.search(db_session, terms, limit + 1, offset)
+        if len(found) > limit:
+            found = found[:limit]
+            set_next_cursor(req, resp, [offset + limit])
+
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = [contact for rank, contact in found]
+
+    def search_params(self, req):
+        terms = req.get_param('q')
+        if not terms or not terms.split():
+            raise falcon.HTTPBadRequest('Invalid parameter', 'The "q" parameter is required')
+
+        limit = req.get_param_as_int('__limit', min=1, max=self.max_limit) or self.default_limit
+        offset = decode_cursor(req.get_param('__cursor'), 1)[0] if req.get_param('__cursor') else 0
+        if not isinstance(offset, int) or offset < 0:
+            raise falcon.HTTPBadRequest('Invalid parameter', 'The "__cursor" parameter is invalid')
+        return terms, limit, offset
+
+    def search(self, db_session, terms, limit, offset):
+        # (rank, contact) pairs, best match first.
+        hits = select([contacts_fts.c.rowid, contacts_fts.c.rank]) \
+            .where(text('contacts_fts MATCH :terms').bindparams(terms=match_expression(terms))) \
+            .order_by(contacts_fts.c.rank) \
+            .limit(limit) \
+            .offset(offset)
+        ranks = db_session.execute(hits).fetchall()
+
+        contacts = {}
+        if ranks:
+            query = db_session.query(Contact).options(joinedload(Contact.address)).filter(Contact.id.in_([id for id, rank in ranks]))
+            contacts = dict((contact.id, contact.as_dict()) for contact in query)
+        return [(rank, contacts[id]) for id, rank in ranks if id in contacts]
+
+
+class ContactChangesResource(ReadOnlyResource):
+    """
+    What changed since a change_seq: contacts written after it, with their
+    addresses, and tombstones for the ones deleted, in change order. Clients
+    pass the returned since back to get the next page, or the next delta.
+    """
+
+    default_limit = 100
+    max_limit = 1000
+    projection = Projection(Contact, CONTACT_FIELDS, {'address': (Contact.address, ADDRESS_FIELDS)})
+
+    def on_get(self, req, resp):
+        since = req.get_param_as_int('since', min=0) or 0
+        limit = req.get_param_as_int('__limit', min=1, max=self.max_limit) or self.default_limit
+        change_seq = Contact.__table__.c.change_seq
+        tombstones = ContactTombstone.__table__
+
+        with session_scope(reader(self, req), sessionmaker_=self.sessionmaker, **self.sessionmaker_kwargs) as db_session:
+            # The two reads below may not see the same snapshot. Capping them at
+            # the last committed change keeps writes that land in between
+            # (always numbered higher) out of this page instead of skipping them.
+            last = db_session.execute(select([TableVersion.version]).where(TableVersion.name == 'changes')).scalar()
+            contacts = db_session.query(*self.projection.columns([(change_seq, False)])).select_from(Contact) \
+                .outerjoin(Contact.address) \
+                .filter(change_seq > since, change_seq <= last) \
+                .order_by(change_seq) \
+                .limit(limit + 1)
+            deleted = select([tombstones.c.contact_id, tombstones.c.change_seq]) \
+                .where(and_(tombstones.c.change_seq > since, tombstones.c.change_seq <= last)) \
+                .order_by(tombstones.c.change_seq) \
+                .limit(limit + 1)
+
+            changes = [(row.change_seq, {'id': row.id, 'change_seq': row.change_seq, 'deleted': False,
+                                         'contact': self.projection.serialize(row)})
+                       for row in db_session.execute(contacts.statement)]
+            changes += [(row.change_seq, {'id': row.contact_id, 'change_seq': row.change_seq, 'deleted': True})
+                        for row in db_session.execute(deleted)]
+            changes.sort(key=lambda change: change[0])
+
+        more = len(changes) > limit
+        changes = changes[:limit]
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = {
+            'changes':  [change for seq, change in changes],
+            # Nothing up to last is left to read once the feed is drained.
+            'since':    changes[-1][0] if more else max(last, since),
+            'more':     more,
+        }
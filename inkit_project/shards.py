@@ -0,0 +1,446 @@
+"""
+Hash-sharded storage: contacts, with their address, spread over several
+SQLite databases. A contact lives in the shard a hash of its normalized email
+picks, so a duplicate email always meets the unique index of the same shard,
+and its id (and its address's, which is the same) is one that shard's index
+modulo count, so /contacts/{id} goes straight to it.
+
+    python -m inkit_project.shards --shards 4
+    python -m inkit_project.shards --shards 8 --source 'sqlite:///contacts-{shard}.db' --from-shards 4 --target 'sqlite:///new-{shard}.db'
+"""
+from __future__ import absolute_import
+import argparse
+import collections
+import csv
+import hashlib
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import falcon
+from falcon_autocrud.db_session import session_scope
+from sqlalchemy import event, func, select
+
+from inkit_project.db import engine_config, make_engine, make_engines
+from inkit_project.migrations import upgrade
+from inkit_project.models import COUNTED_COLUMNS, Address, Contact, TableVersion, normalize_email
+from inkit_project.resources import AddressCollectionResource, AddressResource, AddressStatsResource, ContactCollectionResource, ContactResource, \
+    ContactSearchResource, etag_matches, patch_validator, reader, set_next_cursor, validate_content_type, validate_json
+
+# The table_versions row each shard allocates contact ids from.
+CONTACT_IDS = 'contact_ids'
+
+
+def placement(email, count):
+    return zlib.crc32(normalize_email(email).encode('utf-8')) % count
+
+
+def allocate_ids(connection, count, step):
+    # The UPDATE takes the write lock before anything is read, so concurrent
+    # writers, even in other processes, never get the same ids.
+    versions = TableVersion.__table__
+    connection.execute(versions.update().where(versions.c.name == CONTACT_IDS).values(version=versions.c.version + count * step))
+    last = connection.execute(select([versions.c.version]).where(versions.c.name == CONTACT_IDS)).scalar()
+    return list(range(last - (count - 1) * step, last + 1, step))
+
+
+def prepare_shard(engine, index, count):
+    upgrade(engine)
+    with engine.begin() as connection:
+        last = connection.execute(select([func.max(Contact.id)])).scalar()
+        # An empty shard starts where its first id, index (or count for shard 0), is next.
+        connection.execute('INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, ?)',
+                           (CONTACT_IDS, last if last is not None else (index or count) - count))
+        last = connection.execute(select([TableVersion.version]).where(TableVersion.name == CONTACT_IDS)).scalar()
+    if last % count != index:
+        raise ValueError('{0} holds ids for another number of shards; reshard it instead'.format(engine.url))
+
+
+class Shards(object):
+    """
+    The (db_engine, read_engine) pairs of every shard, and the thread pool
+    that reads them in parallel.
+    """
+
+    def __init__(self, engines, max_workers=None):
+        self.engines = engines
+        self.count = len(engines)
+        self.executor = ThreadPoolExecutor(max_workers or self.count)
+
+    def index(self, contact_id):
+        return contact_id % self.count
+
+    def placement(self, email):
+        return placement(email, self.count)
+
+    def map(self, fn, items):
+        return list(self.executor.map(fn, items))
+
+    def all_engines(self):
+        return [engine for pair in self.engines for engine in pair if engine is not None]
+
+    def dispose(self):
+        self.executor.shutdown()
+        dispose_engines(self.engines)
+
+
+def dispose_engines(engines):
+    for db_engine, read_engine in engines:
+        # The writer closes last, so it can checkpoint and remove the WAL.
+        if read_engine is not None:
+            read_engine.dispose()
+        db_engine.dispose()
+
+
+def make_shards(environ=None, **overrides):
+    config = engine_config(environ, **overrides)
+    engines = []
+    try:
+        for index in range(config['shards']):
+            overrides['url'] = config['shard_url'].format(shard=index)
+            engines.append(make_engines(environ, **overrides))
+            prepare_shard(engines[-1][0], index, config['shards'])
+    except Exception:
+        dispose_engines(engines)
+        raise
+    # Every request thread may be waiting on a read of each shard.
+    return Shards(engines, max_workers=config['shards'] * config['pool_size'])
+
+
+class ShardContactCollectionResource(ContactCollectionResource):
+
+    def __init__(self, db_engine, shard_count, **kwargs):
+        super(ShardContactCollectionResource, self).__init__(db_engine, **kwargs)
+        self.shard_count = shard_count
+
+    def before_post(self, req, resp, db_session, resource, *args, **kwargs):
+        resource.id = allocate_ids(db_session.connection(), 1, self.shard_count)[0]
+
+        # autocrud only attaches the address after this hook. It takes its
+        # contact's id, which routes /addresses/{id} the same way.
+        @event.listens_for(db_session, 'before_flush', once=True)
+        def address_id(session, flush_context, instances):
+            if resource.address is not None:
+                resource.address.id = resource.id
+
+
+class ShardContactResource(ContactResource):
+
+    def __init__(self, db_engine, shard_index, shard_count, **kwargs):
+        super(ShardContactResource, self).__init__(db_engine, **kwargs)
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+    def check_placement(self, req):
+        # A contact can't move to another shard without changing its id.
+        doc = req.context.get('doc')
+        email = doc.get('email') if isinstance(doc, dict) else None
+        if isinstance(email, str) and placement(email, self.shard_count) != self.shard_index:
+            raise falcon.HTTPConflict('Conflict', 'The new email belongs in another shard; delete the contact and post it again instead')
+
+    def on_put(self, req, resp, *args, **kwargs):
+        self.check_placement(req)
+        super(ShardContactResource, self).on_put(req, resp, *args, **kwargs)
+
+    def on_patch(self, req, resp, *args, **kwargs):
+        self.check_placement(req)
+        super(ShardContactResource, self).on_patch(req, resp, *args, **kwargs)
+
+
+def sort_rows(rows, order):
+    # Sorting by each column from the last one makes the first the primary
+    # key, as the sort is stable. Nulls come first, as in SQLite.
+    for column, descending in reversed(order):
+        rows.sort(key=lambda row: (getattr(row, column.key) is not None, getattr(row, column.key)), reverse=descending)
+    return rows
+
+
+class ShardedCollectionResource(object):
+    """
+    A collection GET over every shard. Each one applies the same filters,
+    order and cursor and returns its first __offset + __limit + 1 rows, so
+    the merged rows hold the page of the whole collection.
+    """
+
+    def __init__(self, shards, resources):
+        self.shards = shards
+        self.resources = resources
+
+    def on_get(self, req, resp):
+        template = self.resources[0]
+        if req.get_param_as_bool('__stream'):
+            raise falcon.HTTPNotImplemented('Not implemented', 'The "__stream" parameter is not supported with sharded storage')
+
+        etags = self.shards.map(lambda resource: resource.collection_etag(req), self.resources)
+        etag = '"{0}"'.format(hashlib.sha1(''.join(etags).encode('utf-8')).hexdigest()[:32])
+        resp.set_header('ETag', etag)
+        if etag_matches(req, etag):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            return
+
+        limit = req.get_param_as_int('__limit', min=1, max=template.max_limit) or template.default_limit
+        offset = req.get_param_as_int('__offset', min=0) or 0
+        order = template.sort_order(req)
+        projection = template.projection(req)
+
+        def read_page(resource):
+            with session_scope(reader(resource, req), sessionmaker_=resource.sessionmaker, **resource.sessionmaker_kwargs) as db_session:
+                count = resource.total_count(req, db_session)
+                # The offset is of the merged rows, not of each shard's.
+                resources = resource.collection_query(db_session, req, resp, order, projection).offset(None)
+                resources = resources.limit(offset + limit + 1)
+                return count, db_session.execute(resources.statement).fetchall()
+
+        pages = self.shards.map(read_page, self.resources)
+        counts = [count for count, rows in pages]
+        if None not in counts:
+            resp.set_header('X-Total-Count', str(sum(counts)))
+
+        page = sort_rows(list(itertools.chain.from_iterable(rows for count, rows in pages)), order)[offset:]
+        if len(page) > limit:
+            page = page[:limit]
+            set_next_cursor(req, resp, [getattr(page[-1], column.key) for column, descending in order])
+
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = [projection.serialize(row) for row in page]
+
+
+class ShardedContactCollectionResource(ShardedCollectionResource):
+    """
+    GET /contacts over every shard, POST of a single contact to the shard
+    its email belongs in, and set-based PATCH and DELETE on every shard.
+    Each shard commits its part of a set-based write on its own, so one
+    that fails, e.g. on a unique email, doesn't undo the others.
+    """
+
+    def on_post(self, req, resp):
+        doc = req.context.get('doc')
+        if isinstance(doc, list) or req.get_param_as_bool('__upsert'):
+            raise falcon.HTTPNotImplemented('Not implemented', 'Bulk posts and upserts are not supported with sharded storage')
+        # Anything without an email is rejected by validation in whichever shard.
+        email = doc.get('email') if isinstance(doc, dict) else None
+        shard = self.shards.placement(email) if isinstance(email, str) else 0
+        self.resources[shard].on_post(req, resp)
+
+    @falcon.before(validate_content_type)
+    def on_patch(self, req, resp):
+        changes = req.context['doc']
+        validate_json(changes, patch_validator)
+        if 'email' in changes:
+            # It could move a contact to another shard; see ShardContactResource.
+            raise falcon.HTTPConflict('Conflict', 'Emails can only be changed one contact at a time with sharded storage')
+        updated = self.shards.map(lambda resource: resource.bulk_update(req), self.resources)
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = {'updated': sum(updated)}
+
+    def on_delete(self, req, resp):
+        deleted = self.shards.map(lambda resource: resource.bulk_delete(req), self.resources)
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = {'deleted': sum(deleted)}
+
+
+class ShardedSearchResource(object):
+    """
+    GET /contacts/search over every shard. Each shard ranks the first
+    matches up to the end of the requested page, and the best of them are
+    merged. bm25 weighs terms by each shard's own statistics, which come
+    close to the whole collection's once the shards are large.
+    """
+
+    def __init__(self, shards, resources):
+        self.shards = shards
+        self.resources = resources
+
+    def on_get(self, req, resp):
+        terms, limit, offset = self.resources[0].search_params(req)
+
+        def search(resource):
+            with session_scope(reader(resource, req), sessionmaker_=resource.sessionmaker, **resource.sessionmaker_kwargs) as db_session:
+                return resource.search(db_session, terms, offset + limit + 1, 0)
+
+        found = sorted(itertools.chain.from_iterable(self.shards.map(search, self.resources)), key=lambda hit: hit[0])
+        found = found[offset:offset + limit + 1]
+        if len(found) > limit:
+            found = found[:limit]
+            set_next_cursor(req, resp, [offset + limit])
+
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = [contact for rank, contact in found]
+
+
+class ShardedStatsResource(object):
+    """
+    GET /addresses/stats: the sum of every shard's counts.
+    """
+
+    def __init__(self, shards, resources):
+        self.shards = shards
+        self.resources = resources
+
+    def on_get(self, req, resp):
+        shard_stats = self.shards.map(lambda resource: resource.stats(req), self.resources)
+        stats = {'total': sum(shard['total'] for shard in shard_stats)}
+        for dimension in COUNTED_COLUMNS['addresses']:
+            counts = collections.Counter()
+            for shard in shard_stats:
+                counts.update(shard[dimension])
+            stats[dimension] = dict(sorted(counts.items()))
+
+        resp.status = falcon.HTTP_OK
+        req.context['result'] = stats
+
+
+class SingleDatabaseResource(object):
+    """
+    Answers the routes that need a single database: export, import and the
+    change feed, whose sequence is kept by each shard.
+    """
+
+    def fail(self, req, resp, **kwargs):
+        raise falcon.HTTPNotImplemented('Not implemented', '{0} is not supported with sharded storage'.format(req.path))
+
+    on_get = on_post = fail
+
+
+class ShardRouter(object):
+    """
+    Sends each request for /contacts/{id} to the resource of the shard that
+    id belongs to.
+    """
+
+    def __init__(self, shards, resources):
+        self.shards = shards
+        self.resources = resources
+
+    def route(self, id):
+        try:
+            return self.resources[self.shards.index(int(id))]
+        except ValueError:
+            raise falcon.HTTPNotFound()
+
+    def on_get(self, req, resp, id):
+        self.route(id).on_get(req, resp, id=id)
+
+    def on_put(self, req, resp, id):
+        self.route(id).on_put(req, resp, id=id)
+
+    def on_patch(self, req, resp, id):
+        self.route(id).on_patch(req, resp, id=id)
+
+    def on_delete(self, req, resp, id):
+        self.route(id).on_delete(req, resp, id=id)
+
+
+def add_sharded_routes(app, shards, cache=None):
+    contact_collections, contacts, searches, address_collections, addresses, stats = [], [], [], [], [], []
+    for index, (db_engine, read_engine) in enumerate(shards.engines):
+        contact_collections.append(ShardContactCollectionResource(db_engine, shards.count, cache=cache, read_engine=read_engine))
+        contacts.append(ShardContactResource(db_engine, index, shards.count, cache=cache, read_engine=read_engine))
+        searches.append(ContactSearchResource(db_engine, read_engine=read_engine))
+        address_collections.append(AddressCollectionResource(db_engine, read_engine=read_engine))
+        addresses.append(AddressResource(db_engine, cache=cache, read_engine=read_engine))
+        stats.append(AddressStatsResource(db_engine, read_engine=read_engine))
+
+    # An address has its contact's id.
+    address_router = ShardRouter(shards, addresses)
+    app.add_route('/contacts', ShardedContactCollectionResource(shards, contact_collections))
+    app.add_route('/contacts/search', ShardedSearchResource(shards, searches))
+    app.add_route('/contacts/{id}', ShardRouter(shards, contacts))
+    app.add_route('/contacts/{id}/address', address_router)
+    app.add_route('/addresses', ShardedCollectionResource(shards, address_collections))
+    app.add_route('/addresses/stats', ShardedStatsResource(shards, stats))
+    app.add_route('/addresses/{id}', address_router)
+    for path in ['/contacts/export', '/contacts/changes', '/contacts/import', '/contacts/import/{job_id}']:
+        app.add_route(path, SingleDatabaseResource())
+
+
+def reshard(sources, target_url, count, batch_size=10000, id_map=None):
+    """
+    Copies the contacts and addresses of the source databases into count new
+    shards named by formatting target_url, each contact to the shard its
+    email belongs in. A contact keeps its id if that shard's index modulo
+    count allows it, and otherwise gets a new one above every source id;
+    id_map, a text file, gets an old_id,new_id line for each of those. An
+    address takes its contact's id. The search index, row counts and change
+    sequence of each shard are rebuilt by its triggers as the rows go in.
+    Returns the number of contacts per shard and the number renumbered.
+    """
+    targets = []
+    for index in range(count):
+        target = make_engine(url=target_url.format(shard=index))
+        upgrade(target)
+        if target.execute(select([func.count()]).select_from(Contact)).scalar():
+            raise ValueError('{0} already has contacts'.format(target.url))
+        targets.append(target)
+
+    contacts, addresses = Contact.__table__, Address.__table__
+    sources = [make_engine(url=source_url) for source_url in sources]
+    last = max([source.execute(select([func.max(contacts.c.id)])).scalar() or 0 for source in sources])
+    # The first id above every source id for each shard.
+    next_ids = [last + 1 + (index - last - 1) % count for index in range(count)]
+    writer = csv.writer(id_map) if id_map is not None else None
+    copied, renumbered = [0] * count, 0
+
+    for source in sources:
+        with source.connect() as connection:
+            last_id = 0
+            while True:
+                rows = connection.execute(select([contacts]).where(contacts.c.id > last_id).order_by(contacts.c.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                related = connection.execute(select([addresses]).where(addresses.c.contact_id.between(rows[0].id, last_id)))
+                related = dict((row.contact_id, dict(row)) for row in related)
+
+                shard_contacts = [[] for index in range(count)]
+                shard_addresses = [[] for index in range(count)]
+                for row in rows:
+                    index = placement(row.email, count)
+                    contact = dict(row)
+                    if contact['id'] % count != index:
+                        contact['id'] = next_ids[index]
+                        next_ids[index] += count
+                        renumbered += 1
+                        if writer is not None:
+                            writer.writerow([row.id, contact['id']])
+                    shard_contacts[index].append(contact)
+                    if row.id in related:
+                        shard_addresses[index].append(dict(related[row.id], id=contact['id'], contact_id=contact['id']))
+
+                for index, target in enumerate(targets):
+                    if not shard_contacts[index]:
+                        continue
+                    with target.begin() as shard:
+                        shard.execute(contacts.insert(), shard_contacts[index])
+                        if shard_addresses[index]:
+                            shard.execute(addresses.insert(), shard_addresses[index])
+                    copied[index] += len(shard_contacts[index])
+        source.dispose()
+
+    for index, target in enumerate(targets):
+        prepare_shard(target, index, count)
+        target.dispose()
+    return copied, renumbered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, required=True, help='number of shards to create')
+    parser.add_argument('--source', help='database URI to split, formatted with {shard} if it is sharded already '
+                                         '(default: $CONTACTS_DB_URL or contacts.db)')
+    parser.add_argument('--from-shards', type=int, help='number of shards --source is split into')
+    parser.add_argument('--target', help='database URI of each new shard, formatted with {shard} '
+                                         '(default: $CONTACTS_SHARD_URL or contacts-{shard}.db)')
+    parser.add_argument('--id-map', default='reshard-ids.csv', help='CSV file to write the old and new id of '
+                                                                   'every renumbered contact to (default: reshard-ids.csv)')
+    options = parser.parse_args()
+
+    config = engine_config()
+    source = options.source or config['url']
+    sources = [source.format(shard=index) for index in range(options.from_shards)] if options.from_shards else [source]
+    with open(options.id_map, 'w', newline='') as id_map:
+        id_map.write('old_id,new_id\n')
+        counts, renumbered = reshard(sources, options.target or config['shard_url'], options.shards, id_map=id_map)
+    for index, copied in enumerate(counts):
+        print('shard {0}: {1} contacts'.format(index, copied))
+    print('{0} contacts got new ids, listed in {1}'.format(renumbered, options.id_map))
@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue(object):
+    """
+    Group commit for SQLite. Writes submitted by request threads run one
+    after another on a single writer thread, each in its own savepoint, and
+    are committed together once max_batch of them are queued or max_delay
+    seconds have passed since the first. A write that fails only rolls back
+    its savepoint, so each caller gets its own result or error.
+    """
+
+    def __init__(self, db_engine, max_batch=64, max_delay=0.002):
+        self.db_engine = db_engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.local = threading.local()
+        self.thread = threading.Thread(target=self.run, name='write-queue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, write):
+        """
+        Runs write(connection) in the next batch and returns its result once
+        the batch is committed, or raises what it raised.
+        """
+        if getattr(self.local, 'connection', None) is not None:
+            # Already on the writer thread, inside a batch.
+            return write(self.local.connection)
+        future = Future()
+        self.queue.put((write, future))
+        return future.result()
+
+    def sessionmaker(self, bind=None, **kwargs):
+        # Sessions opened by a queued write join its savepoint; the rest are
+        # bound as usual.
+        connection = getattr(self.local, 'connection', None)
+        return sessionmaker(bind=connection if connection is not None else bind, **kwargs)
+
+    def after_commit(self, callback, *args):
+        """
+        Defers callback until the current batch is committed. Outside one it
+        runs straight away.
+        """
+        callbacks = getattr(self.local, 'callbacks', None)
+        if callbacks is None:
+            callback(*args)
+        else:
+            callbacks.append((callback, args))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Finish this batch, then stop.
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                self.commit(batch)
+            except Exception as e:
+                # The writer must outlive any batch, and no caller may be left waiting.
+                logger.exception('Write batch failed')
+                for write, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def commit(self, batch):
+        results = []
+        self.local.callbacks = callbacks = []
+        try:
+            with self.db_engine.connect() as connection:
+                transaction = connection.begin()
+                try:
+                    # Takes the write lock up front. pysqlite would only begin
+                    # at the first INSERT, and the first savepoint would
+                    # otherwise become the transaction itself.
+                    connection.execute('BEGIN IMMEDIATE')
+                    self.local.connection = connection
+                    for write, future in batch:
+                        results.append(self.run_write(connection, write))
+                    transaction.commit()
+                except BaseException:
+                    transaction.rollback()
+                    raise
+                finally:
+                    self.local.connection = None
+        except Exception as e:
+            # Nothing was committed, so every write in the batch failed.
+            for write, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self.local.callbacks = None
+
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                # The writes are committed either way, so their callers still get their results.
+                logger.exception('after_commit callback failed')
+        for (write, future), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run_write(self, connection, write):
+        savepoint = connection.begin_nested()
+        try:
+            result = write(connection)
+        except Exception as e:
+            if savepoint.is_active:
+                savepoint.rollback()
+            return None, e
+        if savepoint.is_active:
+            savepoint.commit()
+        return result, None
@@ -1,7 +1,38 @@
 from tests.test_base import BaseTestCase
+import asyncio
+import csv
+import falcon
+import gzip
+import io
+import itertools
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from inkit_project.resources import validate_json
+from falcon_autocrud.middleware import Middleware
+from unittest import mock
+from inkit_project import resources
+from inkit_project.asgi import AsgiAdapter
+from inkit_project.cache import ResponseCache, make_cache
+from inkit_project.compression import CompressionMiddleware, accepted_encodings
+from inkit_project.db import engine_config, make_engine, make_engines
+from inkit_project.migrations import dedupe_contacts, upgrade
+from inkit_project.models import Address, Contact
+from inkit_project.resources import ContactCollectionResource, ContactExportResource, validate_json
+from inkit_project.shards import add_sharded_routes, make_shards, reshard
+from inkit_project.writes import WriteQueue
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import OperationalError
+
+
+def without_ids(document):
+    # Responses carry the server-assigned id, which post_schema.json does not allow.
+    if isinstance(document, list):
+        return [without_ids(item) for item in document]
+    return {key: value for key, value in document.items() if key != 'id'}
 
 
 class TestContactCollectionRoute(BaseTestCase):
@@ -31,7 +62,7 @@ class TestContactCollectionRoute(BaseTestCase):
         response = self.simulate_request('/contacts', method='GET', headers={'Accept': 'application/json'})
         self.assertOK(response)
         try:
-            validate_json(json.loads(response[0].decode('utf-8')))
+            validate_json(without_ids(json.loads(response[0].decode('utf-8'))))
         except AssertionError:
             self.fail()
 
@@ -70,7 +101,7 @@ class TestContactCollectionRoute(BaseTestCase):
         self.assertEqual(len(json.loads(response[0].decode('utf-8'))), 2)
 
         try:
-            validate_json(json.loads(response[0].decode('utf-8')))
+            validate_json(without_ids(json.loads(response[0].decode('utf-8'))))
         except AssertionError:
             self.fail()
 
@@ -80,7 +111,7 @@ class TestContactCollectionRoute(BaseTestCase):
 
     def test_delete(self):
         response = self.simulate_request('/contacts', method='DELETE')
-        self.assertMethodNotAllowed(response)
+        self.assertBadRequest(response, 'Invalid parameter', 'Updating or deleting every contact needs a filter, e.g. id__in=1,2,3')
 
     def test_put(self):
         response = self.simulate_request('/contacts', method='PUT')
@@ -88,13 +119,1357 @@ class TestContactCollectionRoute(BaseTestCase):
 
     def test_patch(self):
         response = self.simulate_request('/contacts', method='PATCH')
-        self.assertMethodNotAllowed(response)
+        self.assertUnsupportedMediaType(response, 'This API supports only JSON-encoded requests. Make sure the '
+                                                  'Content-Type header is set appropiately')
 
     def test_custom_method(self):
         response = self.simulate_request('/contacts', method='CUSTOM')
         self.assertBadRequest(response, 'Bad request', 'Invalid HTTP method')
 
 
+class TestContactQueryCount(BaseTestCase):
+
+    def test_collection_query_count_is_constant(self):
+        self.post_contacts(1)
+        with self.count_queries() as few:
+            response = self.simulate_request('/contacts', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual(len(json.loads(response[0].decode('utf-8'))), 1)
+
+        self.post_contacts(20, start=1)
+        with self.count_queries() as many:
+            response = self.simulate_request('/contacts', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual(len(json.loads(response[0].decode('utf-8'))), 21)
+
+        # The table versions read for the ETag, the total count, then the contacts with their addresses.
+        self.assertEqual(len(few), 3)
+        self.assertEqual(len(many), len(few))
+
+    def test_single_contact_one_query(self):
+        self.post_contacts(2)
+        with self.count_queries() as statements:
+            response = self.simulate_request('/contacts/2', method='GET', headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        self.assertEqual(json.loads(response[0].decode('utf-8'))['address']['contact_id'], 2)
+        self.assertEqual(len(statements), 1)
+
+
+class TestRowCounts(BaseTestCase):
+
+    def get(self, path, query_string=''):
+        with self.count_queries() as statements:
+            response = self.simulate_request(path, method='GET', query_string=query_string, headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        self.statements = [statement for statement, parameters in statements]
+        return json.loads(response[0].decode('utf-8')), dict(self.srmock.headers).get('x-total-count')
+
+    def post(self, count, state, country=None):
+        post = [{"first_name": "Contact", "last_name": state, "email": "{0}{1}@macalester.edu".format(state, number),
+                 "address": {"street_address": "1 Main Street", "city": "Capital", "state": state, "post_code": "00000"}}
+                for number in range(count)]
+        for contact in post:
+            if country is not None:
+                contact['address']['country'] = country
+        self.simulate_request('/contacts', method='POST', body=json.dumps(post), headers={'Content-Type': 'application/json'})
+
+    def test_total_count(self):
+        self.post(3, 'MN')
+        self.post(2, 'WI')
+        result, total = self.get('/contacts', '__limit=2')
+        self.assertEqual((len(result), total), (2, '5'))
+        self.assertFalse([statement for statement in self.statements if 'count(' in statement.lower()])
+        self.assertEqual(self.get('/addresses', 'state=WI')[1], '2')
+        self.assertEqual(self.get('/addresses', 'country=US&__limit=1')[1], '5')
+        self.assertEqual(self.get('/addresses', 'country=CO')[1], '0')
+        # Not counted, so no header rather than a scan.
+        self.assertIsNone(self.get('/contacts', 'last_name=MN')[1])
+        self.assertIsNone(self.get('/addresses', 'state=MN&country=US')[1])
+
+    def test_counts_follow_writes(self):
+        self.post(3, 'MN')
+        self.simulate_request('/contacts/1', method='DELETE')
+        self.simulate_request('/contacts', method='PATCH', query_string='id=2', body=json.dumps({'address': {'state': 'WI', 'country': 'CO'}}),
+                              headers={'Content-Type': 'application/json'})
+        self.simulate_request('/contacts', method='POST', query_string='__upsert=true', body=json.dumps(
+            {"first_name": "Contact", "last_name": "MN", "email": "MN2@macalester.edu",
+             "address": {"street_address": "1 Main Street", "city": "Capital", "state": "IA", "post_code": "00000"}}),
+            headers={'Content-Type': 'application/json'})
+        stats, _ = self.get('/addresses/stats')
+        self.assertEqual(stats, {'total': 2, 'country': {'CO': 1, 'US': 1}, 'state': {'IA': 1, 'WI': 1}})
+        self.assertEqual(self.get('/contacts')[1], '2')
+        self.simulate_request('/contacts', method='DELETE', query_string='id__in=2,3')
+        self.assertEqual(self.get('/addresses/stats')[0], {'total': 0, 'country': {}, 'state': {}})
+
+    def test_stats(self):
+        self.post(2, 'MN')
+        self.post(1, 'BOG', 'Colombia')
+        stats, _ = self.get('/addresses/stats')
+        self.assertEqual(stats, {'total': 3, 'country': {'Colombia': 1, 'US': 2}, 'state': {'BOG': 1, 'MN': 2}})
+        self.assertEqual(len(self.statements), 1)
+        self.assertIn('row_counts', self.statements[0])
+
+
+class TestIndexedFilters(BaseTestCase):
+
+    def query_plan(self, path, query_string):
+        with self.count_queries() as statements:
+            response = self.simulate_request(path, method='GET', query_string=query_string, headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        statement, parameters = statements[-1]
+        plan = self.db_engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        return json.loads(response[0].decode('utf-8')), ' '.join(row[-1] for row in plan)
+
+    def test_exact_filters_use_indexes(self):
+        self.post_contacts(5)
+        for path, query_string, index in [('/contacts', 'email=contact3@macalester.edu', 'ix_contacts_email'),
+                                          ('/contacts', 'last_name=3', 'ix_contacts_last_name'),
+                                          ('/addresses', 'post_code=55105', 'ix_addresses_post_code'),
+                                          ('/addresses', 'contact_id=3', 'ix_addresses_contact_id')]:
+            result, plan = self.query_plan(path, query_string)
+            self.assertTrue(result)
+            self.assertIn(index, plan)
+
+    def test_prefix_filter_uses_index(self):
+        self.post_contacts(12)
+        result, plan = self.query_plan('/contacts', 'email__startswith=contact1')
+        self.assertEqual([c['email'] for c in result],
+                         ['contact1@macalester.edu', 'contact10@macalester.edu', 'contact11@macalester.edu'])
+        self.assertIn('ix_contacts_email_nocase', plan)
+
+    def test_prefix_filter_is_case_insensitive(self):
+        self.post_contacts(12)
+        result, plan = self.query_plan('/contacts', 'email__startswith=CONTACT1')
+        self.assertEqual(len(result), 3)
+        result, plan = self.query_plan('/contacts', 'email__startswith=contact_0')
+        self.assertEqual([c['email'] for c in result], ['contact10@macalester.edu'])
+
+    def test_prefix_filter_last_code_point(self):
+        self.post_contacts(1)
+        for prefix in ['\U0010ffff', 'a\U0010ffff', '\ud7ff']:
+            result, plan = self.query_plan('/contacts', 'last_name__startswith=' + prefix)
+            self.assertEqual(result, [])
+
+    def test_addresses_joined_by_index(self):
+        self.post_contacts(2)
+        result, plan = self.query_plan('/contacts', '')
+        self.assertIn('ix_addresses_contact_id', plan)
+
+    def test_invalid_prefix_filter(self):
+        response = self.simulate_request('/contacts', method='GET', query_string='unknown__startswith=a', headers={'Accept': 'application/json'})
+        self.assertBadRequest(response)
+
+
+class TestCoreReadPath(BaseTestCase):
+
+    def test_output_matches_as_dict(self):
+        self.post_contacts(3)
+        self.simulate_request('/contacts', method='POST', body=json.dumps({
+            "first_name": "Juan David",
+            "last_name": "Garrido",
+            "email": "jgarrido@macalester.edu",
+            "phone_number": "7632830994",
+            "notes": "Ñandú",
+            "address": {"street_address": "1600 Grand Avenue", "unit_number": "Macalester College", "city": "St. Paul",
+                        "state": "MN", "country": "Colombia", "post_code": "55105"}
+        }), headers={'Content-Type': 'application/json'})
+
+        for path, model in [('/contacts', Contact), ('/addresses', Address)]:
+            expected = json.dumps([resource.as_dict() for resource in self.db_session.query(model).order_by(model.id)]).encode('utf-8')
+            self.assertEqual(self.simulate_request(path, method='GET', headers={'Accept': 'application/json'})[0], expected)
+            stream = self.simulate_request(path, method='GET', query_string='__stream=true', headers={'Accept': 'application/json'})
+            self.assertEqual(b''.join(stream), expected)
+
+    def test_contact_without_address(self):
+        self.post_contacts(2)
+        self.db_engine.execute('DELETE FROM addresses WHERE contact_id = 1')
+        response = self.simulate_request('/contacts', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual([c['address'] for c in json.loads(response[0].decode('utf-8'))][0], None)
+
+
+class TestContactExport(BaseTestCase):
+
+    def export(self, query_string):
+        body = b''.join(self.simulate_request('/contacts/export', method='GET', query_string=query_string))
+        self.assertEqual(self.srmock.status, falcon.HTTP_OK)
+        return dict(self.srmock.headers)['content-type'], body.decode('utf-8')
+
+    def test_ndjson(self):
+        self.post_contacts(3)
+        content_type, body = self.export('format=ndjson')
+        self.assertEqual(content_type, 'application/x-ndjson')
+        lines = body.splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [contact.as_dict() for contact in self.db_session.query(Contact).order_by(Contact.id)])
+
+    def test_csv(self):
+        self.post_contacts(2)
+        content_type, body = self.export('format=csv&fields=id,email,address.city,address.unit_number')
+        self.assertEqual(content_type, 'text/csv; charset=utf-8')
+        self.assertEqual(list(csv.reader(body.splitlines())), [
+            ['id', 'email', 'address.city', 'address.unit_number'],
+            ['1', 'contact0@macalester.edu', 'St. Paul', ''],
+            ['2', 'contact1@macalester.edu', 'St. Paul', ''],
+        ])
+
+    def test_since_and_id_range(self):
+        self.post_contacts(6)
+        _, body = self.export('fields=id&since=2')
+        self.assertEqual([json.loads(line)['id'] for line in body.splitlines()], [3, 4, 5, 6])
+        _, body = self.export('fields=id&id__gte=2&id__lte=4&last_name__startswith=3')
+        self.assertEqual([json.loads(line)['id'] for line in body.splitlines()], [4])
+
+    def test_batches(self):
+        self.post_contacts(5)
+        with mock.patch.object(ContactExportResource, 'export_batch_size', 2):
+            stream = self.simulate_request('/contacts/export', method='GET', query_string='format=csv&fields=id')
+            self.assertEqual([chunk.count(b'\n') for chunk in stream], [3, 2, 1])
+
+    def test_invalid_format(self):
+        response = self.simulate_request('/contacts/export', method='GET', query_string='format=xml')
+        self.assertBadRequest(response, 'Invalid parameter', 'The "format" parameter must be one of: csv, ndjson')
+
+
+class TestContactChanges(BaseTestCase):
+
+    def changes(self, since=None, limit=None):
+        query_string = '&'.join(name + '=' + str(value) for name, value in [('since', since), ('__limit', limit)] if value is not None)
+        response = self.simulate_request('/contacts/changes', method='GET', query_string=query_string, headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        return json.loads(response[0].decode('utf-8'))
+
+    def summary(self, feed):
+        return [(change['id'], change['deleted']) for change in feed['changes']]
+
+    def test_inserts(self):
+        self.post_contacts(3)
+        feed = self.changes()
+        self.assertEqual(self.summary(feed), [(1, False), (2, False), (3, False)])
+        self.assertEqual([change['contact'] for change in feed['changes']],
+                         [contact.as_dict() for contact in self.db_session.query(Contact).order_by(Contact.id)])
+        self.assertFalse(feed['more'])
+        self.assertEqual(feed['since'], feed['changes'][-1]['change_seq'])
+        self.assertEqual(self.changes(feed['since'])['changes'], [])
+
+    def test_updates_and_deletes(self):
+        self.post_contacts(4)
+        since = self.changes()['since']
+        self.simulate_request('/contacts/2', method='PATCH', body=json.dumps({'notes': 'Changed'}), headers={'Content-Type': 'application/json'})
+        self.simulate_request('/contacts/1', method='DELETE')
+        self.simulate_request('/contacts', method='PATCH', query_string='id=4', body=json.dumps({'address': {'city': 'Duluth'}}),
+                              headers={'Content-Type': 'application/json'})
+        self.simulate_request('/contacts', method='DELETE', query_string='id=2')
+
+        feed = self.changes(since)
+        self.assertEqual(self.summary(feed), [(1, True), (4, False), (2, True)])
+        self.assertEqual(feed['changes'][1]['contact']['address']['city'], 'Duluth')
+        self.assertEqual(self.changes(feed['since'])['changes'], [])
+
+    def test_reused_id(self):
+        self.post_contacts(2)
+        self.simulate_request('/contacts/2', method='DELETE')
+        self.assertEqual(self.summary(self.changes()), [(1, False), (2, True)])
+        self.post_contacts(1, start=5)
+        self.assertEqual(self.summary(self.changes()), [(1, False), (2, False)])
+
+    def test_pages(self):
+        self.post_contacts(5)
+        self.simulate_request('/contacts/1', method='DELETE')
+        pages, since = [], 0
+        while True:
+            feed = self.changes(since, limit=2)
+            pages.append(self.summary(feed))
+            since = feed['since']
+            if not feed['more']:
+                break
+        self.assertEqual(pages, [[(2, False), (3, False)], [(4, False), (5, False)], [(1, True)]])
+
+    def test_uses_indexes(self):
+        self.post_contacts(3)
+        self.simulate_request('/contacts/3', method='DELETE')
+        with self.count_queries() as statements:
+            self.changes(1)
+        plans = []
+        for statement, parameters in statements[-2:]:
+            plan = self.db_engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            plans.append(' '.join(row[-1] for row in plan))
+        self.assertIn('ix_contacts_change_seq (change_seq>? AND change_seq<?)', plans[0])
+        self.assertIn('ix_contact_tombstones_change_seq (change_seq>? AND change_seq<?)', plans[1])
+        self.assertNotIn('TEMP B-TREE', ' '.join(plans))
+
+
+class TestContactImport(BaseTestCase):
+
+    def start(self, body, content_type, query_string=''):
+        response = self.simulate_request('/contacts/import', method='POST', body=body, query_string=query_string,
+                                         headers={'Content-Type': content_type, 'Accept': 'application/json'})
+        self.assertEqual(self.srmock.status, falcon.HTTP_ACCEPTED)
+        job = json.loads(response[0].decode('utf-8'))
+        self.assertEqual(dict(self.srmock.headers)['location'], '/contacts/import/' + job['id'])
+        return job
+
+    def finish(self, job):
+        for attempt in range(100):
+            response = self.simulate_request('/contacts/import/' + job['id'], method='GET', headers={'Accept': 'application/json'})
+            self.assertOK(response)
+            job = json.loads(response[0].decode('utf-8'))
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.05)
+        self.fail('The import did not finish')
+
+    def test_ndjson(self):
+        lines = [
+            json.dumps({'first_name': 'Ada', 'last_name': 'Lovelace', 'email': 'ada@example.com',
+                        'address': {'street_address': '12 St James Square', 'city': 'London', 'state': 'LDN', 'post_code': 'SW1Y'}}),
+            '{"first_name": ',
+            '',
+            json.dumps({'first_name': 'Alan', 'email': 'alan@example.com'}),
+            json.dumps({'first_name': 'Grace', 'last_name': 'Hopper', 'email': 'grace@example.com',
+                        'address': {'street_address': '1 Navy Way', 'city': 'Arlington', 'state': 'VA', 'post_code': '22202'}}),
+        ]
+        job = self.finish(self.start('\n'.join(lines), 'application/x-ndjson', '__chunk_size=2'))
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual((job['records'], job['imported'], job['failed']), (4, 2, 2))
+        self.assertEqual([error['line'] for error in job['errors']], [2, 4])
+        self.assertEqual(job['errors'][0]['description'], 'Malformed JSON')
+        self.assertEqual([contact.email for contact in self.db_session.query(Contact).order_by(Contact.id)],
+                         ['ada@example.com', 'grace@example.com'])
+        self.assertEqual(job['errors'][1]['description'], "'last_name' is a required property")
+        self.assertEqual([address.city for address in self.db_session.query(Address).order_by(Address.id)], ['London', 'Arlington'])
+
+    def test_duplicates(self):
+        self.post_contacts(1)
+        rows = ['first_name,last_name,email,address.street_address,address.city,address.state,address.post_code',
+                'Contact,0,contact0@macalester.edu,1600 Grand Avenue,Duluth,MN,55802',
+                'Contact,1,contact1@macalester.edu,1600 Grand Avenue,St. Paul,MN,55105']
+        job = self.finish(self.start('\n'.join(rows), 'text/csv'))
+        self.assertEqual((job['imported'], job['failed']), (1, 1))
+        self.assertEqual(job['errors'], [{'line': 2, 'description': 'Unique constraint violated'}])
+
+        job = self.finish(self.start('\n'.join(rows), 'text/csv', '__upsert=true'))
+        self.assertEqual((job['upsert'], job['imported'], job['failed']), (True, 2, 0))
+        self.assertEqual([address.city for address in self.db_session.query(Address).order_by(Address.id)], ['Duluth', 'St. Paul'])
+
+    def test_export_round_trip(self):
+        self.post_contacts(3)
+        exported = b''.join(self.simulate_request('/contacts/export', method='GET', query_string='format=csv'))
+        expected = [contact.as_dict() for contact in self.db_session.query(Contact).order_by(Contact.id)]
+        self.db_session.query(Contact).delete()
+        self.db_session.commit()
+
+        job = self.finish(self.start(exported, 'text/csv; charset=utf-8'))
+        self.assertEqual((job['records'], job['imported'], job['errors']), (3, 3, []))
+        imported = [contact.as_dict() for contact in self.db_session.query(Contact).order_by(Contact.id)]
+        for contact in expected + imported:
+            del contact['id'], contact['address']['id'], contact['address']['contact_id']
+        self.assertEqual(imported, expected)
+
+    def test_csv_rows(self):
+        rows = ['first_name,last_name,email', 'Ada,Lovelace,ada@example.com,extra', 'Alan,Turing']
+        job = self.finish(self.start('\n'.join(rows), 'text/plain', 'format=csv'))
+        self.assertEqual(job['imported'], 0)
+        self.assertEqual(job['errors'][0], {'line': 2, 'description': 'The row has more fields than the header'})
+        self.assertEqual(job['errors'][1]['line'], 3)
+
+    def test_unsupported(self):
+        response = self.simulate_request('/contacts/import', method='POST', body='[]', headers={'Content-Type': 'application/json'})
+        self.assertUnsupportedMediaType(response, 'Imports must be sent as application/x-ndjson or text/csv')
+        response = self.simulate_request('/contacts/import', method='POST', body='', query_string='format=xml',
+                                         headers={'Content-Type': 'text/csv'})
+        self.assertBadRequest(response, 'Invalid parameter', 'The "format" parameter must be one of: csv, ndjson')
+
+    def test_unknown_job(self):
+        response = self.simulate_request('/contacts/import/nope', method='GET', headers={'Accept': 'application/json'})
+        self.assertNotFound(response)
+
+
+class TestSparseFieldsets(BaseTestCase):
+
+    def get(self, path, query_string):
+        with self.count_queries() as statements:
+            response = self.simulate_request(path, method='GET', query_string=query_string, headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        return json.loads(response[0].decode('utf-8')), statements[-1][0]
+
+    def test_contact_fields(self):
+        self.post_contacts(3)
+        result, statement = self.get('/contacts', 'fields=id,email&last_name=1')
+        self.assertEqual(result, [{'id': 2, 'email': 'contact1@macalester.edu'}])
+        self.assertNotIn('notes', statement)
+        self.assertNotIn('addresses', statement)
+
+    def test_nested_fields(self):
+        self.post_contacts(2)
+        result, statement = self.get('/contacts', 'fields=first_name,address.city,address.post_code')
+        self.assertEqual(result, [{'first_name': 'Contact', 'address': {'city': 'St. Paul', 'post_code': '55105'}}] * 2)
+        self.assertIn('LEFT OUTER JOIN addresses', statement)
+        self.assertNotIn('street_address', statement)
+
+        result, _ = self.get('/contacts', 'fields=address&__limit=1')
+        self.assertEqual(sorted(result[0]['address']), sorted(['id', 'street_address', 'unit_number', 'city', 'state',
+                                                               'post_code', 'country', 'contact_id']))
+
+    def test_pages_and_streams(self):
+        self.post_contacts(3)
+        result, _ = self.get('/contacts', 'fields=email&__limit=2&__sort=-email')
+        self.assertEqual(result, [{'email': 'contact2@macalester.edu'}, {'email': 'contact1@macalester.edu'}])
+        cursor = dict(self.srmock.headers)['x-next-cursor']
+        result, _ = self.get('/contacts', 'fields=email&__limit=2&__sort=-email&__cursor=' + cursor)
+        self.assertEqual(result, [{'email': 'contact0@macalester.edu'}])
+
+        stream = self.simulate_request('/contacts', method='GET', query_string='fields=id&__stream=true', headers={'Accept': 'application/json'})
+        self.assertEqual(json.loads(b''.join(stream).decode('utf-8')), [{'id': 1}, {'id': 2}, {'id': 3}])
+
+    def test_address_fields(self):
+        self.post_contacts(2)
+        result, _ = self.get('/addresses', 'fields=contact_id,city&contact_id=2')
+        self.assertEqual(result, [{'contact_id': 2, 'city': 'St. Paul'}])
+
+    def test_unknown_fields(self):
+        for path, field in [('/contacts', 'version'), ('/contacts', 'address.unknown'),
+                            ('/contacts', 'email.city'), ('/addresses', 'address.city')]:
+            response = self.simulate_request(path, method='GET', query_string='fields=id,' + field, headers={'Accept': 'application/json'})
+            self.assertBadRequest(response, 'Invalid parameter', 'The "fields" parameter has an unknown field: ' + field)
+
+
+class TestContactSearch(BaseTestCase):
+
+    def search(self, query_string):
+        response = self.simulate_request('/contacts/search', method='GET', query_string=query_string, headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        return json.loads(response[0].decode('utf-8'))
+
+    def setUp(self):
+        super(TestContactSearch, self).setUp()
+        post = [
+            {
+                "first_name": "Juan David",
+                "last_name": "Garrido",
+                "email": "jgarrido@macalester.edu",
+                "company": "Inkit",
+                "notes": "Wrote the contacts API",
+                "address": {"street_address": "1600 Grand Avenue", "city": "St. Paul", "state": "MN", "post_code": "55105"}
+            },
+            {
+                "first_name": "John",
+                "last_name": "Doe",
+                "email": "johndoe@example.com",
+                "notes": "Met Garrido at Inkit",
+                "address": {"street_address": "1 Main Street", "city": "Washington", "state": "MD", "post_code": "11111"}
+            }]
+        self.simulate_request('/contacts', method='POST', body=json.dumps(post), headers={'Content-Type': 'application/json'})
+
+    def test_ranked_results(self):
+        self.assertEqual([c['id'] for c in self.search('q=garrido inkit')], [1, 2])
+        self.assertEqual(self.search('q=garrido inkit')[0]['address']['city'], 'St. Paul')
+        self.assertEqual([c['id'] for c in self.search('q=macalester')], [1])
+
+    def test_prefix_match(self):
+        self.assertEqual([c['id'] for c in self.search('q=Gar')], [1, 2])
+        self.assertEqual(self.search('q=nobody'), [])
+
+    def test_index_follows_writes(self):
+        self.simulate_request('/contacts/2', method='PATCH', body=json.dumps({"last_name": "Smith"}), headers={'Content-Type': 'application/json'})
+        self.assertEqual([c['id'] for c in self.search('q=smith')], [2])
+
+        self.simulate_request('/contacts/1', method='DELETE')
+        self.assertEqual([c['id'] for c in self.search('q=garrido')], [2])
+
+    def test_pages(self):
+        self.assertEqual(len(self.search('q=garrido&__limit=1')), 1)
+        cursor = dict(self.srmock.headers)['x-next-cursor']
+        self.assertEqual([c['id'] for c in self.search('q=garrido&__limit=1&__cursor=' + cursor)], [2])
+        self.assertNotIn('x-next-cursor', dict(self.srmock.headers))
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self.search('q=%22 AND OR NEAR('), [])
+
+    def test_missing_query(self):
+        response = self.simulate_request('/contacts/search', method='GET', headers={'Accept': 'application/json'})
+        self.assertBadRequest(response, 'Invalid parameter', 'The "q" parameter is required')
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = ResponseCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('a', 'A', self.cache.token())
+        self.cache.set('b', 'B', self.cache.token())
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.cache.set('c', 'C', self.cache.token())
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        self.cache.set('a', 'A', self.cache.token())
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_invalidate_group(self):
+        self.cache.set('contact', 'C', self.cache.token(), group=1)
+        self.cache.set('address', 'A', self.cache.token(), group=1)
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get('contact'))
+        self.assertIsNone(self.cache.get('address'))
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+    def test_fill_racing_a_write_is_dropped(self):
+        token = self.cache.token()
+        self.cache.invalidate(1)
+        self.cache.set('contact', 'stale', token, group=1)
+        self.assertIsNone(self.cache.get('contact'))
+
+    def test_config_from_environment(self):
+        cache = make_cache({'CONTACTS_CACHE_SIZE': '50', 'CONTACTS_CACHE_TTL': '5'})
+        self.assertEqual((cache.max_size, cache.ttl), (50, 5))
+        self.assertEqual(make_cache({}).max_size, 10000)
+        self.assertIsNone(make_cache({'CONTACTS_CACHE_SIZE': '0'}))
+
+
+class TestCachedRoutes(BaseTestCase):
+
+    def get(self, path):
+        response = self.simulate_request(path, method='GET', headers={'Accept': 'application/json'})
+        self.assertOK(response)
+        return json.loads(response[0].decode('utf-8'))
+
+    def test_repeated_get_skips_database(self):
+        self.post_contacts(2)
+        first = self.get('/contacts/1')
+        with self.count_queries() as statements:
+            self.assertEqual(self.get('/contacts/1'), first)
+        self.assertEqual(statements, [])
+        self.assertEqual(self.get('/cache/stats')['hits'], 1)
+
+    def test_patch_invalidates_contact(self):
+        self.post_contacts(2)
+        self.get('/contacts/1')
+        self.simulate_request('/contacts/1', method='PATCH', body=json.dumps({"first_name": "Changed"}), headers={'Content-Type': 'application/json'})
+        self.assertEqual(self.get('/contacts/1')['first_name'], 'Changed')
+
+    def test_delete_invalidates_address(self):
+        self.post_contacts(2)
+        self.get('/contacts/1')
+        self.get('/addresses/1')
+        self.get('/addresses/2')
+        self.simulate_request('/contacts/1', method='DELETE')
+
+        self.assertEqual(self.cache.stats()['size'], 1)
+        self.assertNotFound(self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'}))
+
+    def test_not_found_is_not_cached(self):
+        self.assertNotFound(self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'}))
+        self.post_contacts(1)
+        self.assertEqual(self.get('/contacts/1')['id'], 1)
+
+
+class TestReadWriteSplit(BaseTestCase):
+
+    def setUp(self):
+        super(TestReadWriteSplit, self).setUp()
+        self.statements = {'write': [], 'read': []}
+        for name, db_engine in [('write', self.db_engine), ('read', self.read_engine)]:
+            event.listen(db_engine, 'before_cursor_execute',
+                         lambda conn, cursor, statement, *args, name=name: self.statements[name].append(statement))
+
+    def engines_used(self, path, method='GET', **kwargs):
+        for statements in self.statements.values():
+            del statements[:]
+        b''.join(self.simulate_request(path, method=method, **kwargs))
+        return sorted(name for name, statements in self.statements.items() if statements)
+
+    def test_gets_use_read_engine(self):
+        self.post_contacts(2)
+        for path in ['/contacts', '/contacts/1', '/contacts/1/address', '/addresses', '/addresses/2',
+                     '/addresses/stats', '/contacts/changes', '/contacts/export']:
+            self.assertEqual(self.engines_used(path, headers={'Accept': 'application/json'}), ['read'], path)
+        self.assertEqual(self.engines_used('/contacts', query_string='__stream=true'), ['read'])
+
+    def test_writes_use_writer(self):
+        self.post_contacts(2)
+        body = json.dumps({"first_name": "Changed"})
+        headers = {'Content-Type': 'application/json'}
+        self.assertEqual(self.engines_used('/contacts/1', method='PATCH', body=body, headers=headers), ['write'])
+        self.assertEqual(self.engines_used('/contacts', method='PATCH', query_string='id__in=1,2', body=body, headers=headers), ['write'])
+        self.assertEqual(self.engines_used('/contacts/2', method='DELETE'), ['write'])
+
+    def test_read_your_writes(self):
+        self.post_contacts(2)
+        self.assertEqual(self.engines_used('/contacts', query_string='__read_your_writes=true'), ['write'])
+        self.assertEqual(self.engines_used('/contacts/1'), ['read'])
+        # The cached body could have come from a replica, so it's bypassed.
+        self.assertEqual(self.engines_used('/contacts/1', query_string='__read_your_writes=true'), ['write'])
+        self.assertEqual(self.engines_used('/contacts/1'), [])
+
+
+class TestWriteQueue(BaseTestCase):
+
+    def make_write_queue(self):
+        # A long window, so requests started together land in one batch.
+        return WriteQueue(self.db_engine, max_batch=8, max_delay=0.2)
+
+    def concurrently(self, requests):
+        barrier = threading.Barrier(len(requests))
+        results = [None] * len(requests)
+
+        def send(index, path, method, body):
+            env = falcon.testing.create_environ(path=path, method=method, body=json.dumps(body),
+                                                headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+            srmock = falcon.testing.StartResponseMock()
+            barrier.wait()
+            response = b''.join(self.app(env, srmock))
+            results[index] = (srmock.status, json.loads(response.decode('utf-8')) if response else None)
+
+        threads = [threading.Thread(target=send, args=(index,) + request) for index, request in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def contact(self, number):
+        return {
+            "first_name": "Contact",
+            "last_name": str(number),
+            "email": "contact{0}@macalester.edu".format(number),
+            "address": {"street_address": "1600 Grand Avenue", "city": "St. Paul", "state": "MN", "post_code": "55105"},
+        }
+
+    def test_posts_share_commits(self):
+        with self.count_queries() as statements:
+            results = self.concurrently([('/contacts', 'POST', self.contact(number)) for number in range(8)])
+        self.assertEqual([status for status, body in results], ['201 Created'] * 8)
+        self.assertEqual(sorted(body['data']['id'] for status, body in results), list(range(1, 9)))
+        transactions = [statement for statement, parameters in statements if statement == 'BEGIN IMMEDIATE']
+        self.assertLess(len(transactions), 8)
+        self.assertEqual(self.db_session.query(Contact).count(), 8)
+
+    def test_conflict_only_fails_its_request(self):
+        self.post_contacts(1)
+        results = self.concurrently([('/contacts', 'POST', self.contact(number)) for number in range(4)])
+        self.assertEqual(sorted(status for status, body in results), ['201 Created'] * 3 + ['409 Conflict'])
+        self.assertEqual(results[0], ('409 Conflict', {'title': 'Conflict', 'description': 'Unique constraint violated'}))
+        self.assertEqual(self.db_session.query(Contact).count(), 4)
+
+    def test_put_patch_delete(self):
+        self.post_contacts(3)
+        self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'})
+        put = dict(self.contact(9), first_name='Put')
+        results = self.concurrently([
+            ('/contacts/1', 'PATCH', {'first_name': 'Patched'}),
+            ('/contacts/2', 'PUT', put),
+            ('/contacts/3', 'DELETE', None),
+            ('/contacts/4', 'PATCH', {'first_name': 'Missing'}),
+        ])
+        self.assertEqual([status for status, body in results], ['200 OK', '200 OK', '200 OK', '404 Not Found'])
+        self.assertEqual(results[0][1]['data']['first_name'], 'Patched')
+        self.assertEqual(results[1][1]['data']['first_name'], 'Put')
+
+        # The cached contact was invalidated once the batch committed.
+        response = self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual(json.loads(response[0].decode('utf-8'))['first_name'], 'Patched')
+        self.assertEqual([contact.id for contact in self.db_session.query(Contact).order_by(Contact.id)], [1, 2])
+
+    def test_failed_commit_fails_every_write(self):
+        error = OperationalError('COMMIT', (), Exception('disk I/O error'))
+        with mock.patch('sqlalchemy.engine.base.RootTransaction._do_commit', side_effect=error):
+            with self.assertRaises(OperationalError):
+                self.write_queue.submit(lambda connection: 1)
+        # The writer carries on with the next batch.
+        self.assertEqual(self.write_queue.submit(lambda connection: connection.execute('SELECT 2').scalar()), 2)
+
+    def test_failed_callback_keeps_writer(self):
+        def write(connection):
+            self.write_queue.after_commit(mock.Mock(side_effect=RuntimeError('callback')))
+            return 1
+
+        with self.assertLogs('inkit_project.writes', 'ERROR'):
+            self.assertEqual(self.write_queue.submit(write), 1)
+            with mock.patch.object(self.write_queue, 'commit', side_effect=RuntimeError('batch')):
+                with self.assertRaisesRegex(RuntimeError, 'batch'):
+                    self.write_queue.submit(lambda connection: 1)
+        self.assertEqual(self.write_queue.submit(lambda connection: connection.execute('SELECT 2').scalar()), 2)
+
+    def test_post_invalidates_after_commit(self):
+        in_batch = []
+        with mock.patch.object(self.cache, 'invalidate', side_effect=lambda *groups: in_batch.append(self.write_queue.local.connection is not None)):
+            self.concurrently([('/contacts', 'POST', self.contact(0))])
+        self.assertEqual(in_batch, [False])
+
+
+class TestConditionalRequests(BaseTestCase):
+
+    def get(self, path, etag=None):
+        headers = {'Accept': 'application/json'}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        response = self.simulate_request(path, method='GET', headers=headers)
+        return self.srmock.status, dict(self.srmock.headers).get('etag'), response
+
+    def test_single_not_modified(self):
+        self.post_contacts(2)
+        status, etag, response = self.get('/contacts/1')
+        self.assertEqual(status, falcon.HTTP_OK)
+        self.assertNotIn('version', json.loads(response[0].decode('utf-8')))
+
+        with self.count_queries() as statements:
+            status, _, response = self.get('/contacts/1', etag)
+        self.assertEqual(status, falcon.HTTP_NOT_MODIFIED)
+        self.assertEqual(response, [])
+        self.assertEqual(statements, [])
+
+        status, _, _ = self.get('/contacts/1', 'W/"other", ' + etag)
+        self.assertEqual(status, falcon.HTTP_NOT_MODIFIED)
+
+    def test_single_not_modified_without_cache(self):
+        self.post_contacts(2)
+        _, etag, _ = self.get('/addresses/2')
+        self.cache.clear()
+        status, same, _ = self.get('/addresses/2', etag)
+        self.assertEqual(status, falcon.HTTP_NOT_MODIFIED)
+        self.assertEqual(same, etag)
+
+    def test_write_changes_etag(self):
+        self.post_contacts(2)
+        _, etag, _ = self.get('/contacts/1')
+        response = self.simulate_request('/contacts/1', method='PATCH', body=json.dumps({"first_name": "Changed"}), headers={'Content-Type': 'application/json'})
+        self.assertNotIn('version', json.loads(response[0].decode('utf-8')))
+
+        status, changed, response = self.get('/contacts/1', etag)
+        self.assertEqual(status, falcon.HTTP_OK)
+        self.assertNotEqual(changed, etag)
+        self.assertEqual(json.loads(response[0].decode('utf-8'))['first_name'], 'Changed')
+
+    def test_write_after_concurrent_write(self):
+        self.post_contacts(2)
+        doc = {"first_name": "Changed", "last_name": "0", "email": "contact0@macalester.edu",
+               "address": {"street_address": "1600 Grand Avenue", "city": "St. Paul", "state": "MN", "post_code": "55105"}}
+        # As a bulk PATCH or an upsert would, between the contact's load and its flush.
+        bump = lambda *args: self.db_engine.execute('UPDATE contacts SET version = version + 1 WHERE id = 1')
+        for method in ['PUT', 'PATCH']:
+            with mock.patch.object(resources.ContactResource, 'apply_default_attributes', side_effect=bump):
+                self.simulate_request('/contacts/1', method=method, body=json.dumps(doc), headers={'Content-Type': 'application/json'})
+            self.assertEqual(self.srmock.status, falcon.HTTP_OK)
+
+    def test_collection_not_modified(self):
+        self.post_contacts(2)
+        _, etag, _ = self.get('/contacts')
+        status, _, response = self.get('/contacts', etag)
+        self.assertEqual(status, falcon.HTTP_NOT_MODIFIED)
+        self.assertEqual(response, [])
+
+        self.post_contacts(1, start=2)
+        status, changed, _ = self.get('/addresses', etag)
+        self.assertEqual(status, falcon.HTTP_OK)
+        status, changed, _ = self.get('/contacts', etag)
+        self.assertEqual(status, falcon.HTTP_OK)
+        self.assertNotEqual(changed, etag)
+
+
+class TestMetrics(BaseTestCase):
+
+    def get_metrics(self):
+        response = self.simulate_request('/metrics', method='GET')
+        self.assertOK(response)
+        self.assertTrue(dict(self.srmock.headers)['content-type'].startswith('text/plain'))
+        return response[0].decode('utf-8').splitlines()
+
+    def sample(self, lines, name):
+        return [float(line.rsplit(' ', 1)[1]) for line in lines if line.startswith(name + ' ')][0]
+
+    def test_request_metrics(self):
+        self.post_contacts(3)
+        response = self.simulate_request('/contacts', method='GET', headers={'Accept': 'application/json'})
+        self.simulate_request('/contacts/9', method='GET', headers={'Accept': 'application/json'})
+        lines = self.get_metrics()
+
+        self.assertEqual(self.sample(lines, 'http_requests_total{route="/contacts",method="POST",status="201"}'), 1)
+        self.assertEqual(self.sample(lines, 'http_requests_total{route="/contacts/{id}",method="GET",status="404"}'), 1)
+        self.assertEqual(self.sample(lines, 'http_request_duration_seconds_count{route="/contacts",method="GET"}'), 1)
+        self.assertEqual(self.sample(lines, 'http_request_duration_seconds_bucket{route="/contacts",method="GET",le="+Inf"}'), 1)
+        self.assertEqual(self.sample(lines, 'http_response_size_bytes_sum{route="/contacts",method="GET"}'), len(response[0]))
+        # The /metrics request itself is still in flight.
+        self.assertEqual(self.sample(lines, 'http_requests_in_flight'), 1)
+
+    def test_statement_counts(self):
+        self.post_contacts(3)
+        stream = self.simulate_request('/contacts', method='GET', query_string='__stream=true', headers={'Accept': 'application/json'})
+        self.assertEqual(len(json.loads(b''.join(stream).decode('utf-8'))), 3)
+        self.simulate_request('/addresses/1', method='GET', headers={'Accept': 'application/json'})
+        lines = self.get_metrics()
+
+        self.assertEqual(self.sample(lines, 'db_statements_per_request_sum{route="/addresses/{id}",method="GET"}'), 1)
+        # The table versions for the ETag, the total count, then the streamed query.
+        self.assertEqual(self.sample(lines, 'db_statements_per_request_sum{route="/contacts",method="GET"}'), 3)
+        self.assertGreater(self.sample(lines, 'db_statements_total'), 3)
+
+    def test_unmatched_route(self):
+        self.simulate_request('/unknown', method='GET')
+        self.assertEqual(self.sample(self.get_metrics(), 'http_requests_total{route="unmatched",method="GET",status="404"}'), 1)
+
+
+class TestCompression(BaseTestCase):
+
+    def get(self, path, query_string='', encoding='gzip', **headers):
+        headers.update({'Accept': 'application/json', 'Accept-Encoding': encoding})
+        body = b''.join(self.simulate_request(path, method='GET', query_string=query_string, headers=headers))
+        return dict(self.srmock.headers), body
+
+    def test_large_body_compressed(self):
+        self.post_contacts(20)
+        headers, body = self.get('/contacts')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+        self.assertTrue(headers['etag'].startswith('W/"'))
+        self.assertEqual(len(json.loads(gzip.decompress(body).decode('utf-8'))), 20)
+
+        self.get('/contacts', **{'If-None-Match': headers['etag']})
+        self.assertEqual(self.srmock.status, falcon.HTTP_NOT_MODIFIED)
+
+    def test_streamed_body_compressed(self):
+        self.post_contacts(20)
+        headers, body = self.get('/contacts', '__stream=true')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(body).decode('utf-8'))), 20)
+
+        headers, body = self.get('/contacts', '__stream=true&__limit=1')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(len(json.loads(body.decode('utf-8'))), 1)
+
+    def test_small_body_not_compressed(self):
+        self.post_contacts(1)
+        headers, body = self.get('/contacts/1')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(json.loads(body.decode('utf-8'))['id'], 1)
+
+    def test_not_accepted(self):
+        self.post_contacts(20)
+        for encoding in ['', 'identity', 'gzip;q=0', 'compress, deflate']:
+            headers, body = self.get('/contacts', encoding=encoding)
+            self.assertNotIn('content-encoding', headers)
+            self.assertEqual(len(json.loads(body.decode('utf-8'))), 20)
+
+    def test_negotiation(self):
+        self.assertEqual(accepted_encodings('gzip;q=0.5, br, *;q=0'), {'gzip': 0.5, 'br': 1.0, '*': 0.0})
+        with mock.patch.dict('inkit_project.compression.AVAILABLE', {'br': False, 'zstd': False}):
+            middleware = CompressionMiddleware(levels={'gzip': 9})
+        req = falcon.Request(falcon.testing.create_environ(headers={'Accept-Encoding': 'br, *;q=0.1'}))
+        self.assertEqual(middleware.choose(req, None)[0::2], ('gzip', 9))
+
+        resource = mock.Mock(compression_levels={'gzip': 2})
+        self.assertEqual(middleware.choose(req, resource)[0::2], ('gzip', 2))
+
+
+class TestAsgiAdapter(BaseTestCase):
+
+    def asgi_request(self, path, method='GET', query_string='', body=b'', headers=()):
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode('latin-1'),
+            'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        }
+        # Split the body to check that it's reassembled.
+        messages = [{'type': 'http.request', 'body': body[:10], 'more_body': True},
+                    {'type': 'http.request', 'body': body[10:]}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        adapter = AsgiAdapter(self.app, max_workers=2)
+        asyncio.get_event_loop().run_until_complete(adapter(scope, receive, send))
+        adapter.executor.shutdown()
+        return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_post_and_get(self):
+        post = {
+            "first_name": "Adam",
+            "last_name": "Smith",
+            "email": "asmith@macalester.edu",
+            "address": {"street_address": "1600 Grand Avenue", "city": "St. Paul", "state": "MN", "post_code": "55105", "country": "US"}
+        }
+        status, _, body = self.asgi_request('/contacts', method='POST', body=json.dumps(post).encode('utf-8'),
+                                            headers=[('Content-Type', 'application/json')])
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body.decode('utf-8'))['data']['email'], 'asmith@macalester.edu')
+
+        status, headers, body = self.asgi_request('/contacts/1/address', headers=[('Accept', 'application/json')])
+        self.assertEqual(status, 200)
+        self.assertTrue(headers[b'content-type'].startswith(b'application/json'))
+        self.assertEqual(json.loads(body.decode('utf-8'))['city'], 'St. Paul')
+
+    def test_streamed_collection(self):
+        self.post_contacts(5)
+        status, _, body = self.asgi_request('/contacts', query_string='__stream=true&last_name=3', headers=[('Accept', 'application/json')])
+        self.assertEqual(status, 200)
+        self.assertEqual([c['id'] for c in json.loads(body.decode('utf-8'))], [4])
+
+    def test_not_found(self):
+        status, _, _ = self.asgi_request('/contacts/1', headers=[('Accept', 'application/json')])
+        self.assertEqual(status, 404)
+
+
+class TestEngineFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'contacts.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pragma(self, connection, name):
+        return connection.execute('PRAGMA ' + name).scalar()
+
+    def test_pragmas(self):
+        db_engine = make_engine(url=self.url, busy_timeout=1234)
+        with db_engine.connect() as connection:
+            self.assertEqual(self.pragma(connection, 'journal_mode'), 'wal')
+            self.assertEqual(self.pragma(connection, 'synchronous'), 1)
+            self.assertEqual(self.pragma(connection, 'foreign_keys'), 1)
+            self.assertEqual(self.pragma(connection, 'busy_timeout'), 1234)
+            self.assertEqual(self.pragma(connection, 'cache_size'), -64000)
+        db_engine.dispose()
+
+    def test_pool_sized_from_threads(self):
+        db_engine = make_engine(environ={'CONTACTS_DB_URL': self.url, 'CONTACTS_THREADS': '8'})
+        self.assertEqual(db_engine.pool.size(), 8)
+        self.assertEqual(str(db_engine.url), self.url)
+        db_engine.dispose()
+
+    def test_config_from_environment(self):
+        config = engine_config({'CONTACTS_DB_SYNCHRONOUS': 'full', 'CONTACTS_DB_MMAP_SIZE': '0'}, pool_size=2)
+        self.assertEqual(config['synchronous'], 'full')
+        self.assertEqual(config['mmap_size'], 0)
+        self.assertEqual(config['pool_size'], 2)
+        self.assertEqual(config['journal_mode'], 'wal')
+
+    def test_memory_database(self):
+        db_engine = make_engine(url='sqlite://')
+        with db_engine.connect() as connection:
+            self.assertEqual(self.pragma(connection, 'journal_mode'), 'memory')
+            self.assertEqual(self.pragma(connection, 'foreign_keys'), 1)
+
+    def test_read_engine_is_read_only(self):
+        db_engine, read_engine = make_engines(url=self.url, pool_size=8, write_pool_size=1)
+        self.assertEqual(db_engine.pool.size(), 1)
+        self.assertEqual(read_engine.pool.size(), 8)
+        db_engine.execute('CREATE TABLE things (id INTEGER PRIMARY KEY)')
+        db_engine.execute('INSERT INTO things VALUES (1)')
+        with read_engine.connect() as connection:
+            self.assertEqual(connection.execute('SELECT count(*) FROM things').scalar(), 1)
+            self.assertEqual(self.pragma(connection, 'journal_mode'), 'wal')
+            with self.assertRaisesRegex(OperationalError, 'readonly database'):
+                connection.execute('INSERT INTO things VALUES (2)')
+        read_engine.dispose()
+        db_engine.dispose()
+
+    def test_read_url(self):
+        replica = os.path.join(self.directory, 'replica.db')
+        create_engine('sqlite:///' + replica).execute('CREATE TABLE replicated (id INTEGER PRIMARY KEY)')
+        db_engine, read_engine = make_engines({'CONTACTS_DB_URL': self.url, 'CONTACTS_DB_READ_URL': 'sqlite:///' + replica})
+        with read_engine.connect() as connection:
+            self.assertEqual(inspect(connection).get_table_names(), ['replicated'])
+        read_engine.dispose()
+        db_engine.dispose()
+
+    def test_memory_database_has_no_read_engine(self):
+        db_engine, read_engine = make_engines(url='sqlite://')
+        self.assertIsNone(read_engine)
+
+
+class TestShardedStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shard_url = 'sqlite:///' + os.path.join(self.directory, 'contacts-{shard}.db')
+        self.shards = make_shards(shards=3, shard_url=self.shard_url)
+        self.app = falcon.API(middleware=[Middleware()])
+        add_sharded_routes(self.app, self.shards, ResponseCache())
+        self.srmock = falcon.testing.StartResponseMock()
+
+    def tearDown(self):
+        self.shards.dispose()
+        shutil.rmtree(self.directory)
+
+    def request(self, path, method='GET', body=None, query_string=''):
+        env = falcon.testing.create_environ(path=path, method=method, query_string=query_string,
+                                            body=json.dumps(body) if body is not None else '',
+                                            headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+        response = b''.join(self.app(env, self.srmock))
+        return json.loads(response.decode('utf-8')) if response else None
+
+    def post(self, number):
+        return self.request('/contacts', 'POST', {
+            "first_name": "Contact",
+            "last_name": str(number),
+            "email": "contact{0}@macalester.edu".format(number),
+            "address": {"street_address": "1600 Grand Avenue", "city": "St. Paul", "state": "MN", "post_code": "55105"},
+        })
+
+    def shard_ids(self, index):
+        return sorted(row[0] for row in self.shards.engines[index][0].execute('SELECT id FROM contacts'))
+
+    def test_post_places_contacts(self):
+        ids = [self.post(number)['data']['id'] for number in range(12)]
+        self.assertEqual(len(set(ids)), 12)
+        for index in range(3):
+            # Every shard got some, each with ids its own modulo.
+            self.assertTrue(self.shard_ids(index))
+            self.assertEqual(set(id % 3 for id in self.shard_ids(index)), {index})
+
+        placed = self.shards.placement('contact5@macalester.edu')
+        self.assertEqual(ids[5] % 3, placed)
+        self.post(5)
+        self.assertEqual(self.srmock.status, '409 Conflict')
+
+    def test_single_routes(self):
+        ids = [self.post(number)['data']['id'] for number in range(6)]
+        self.assertEqual(self.request('/contacts/{0}'.format(ids[4]))['last_name'], '4')
+        self.assertEqual(self.request('/contacts/{0}/address'.format(ids[4]))['contact_id'], ids[4])
+
+        self.request('/contacts/{0}'.format(ids[4]), 'PATCH', {'first_name': 'Patched'})
+        self.assertEqual(self.request('/contacts/{0}'.format(ids[4]))['first_name'], 'Patched')
+        self.request('/contacts/{0}'.format(ids[4]), 'DELETE')
+        self.assertEqual(self.srmock.status, '200 OK')
+        self.request('/contacts/{0}'.format(ids[4]))
+        self.assertEqual(self.srmock.status, '404 Not Found')
+        self.request('/contacts/abc')
+        self.assertEqual(self.srmock.status, '404 Not Found')
+
+    def test_collection_merges_shards(self):
+        ids = sorted(self.post(number)['data']['id'] for number in range(10))
+        pages, cursor = [], None
+        while True:
+            page = self.request('/contacts', query_string='__limit=4' + ('&__cursor=' + cursor if cursor else ''))
+            pages.append([contact['id'] for contact in page])
+            self.assertEqual(self.srmock.headers_dict['X-Total-Count'], '10')
+            cursor = self.srmock.headers_dict.get('X-Next-Cursor')
+            if cursor is None:
+                break
+        self.assertEqual(pages, [ids[:4], ids[4:8], ids[8:]])
+        for offset in range(11):
+            page = self.request('/contacts', query_string='__offset={0}&__limit=2&fields=id'.format(offset))
+            self.assertEqual([contact['id'] for contact in page], ids[offset:offset + 2])
+
+        names = [contact['last_name'] for contact in self.request('/contacts', query_string='__sort=-last_name&fields=last_name')]
+        self.assertEqual(names, sorted([str(number) for number in range(10)], reverse=True))
+        self.assertEqual(len(self.request('/contacts', query_string='last_name__in=1,2,3')), 3)
+
+        etag = self.srmock.headers_dict['ETag']
+        env = falcon.testing.create_environ(path='/contacts', query_string='last_name__in=1,2,3', headers={'If-None-Match': etag})
+        self.app(env, self.srmock)
+        self.assertEqual(self.srmock.status, '304 Not Modified')
+
+    def test_addresses_merge_shards(self):
+        ids = sorted(self.post(number)['data']['id'] for number in range(7))
+        addresses = self.request('/addresses', query_string='__limit=3')
+        self.assertEqual([address['id'] for address in addresses], ids[:3])
+        self.assertEqual([address['contact_id'] for address in addresses], ids[:3])
+        self.assertEqual(self.srmock.headers_dict['X-Total-Count'], '7')
+        self.assertEqual(len(self.request('/addresses', query_string='city=St. Paul&__offset=5')), 2)
+
+        self.assertEqual(self.request('/addresses/{0}'.format(ids[4]))['contact_id'], ids[4])
+        self.assertEqual(self.request('/addresses/stats'), {'total': 7, 'country': {'US': 7}, 'state': {'MN': 7}})
+
+    def test_email_change_stays_in_shard(self):
+        contact = self.post(0)['data']
+        moved = next(number for number in itertools.count(1)
+                     if self.shards.placement('contact{0}@macalester.edu'.format(number)) != contact['id'] % 3)
+        kept = next(number for number in itertools.count(1)
+                    if self.shards.placement('contact{0}@macalester.edu'.format(number)) == contact['id'] % 3)
+        path = '/contacts/{0}'.format(contact['id'])
+
+        self.request(path, 'PATCH', {'email': 'contact{0}@macalester.edu'.format(moved)})
+        self.assertEqual(self.srmock.status, '409 Conflict')
+        put = dict(self.request(path), email='CONTACT{0}@macalester.edu'.format(moved))
+        put.pop('id')
+        self.request(path, 'PUT', put)
+        self.assertEqual(self.srmock.status, '409 Conflict')
+        self.request(path, 'PATCH', {'email': 'contact{0}@macalester.edu'.format(kept)})
+        self.assertEqual(self.srmock.status, '200 OK')
+
+    def test_single_database_routes(self):
+        for path, method in [('/contacts/export', 'GET'), ('/contacts/changes', 'GET'), ('/contacts/import', 'POST')]:
+            self.request(path, method, {} if method == 'POST' else None)
+            self.assertEqual(self.srmock.status, '501 Not Implemented')
+
+    def test_search_merges_shards(self):
+        for number in range(9):
+            self.post(number)
+        found = self.request('/contacts/search', query_string='q=macalester&__limit=5')
+        cursor = self.srmock.headers_dict['X-Next-Cursor']
+        found += self.request('/contacts/search', query_string='q=macalester&__limit=5&__cursor=' + cursor)
+        self.assertEqual(sorted(contact['last_name'] for contact in found), [str(number) for number in range(9)])
+
+    def test_set_based_writes_every_shard(self):
+        ids = [self.post(number)['data']['id'] for number in range(6)]
+        result = self.request('/contacts', 'PATCH', {'company': 'Inkit', 'address': {'city': 'Duluth'}},
+                              query_string='id__in=' + ','.join(str(id) for id in ids[:4]))
+        self.assertEqual(result, {'updated': 4})
+        contacts = self.request('/contacts', query_string='__sort=last_name')
+        self.assertEqual([contact['company'] for contact in contacts], ['Inkit'] * 4 + [None] * 2)
+        self.assertEqual(self.request('/contacts/{0}/address'.format(ids[3]))['city'], 'Duluth')
+
+        self.request('/contacts', 'PATCH', {'email': 'moved@macalester.edu'}, query_string='id=' + str(ids[0]))
+        self.assertEqual(self.srmock.status, '409 Conflict')
+
+        self.assertEqual(self.request('/contacts', 'DELETE', query_string='company=Inkit'), {'deleted': 4})
+        self.assertEqual(sorted(contact['id'] for contact in self.request('/contacts')), sorted(ids[4:]))
+        self.request('/contacts', 'DELETE')
+        self.assertEqual(self.srmock.status, '400 Bad Request')
+
+    def test_single_database_writes_are_not_implemented(self):
+        self.request('/contacts', 'POST', [])
+        self.assertEqual(self.srmock.status, '501 Not Implemented')
+        self.request('/contacts', 'POST', {'first_name': 'Contact'}, query_string='__upsert=true')
+        self.assertEqual(self.srmock.status, '501 Not Implemented')
+        self.request('/contacts', query_string='__stream=true')
+        self.assertEqual(self.srmock.status, '501 Not Implemented')
+
+    def test_reshard(self):
+        source = os.path.join(self.directory, 'contacts.db')
+        source_engine = make_engine(url='sqlite:///' + source)
+        upgrade(source_engine)
+        for number in range(10):
+            source_engine.execute(Contact.__table__.insert(), first_name='Contact', last_name=str(number),
+                                  email='contact{0}@macalester.edu'.format(number))
+            source_engine.execute(Address.__table__.insert(), street_address='1600 Grand Avenue', city='St. Paul',
+                                  state='MN', post_code='55105', country='US', contact_id=number + 1)
+        source_engine.dispose()
+
+        target = 'sqlite:///' + os.path.join(self.directory, 'resharded-{shard}.db')
+        id_map = io.StringIO()
+        copied, renumbered = reshard(['sqlite:///' + source], target, 4, batch_size=3, id_map=id_map)
+        new_ids = dict((int(old), int(new)) for old, new in csv.reader(io.StringIO(id_map.getvalue())))
+        self.assertEqual(sum(copied), 10)
+        self.assertEqual(renumbered, len(new_ids))
+        # Renumbered contacts get ids above every old one, each in its own shard's modulo.
+        self.assertTrue(all(new > 10 for new in new_ids.values()))
+
+        shards = make_shards(shards=4, shard_url=target)
+        try:
+            for number in range(10):
+                old_id = number + 1
+                contact_id = new_ids.get(old_id, old_id)
+                index = shards.placement('contact{0}@macalester.edu'.format(number))
+                db_engine = shards.engines[index][0]
+                self.assertEqual(contact_id % 4, index)
+                self.assertEqual(db_engine.execute('SELECT last_name FROM contacts WHERE id = ?', (contact_id,)).scalar(), str(number))
+                self.assertEqual(db_engine.execute('SELECT id FROM addresses WHERE contact_id = ?', (contact_id,)).scalar(), contact_id)
+                self.assertEqual(db_engine.execute("SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ?", ('"{0}"'.format(number),)).fetchall(), [(contact_id,)])
+            for index, count in enumerate(copied):
+                self.assertEqual(shards.engines[index][0].execute("SELECT count FROM row_counts WHERE table_name = 'contacts'").scalar(), count)
+
+            # The copied emails are still unique.
+            app = falcon.API(middleware=[Middleware()])
+            add_sharded_routes(app, shards)
+            env = falcon.testing.create_environ(path='/contacts', method='POST', headers={'Content-Type': 'application/json'}, body=json.dumps({
+                "first_name": "Contact", "last_name": "2", "email": " CONTACT2@Macalester.edu",
+                "address": {"street_address": "1600 Grand Avenue", "city": "St. Paul", "state": "MN", "post_code": "55105"},
+            }))
+            app(env, self.srmock)
+            self.assertEqual(self.srmock.status, '409 Conflict')
+        finally:
+            shards.dispose()
+
+        with self.assertRaisesRegex(ValueError, 'another number of shards'):
+            make_shards(shards=3, shard_url=target)
+        with self.assertRaisesRegex(ValueError, 'already has contacts'):
+            reshard(['sqlite:///' + source], target, 4)
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        # The schema contacts.db was originally created with, without indexes.
+        self.db_engine = create_engine('sqlite://')
+        self.db_engine.execute('CREATE TABLE contacts (id INTEGER NOT NULL, first_name VARCHAR(50) NOT NULL, '
+                               'last_name VARCHAR(50) NOT NULL, email VARCHAR(50) NOT NULL, phone_number VARCHAR(50), '
+                               'company VARCHAR(50), notes VARCHAR(500), PRIMARY KEY (id))')
+        self.db_engine.execute('CREATE TABLE addresses (id INTEGER NOT NULL, street_address VARCHAR(250) NOT NULL, '
+                               'unit_number VARCHAR(250), city VARCHAR(50) NOT NULL, state VARCHAR(50) NOT NULL, '
+                               'post_code VARCHAR(50) NOT NULL, country VARCHAR(50) NOT NULL, contact_id INTEGER, '
+                               'PRIMARY KEY (id), FOREIGN KEY(contact_id) REFERENCES contacts (id) ON DELETE CASCADE)')
+
+    def tearDown(self):
+        self.db_engine.dispose()
+
+    def index_names(self, table):
+        return sorted(index['name'] for index in inspect(self.db_engine).get_indexes(table))
+
+    def test_upgrade_builds_search_index(self):
+        self.db_engine.execute("INSERT INTO contacts (first_name, last_name, email) VALUES ('Adam', 'Smith', 'asmith@macalester.edu')")
+        upgrade(self.db_engine)
+        upgrade(self.db_engine)
+        self.assertEqual(self.db_engine.execute("SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH 'smith'").fetchall(), [(1,)])
+
+    def test_upgrade_adds_indexes(self):
+        upgrade(self.db_engine)
+        upgrade(self.db_engine)
+        self.assertEqual(self.index_names('contacts'), ['ix_contacts_change_seq', 'ix_contacts_company', 'ix_contacts_company_nocase',
+                                                        'ix_contacts_email', 'ix_contacts_email_nocase', 'ix_contacts_email_normalized',
+                                                        'ix_contacts_last_name', 'ix_contacts_last_name_nocase'])
+        self.assertEqual(self.index_names('addresses'), ['ix_addresses_city', 'ix_addresses_city_nocase', 'ix_addresses_contact_id',
+                                                         'ix_addresses_post_code', 'ix_addresses_post_code_nocase'])
+
+    def test_upgrade_refuses_duplicates(self):
+        self.db_engine.execute("CREATE INDEX ix_addresses_contact_id ON addresses (contact_id)")
+        for email in ['asmith@macalester.edu', 'jdoe@macalester.edu', ' ASmith@Macalester.edu', 'asmith@macalester.edu']:
+            self.db_engine.execute("INSERT INTO contacts (first_name, last_name, email) VALUES ('Adam', 'Smith', ?)", (email,))
+        for contact_id in [1, 2, 2, 3]:
+            self.db_engine.execute("INSERT INTO addresses (street_address, city, state, post_code, country, contact_id) "
+                                   "VALUES ('1600 Grand Avenue', 'St. Paul', 'MN', '55105', 'US', ?)", (contact_id,))
+        with self.assertRaisesRegex(ValueError, 'contacts with the same email and contacts with more than one address; .* --dedupe'):
+            upgrade(self.db_engine)
+        self.assertEqual(self.db_engine.execute('SELECT count(*) FROM contacts').scalar(), 4)
+
+        with self.db_engine.begin() as connection:
+            self.assertEqual(dedupe_contacts(connection), (2, 2))
+        upgrade(self.db_engine)
+        upgrade(self.db_engine)
+        self.assertEqual(self.db_engine.execute('SELECT id FROM contacts ORDER BY id').fetchall(), [(1,), (2,)])
+        self.assertEqual(self.db_engine.execute('SELECT id, contact_id FROM addresses ORDER BY id').fetchall(), [(1, 1), (2, 2)])
+        self.assertTrue(dict((index['name'], index['unique']) for index in inspect(self.db_engine).get_indexes('addresses'))['ix_addresses_contact_id'])
+
+    def test_upgrade_adds_versions(self):
+        self.db_engine.execute("INSERT INTO contacts (first_name, last_name, email) VALUES ('Adam', 'Smith', 'asmith@macalester.edu')")
+        upgrade(self.db_engine)
+        upgrade(self.db_engine)
+        self.assertEqual(self.db_engine.execute('SELECT version FROM contacts').fetchall(), [(1,)])
+        before = dict(self.db_engine.execute('SELECT name, version FROM table_versions').fetchall())
+        self.db_engine.execute("UPDATE contacts SET notes = 'Changed'")
+        after = dict(self.db_engine.execute('SELECT name, version FROM table_versions').fetchall())
+        # The change_seq stamp is a second write to the row.
+        self.assertEqual(after['contacts'], before['contacts'] + 2)
+        self.assertEqual(after['addresses'], before['addresses'])
+
+    def test_upgrade_counts_rows(self):
+        self.db_engine.execute("INSERT INTO contacts (first_name, last_name, email) VALUES ('Adam', 'Smith', 'asmith@macalester.edu')")
+        self.db_engine.execute("INSERT INTO addresses (street_address, city, state, post_code, country, contact_id) "
+                               "VALUES ('1600 Grand Avenue', 'St. Paul', 'MN', '55105', 'US', 1)")
+        upgrade(self.db_engine)
+        upgrade(self.db_engine)
+        self.db_engine.execute("INSERT INTO contacts (first_name, last_name, email) VALUES ('Eve', 'Smith', 'esmith@macalester.edu')")
+        counts = self.db_engine.execute('SELECT table_name, dimension, value, count FROM row_counts ORDER BY 1, 2, 3').fetchall()
+        self.assertEqual(counts, [('addresses', '', '', 1), ('addresses', 'country', 'US', 1), ('addresses', 'state', 'MN', 1),
+                                  ('contacts', '', '', 2)])
+
+    def test_upgrade_stamps_changes(self):
+        for name in ['Adam', 'Eve']:
+            self.db_engine.execute("INSERT INTO contacts (first_name, last_name, email) VALUES (?, 'Smith', ?)", (name, name + '@macalester.edu'))
+        self.db_engine.execute("INSERT INTO addresses (street_address, city, state, post_code, country, contact_id) "
+                               "VALUES ('1600 Grand Avenue', 'St. Paul', 'MN', '55105', 'US', 2)")
+        upgrade(self.db_engine)
+        upgrade(self.db_engine)
+        self.assertEqual(self.db_engine.execute('SELECT id, change_seq FROM contacts ORDER BY id').fetchall(), [(1, 1), (2, 2)])
+        self.assertEqual(self.db_engine.execute('SELECT change_seq FROM addresses').fetchall(), [(2,)])
+        self.db_engine.execute("UPDATE contacts SET notes = 'Changed' WHERE id = 1")
+        self.assertEqual(self.db_engine.execute('SELECT change_seq FROM contacts WHERE id = 1').scalar(), 3)
+
+
+class TestKeysetPagination(BaseTestCase):
+
+    def get_pages(self, path, query_string):
+        pages = []
+        while True:
+            response = self.simulate_request(path, method='GET', query_string=query_string, headers={'Accept': 'application/json'})
+            self.assertOK(response)
+            pages.append(json.loads(response[0].decode('utf-8')))
+            cursor = dict(self.srmock.headers).get('x-next-cursor')
+            if cursor is None:
+                return pages
+            query_string = query_string + '&__cursor=' + cursor
+
+    def test_pages_by_id(self):
+        self.post_contacts(5)
+        pages = self.get_pages('/contacts', '__limit=2')
+        self.assertEqual([[c['id'] for c in page] for page in pages], [[1, 2], [3, 4], [5]])
+
+        pages = self.get_pages('/addresses', '__limit=5')
+        self.assertEqual([[a['id'] for a in page] for page in pages], [[1, 2, 3, 4, 5]])
+
+    def test_pages_by_sort_column(self):
+        self.post_contacts(6)
+        pages = self.get_pages('/contacts', '__limit=4&__sort=-last_name')
+        self.assertEqual([[c['last_name'] for c in page] for page in pages], [['5', '4', '3', '2'], ['1', '0']])
+
+    def test_next_link(self):
+        self.post_contacts(3)
+        self.simulate_request('/contacts', method='GET', query_string='__limit=2', headers={'Accept': 'application/json'})
+        self.assertIn('rel=next', dict(self.srmock.headers)['link'])
+
+    def test_pages_by_nullable_column(self):
+        self.post_contacts(5)
+        self.simulate_request('/contacts', method='PATCH', query_string='id__in=2,4', body=json.dumps({'company': 'Inkit'}),
+                              headers={'Content-Type': 'application/json'})
+        pages = self.get_pages('/contacts', '__limit=2&__sort=company')
+        self.assertEqual([[c['id'] for c in page] for page in pages], [[1, 3], [5, 2], [4]])
+        pages = self.get_pages('/contacts', '__limit=2&__sort=-company')
+        self.assertEqual([[c['id'] for c in page] for page in pages], [[2, 4], [1, 3], [5]])
+
+    def test_invalid_cursor(self):
+        response = self.simulate_request('/contacts', method='GET', query_string='__limit=2&__cursor=bogus', headers={'Accept': 'application/json'})
+        self.assertBadRequest(response, 'Invalid parameter', 'The "__cursor" parameter is invalid')
+
+    def test_non_scalar_cursor(self):
+        self.post_contacts(2)
+        cursor = resources.encode_cursor([{'a': 1}])
+        response = self.simulate_request('/contacts', method='GET', query_string='__limit=1&__cursor=' + cursor, headers={'Accept': 'application/json'})
+        self.assertBadRequest(response, 'Invalid parameter', 'The "__cursor" parameter is invalid')
+
+    def test_limit_above_maximum(self):
+        self.simulate_request('/contacts', method='GET', query_string='__limit=100000', headers={'Accept': 'application/json'})
+        self.assertEqual(self.srmock.status, '400 Bad Request')
+
+    def test_default_limit(self):
+        self.post_contacts(3)
+        with mock.patch.object(resources.ModelCollectionResource, 'default_limit', 2):
+            pages = self.get_pages('/contacts', '')
+        self.assertEqual([[c['id'] for c in page] for page in pages], [[1, 2], [3]])
+
+
+class TestStreamingCollection(BaseTestCase):
+
+    def test_stream_matches_buffered(self):
+        self.post_contacts(7)
+        for path in ['/contacts', '/addresses']:
+            buffered = self.simulate_request(path, method='GET', headers={'Accept': 'application/json'})
+            streamed = self.simulate_request(path, method='GET', query_string='__stream=true', headers={'Accept': 'application/json'})
+            self.assertOK(streamed)
+            self.assertEqual(b''.join(streamed), buffered[0])
+
+    def test_stream_in_batches(self):
+        self.post_contacts(5)
+        with mock.patch.object(ContactCollectionResource, 'stream_batch_size', 2):
+            streamed = list(self.simulate_request('/contacts', method='GET', query_string='__stream=true&__sort=-id',
+                                                  headers={'Accept': 'application/json'}))
+        self.assertEqual(len(streamed), 4)
+        self.assertEqual([c['id'] for c in json.loads(b''.join(streamed).decode('utf-8'))], [5, 4, 3, 2, 1])
+
+    def test_stream_releases_connection_between_batches(self):
+        self.post_contacts(5)
+        with mock.patch.object(ContactCollectionResource, 'stream_batch_size', 2):
+            streamed = self.simulate_request('/contacts', method='GET', query_string='__stream=true&__offset=1&__limit=3',
+                                             headers={'Accept': 'application/json'})
+            chunks = [next(streamed), next(streamed)]
+            self.assertEqual(self.read_engine.pool.checkedout(), 0)
+            chunks += list(streamed)
+        self.assertEqual([c['id'] for c in json.loads(b''.join(chunks).decode('utf-8'))], [2, 3, 4])
+
+    def test_stream_empty(self):
+        streamed = self.simulate_request('/contacts', method='GET', query_string='__stream=true', headers={'Accept': 'application/json'})
+        self.assertEqual(b''.join(streamed), b'[]')
+
+
 class TestContactsPost(BaseTestCase):
 
     def test_post_only_required(self):
@@ -249,6 +1624,249 @@ class TestContactsPost(BaseTestCase):
         self.assertFailValidation(response, 'b\'' + invalid_file + '\'' + " is not of type 'object', 'array'")
 
 
+class TestContactsBulkPost(BaseTestCase):
+
+    contacts = [
+        {
+            "first_name": "Juan David",
+            "last_name": "Garrido",
+            "email": "jgarrido@macalester.edu",
+            "address": {
+                "street_address": "1600 Grand Avenue",
+                "city": "St. Paul",
+                "state": "MN",
+                "post_code": "55105"
+            }
+        },
+        {
+            "first_name": "John",
+            "last_name": "Doe",
+            "email": "johndoe@macalester.edu",
+            "address": {
+                "street_address": "1600 Pennsilvania Avenue",
+                "city": "Washington",
+                "state": "MD",
+                "country": "Colombia",
+                "post_code": "11111"
+            }
+        },
+        {
+            "first_name": "Jane",
+            "last_name": "Roe",
+            "email": "janeroe@macalester.edu",
+            "address": {
+                "street_address": "1 Main Street",
+                "city": "Minneapolis",
+                "state": "MN",
+                "post_code": "55401"
+            }
+        }]
+
+    def test_bulk_post_links_addresses(self):
+        response = self.simulate_request('/contacts', method='POST', query_string='__chunk_size=2',
+                                         body=json.dumps(self.contacts), headers={'Content-Type': 'application/json'})
+        self.assertCreated(response)
+        created = json.loads(response[0].decode('utf-8'))['data']
+        self.assertEqual([c['id'] for c in created], [1, 2, 3])
+
+        response = self.simulate_request('/addresses', method='GET', headers={'Accept': 'application/json'})
+        addresses = json.loads(response[0].decode('utf-8'))
+        self.assertEqual([(a['contact_id'], a['city'], a['country']) for a in addresses],
+                         [(1, 'St. Paul', 'US'), (2, 'Washington', 'Colombia'), (3, 'Minneapolis', 'US')])
+
+    def test_bulk_post_atomic_rejects_all(self):
+        post = self.contacts + [{"first_name": "Adam"}]
+
+        response = self.simulate_request('/contacts', method='POST', body=json.dumps(post), headers={'Content-Type': 'application/json'})
+        self.assertFailValidation(response, "Item 3: 'last_name' is a required property")
+
+        response = self.simulate_request('/contacts', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual(response[0], b'[]')
+
+    def test_bulk_post_per_item_errors(self):
+        post = [self.contacts[0], {"first_name": "Adam"}, self.contacts[1]]
+
+        response = self.simulate_request('/contacts', method='POST', query_string='__atomic=false',
+                                         body=json.dumps(post), headers={'Content-Type': 'application/json'})
+        self.assertCreated(response)
+        result = json.loads(response[0].decode('utf-8'))
+        self.assertEqual([c['email'] for c in result['data']], ['jgarrido@macalester.edu', 'johndoe@macalester.edu'])
+        self.assertEqual([e['index'] for e in result['errors']], [1])
+
+    def test_bulk_post_per_item_errors_all_invalid(self):
+        self.simulate_request('/contacts', method='POST', body=json.dumps(self.contacts[0]), headers={'Content-Type': 'application/json'})
+        post = [{"first_name": "Adam"}, self.contacts[0]]
+
+        response = self.simulate_request('/contacts', method='POST', query_string='__atomic=false',
+                                         body=json.dumps(post), headers={'Content-Type': 'application/json'})
+        self.assertEqual(self.srmock.status, '400 Bad Request')
+        result = json.loads(response[0].decode('utf-8'))
+        self.assertEqual(result['data'], [])
+        self.assertEqual([e['index'] for e in result['errors']], [0, 1])
+        self.assertEqual(result['errors'][1]['description'], 'Unique constraint violated')
+
+
+class TestContactsBulkWrites(BaseTestCase):
+
+    def request(self, method, query_string, body=None):
+        with self.count_queries() as statements:
+            response = self.simulate_request('/contacts', method=method, query_string=query_string,
+                                             body=json.dumps(body) if body is not None else '',
+                                             headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+        return response, [statement for statement, parameters in statements]
+
+    def test_delete_ids(self):
+        self.post_contacts(4)
+        response, statements = self.request('DELETE', 'id__in=1,3,5')
+        self.assertOK(response[0], {'deleted': 2})
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('DELETE FROM contacts'))
+        self.assertEqual([contact.id for contact in self.db_session.query(Contact).order_by(Contact.id)], [2, 4])
+        self.assertEqual([address.contact_id for address in self.db_session.query(Address).order_by(Address.id)], [2, 4])
+
+    def test_delete_filter(self):
+        self.post_contacts(12)
+        response, _ = self.request('DELETE', 'last_name__startswith=1')
+        self.assertOK(response[0], {'deleted': 3})
+        self.assertEqual(self.db_session.query(Contact).count(), 9)
+        self.assertEqual(self.db_session.query(Address).count(), 9)
+
+    def test_patch(self):
+        self.post_contacts(3)
+        response, statements = self.request('PATCH', 'last_name__in=0,2', {'company': 'Inkit', 'address': {'city': 'Duluth'}})
+        self.assertOK(response[0], {'updated': 2})
+        self.assertEqual(len(statements), 2)
+        contacts = self.db_session.query(Contact).order_by(Contact.id).all()
+        self.assertEqual([contact.company for contact in contacts], ['Inkit', None, 'Inkit'])
+        self.assertEqual([contact.address.city for contact in contacts], ['Duluth', 'St. Paul', 'Duluth'])
+        self.assertEqual([contact.version for contact in contacts], [2, 1, 2])
+
+    def test_patch_filtered_column(self):
+        self.post_contacts(2)
+        response, _ = self.request('PATCH', 'last_name=1', {'last_name': 'One', 'address': {'state': 'WI'}})
+        self.assertOK(response[0], {'updated': 1})
+        contact = self.db_session.query(Contact).get(2)
+        self.assertEqual((contact.last_name, contact.address.state), ('One', 'WI'))
+
+    def test_patch_validation(self):
+        self.post_contacts(1)
+        response, _ = self.request('PATCH', 'id=1', {'id': 5})
+        self.assertFailValidation(response, "Additional properties are not allowed ('id' was unexpected)")
+        response, _ = self.request('PATCH', 'id=1', {'address': {'contact_id': 5}})
+        self.assertFailValidation(response, "Additional properties are not allowed ('contact_id' was unexpected)")
+        response, _ = self.request('PATCH', 'id=1', {})
+        self.assertFailValidation(response, '{} does not have enough properties')
+
+    def test_invalid_filter(self):
+        response, _ = self.request('DELETE', 'nope__in=1')
+        self.assertBadRequest(response)
+
+    def test_invalidates_cache(self):
+        self.post_contacts(3)
+        for contact_id in [1, 2, 3]:
+            self.simulate_request('/contacts/{0}'.format(contact_id), method='GET', headers={'Accept': 'application/json'})
+        self.request('PATCH', 'id__in=1', {'notes': 'Patched'})
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.request('DELETE', 'last_name=2')
+        self.assertEqual(self.cache.stats()['size'], 0)
+        response = self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual(json.loads(response[0].decode('utf-8'))['notes'], 'Patched')
+
+
+class TestContactsUpsert(BaseTestCase):
+
+    def contact(self, email, city='St. Paul', **fields):
+        contact = {"first_name": "Adam", "last_name": "Smith", "email": email,
+                   "address": {"street_address": "1600 Grand Avenue", "city": city, "state": "MN", "post_code": "55105"}}
+        contact.update(fields)
+        return contact
+
+    def post(self, body, query_string='__upsert=true'):
+        with self.count_queries() as statements:
+            response = self.simulate_request('/contacts', method='POST', query_string=query_string, body=json.dumps(body),
+                                             headers={'Content-Type': 'application/json'})
+        return json.loads(response[0].decode('utf-8')), [statement for statement, parameters in statements]
+
+    def test_duplicate_email(self):
+        self.post(self.contact('asmith@macalester.edu'), '')
+        self.assertEqual(self.srmock.status, falcon.HTTP_CREATED)
+        self.post(self.contact(' ASmith@macalester.edu'), '')
+        self.assertEqual(self.srmock.status, falcon.HTTP_CONFLICT)
+
+    def test_single(self):
+        self.post_contacts(1)
+        result, _ = self.post(self.contact('asmith@macalester.edu'))
+        self.assertEqual(self.srmock.status, falcon.HTTP_OK)
+        self.assertEqual(result['data']['id'], 2)
+
+        result, statements = self.post(self.contact('ASmith@macalester.edu ', 'Duluth', company='Inkit'))
+        self.assertEqual(result['data']['id'], 2)
+        self.assertEqual(len(statements), 2)
+        contact = self.db_session.query(Contact).get(2)
+        self.assertEqual((contact.email, contact.company, contact.address.city, contact.version, contact.address.version),
+                         ('ASmith@macalester.edu ', 'Inkit', 'Duluth', 2, 2))
+        self.assertEqual((self.db_session.query(Contact).count(), self.db_session.query(Address).count()), (2, 2))
+
+    def test_bulk(self):
+        self.post_contacts(2)
+        docs = [self.contact('contact1@macalester.edu', 'Duluth'), self.contact('new@macalester.edu'),
+                self.contact('CONTACT0@macalester.edu', 'Rochester')]
+        with mock.patch.object(resources, 'SQLITE_MAX_VARIABLES', 14):
+            result, statements = self.post(docs, '__upsert=true&__chunk_size=3')
+        self.assertEqual(self.srmock.status, falcon.HTTP_OK)
+        self.assertEqual([contact['id'] for contact in result['data']], [2, 3, 1])
+        # Two statements per table, as only two rows fit in 14 parameters.
+        self.assertEqual(len(statements), 4)
+        self.assertEqual([address.city for address in self.db_session.query(Address).order_by(Address.contact_id)],
+                         ['Rochester', 'Duluth', 'St. Paul'])
+
+    def test_bulk_not_atomic(self):
+        docs = [self.contact('asmith@macalester.edu'), self.contact('ASMITH@macalester.edu', 'Duluth'), {"first_name": "Adam"}]
+        result, _ = self.post(docs, '__upsert=true&__atomic=false')
+        self.assertEqual([contact['id'] for contact in result['data']], [1, 1])
+        self.assertEqual([error['index'] for error in result['errors']], [2])
+        self.assertEqual(self.db_session.query(Address).one().city, 'Duluth')
+
+    def test_invalidates_cache(self):
+        self.post_contacts(1)
+        self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'})
+        self.post(self.contact('contact0@macalester.edu'))
+        response = self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'})
+        self.assertEqual(json.loads(response[0].decode('utf-8'))['first_name'], 'Adam')
+
+
+class TestValidation(unittest.TestCase):
+
+    contact = {
+        "first_name": "Adam",
+        "last_name": "Smith",
+        "email": "asmith@macalester.edu",
+        "address": {
+            "street_address": "1600 Grand Avenue",
+            "city": "St. Paul",
+            "state": "MN",
+            "post_code": "55105"
+        }
+    }
+
+    def test_array_items_are_validated(self):
+        with self.assertRaises(falcon.HTTPBadRequest) as context:
+            validate_json([self.contact, {"first_name": "Adam"}, self.contact, dict(self.contact, email=1)])
+        self.assertEqual(context.exception.description,
+                         "Item 1: 'last_name' is a required property; Item 3: 1 is not of type 'string'")
+
+    def test_nested_arrays_are_rejected(self):
+        with self.assertRaises(falcon.HTTPBadRequest) as context:
+            validate_json([[self.contact]])
+        self.assertEqual(context.exception.description, "Item 0: [{0}] is not of type 'object'".format(repr(self.contact)))
+
+    def test_schema_is_not_recompiled(self):
+        with mock.patch('jsonschema.validate', side_effect=AssertionError), \
+                mock.patch('jsonschema.validators.validator_for', side_effect=AssertionError):
+            validate_json(self.contact)
+            validate_json([self.contact, self.contact])
+
+
 class TestSingleContactRoute(BaseTestCase):
 
     def test_get(self):
@@ -273,7 +1891,7 @@ class TestSingleContactRoute(BaseTestCase):
         response = self.simulate_request('/contacts/1', method='GET', headers={'Accept': 'application/json'})
         self.assertOK(response)
         try:
-            validate_json(json.loads(response[0].decode('utf-8')))
+            validate_json(without_ids(json.loads(response[0].decode('utf-8'))))
         except AssertionError:
             self.fail()
 
@@ -309,14 +1927,14 @@ class TestSingleContactRoute(BaseTestCase):
         response = self.simulate_request('/contacts/2', method='GET', headers={'Accept': 'application/json'})
         self.assertOK(response)
         try:
-            validate_json(json.loads(response[0].decode('utf-8')))
+            validate_json(without_ids(json.loads(response[0].decode('utf-8'))))
         except AssertionError:
             self.fail()
 
         response = self.simulate_request('/contacts/3', method='GET', headers={'Accept': 'application/json'})
         self.assertOK(response)
         try:
-            validate_json(json.loads(response[0].decode('utf-8')))
+            validate_json(without_ids(json.loads(response[0].decode('utf-8'))))
         except AssertionError:
             self.fail()
 
@@ -358,6 +1976,11 @@ class TestSingleContactRoute(BaseTestCase):
             "notes": "This is a difficult project"
         }
 
+        # Contact 2 already has that email.
+        response_put = self.simulate_request('/contacts/1', method='PUT', body=json.dumps(put), headers={'Content-Type': 'application/json'})
+        self.assertConflict(response_put)
+
+        put['email'] = 'adavid@macalester.edu'
         response_put = self.simulate_request('/contacts/1', method='PUT', body=json.dumps(put), headers={'Content-Type': 'application/json'})
         self.assertOK(response_put)
 
@@ -605,7 +2228,7 @@ class TestAddressCollectionRoute(BaseTestCase):
 
     def test_delete(self):
         response = self.simulate_request('/contacts', method='DELETE')
-        self.assertMethodNotAllowed(response)
+        self.assertBadRequest(response, 'Invalid parameter', 'Updating or deleting every contact needs a filter, e.g. id__in=1,2,3')
 
     def test_put(self):
         response = self.simulate_request('/contacts', method='PUT')
@@ -613,7 +2236,8 @@ class TestAddressCollectionRoute(BaseTestCase):
 
     def test_patch(self):
         response = self.simulate_request('/contacts', method='PATCH')
-        self.assertMethodNotAllowed(response)
+        self.assertUnsupportedMediaType(response, 'This API supports only JSON-encoded requests. Make sure the '
+                                                  'Content-Type header is set appropiately')
 
     def test_custom_method(self):
         response = self.simulate_request('/contacts', method='CUSTOM')
@@ -2,86 +2,102 @@ import falcon
 import falcon.testing
 import json
 import unittest
+from contextlib import contextmanager
 from falcon_autocrud.middleware import Middleware
-from inkit_project.resources import ContactResource, ContactCollectionResource, AddressResource, AddressCollectionResource, json1_file
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from inkit_project.cache import ResponseCache
+from inkit_project.compression import CompressionMiddleware
+from inkit_project.db import make_engines
+from inkit_project.imports import ImportJobs
+from inkit_project.metrics import Metrics, MetricsMiddleware
+from inkit_project.models import Base
+from inkit_project.resources import ContactChangesResource, ContactResource, ContactCollectionResource, ContactExportResource, ContactImportResource, ContactSearchResource, AddressResource, AddressCollectionResource, AddressStatsResource, CacheStatsResource, ImportJobResource, MetricsResource, json1_file
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 
-Base = declarative_base()
-
-
-class TestAddress(Base):
-    __tablename__ = 'addresses'
-
-    id = Column(Integer, primary_key=True)
-    street_address = Column(String(250), nullable=False)
-    unit_number = Column(String(250), nullable=True)
-    city = Column(String(50), nullable=False)
-    state = Column(String(50), nullable=False)
-    post_code = Column(String(50), nullable=False)
-    country = Column(String(50), nullable=False, default="US")
-
-    contact_id = Column(Integer, ForeignKey('contacts.id'))
-    contact = relationship("TestContact", back_populates="address")
-
-    def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
-
-
-class TestContact(Base):
-    __tablename__ = 'contacts'
-
-    id = Column(Integer, primary_key=True)
-    first_name = Column(String(50), nullable=False)
-    last_name = Column(String(50), nullable=False)
-    email = Column(String(50), nullable=False)
-    phone_number = Column(String(50), nullable=True)
-    company = Column(String(50), nullable=True)
-    notes = Column(String(500), nullable=True)
-
-    address = relationship("TestAddress", uselist=False, back_populates="contact", cascade='all,delete')
-
-    def as_dict(self):
-        contact = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        contact.update({'address': self.address.as_dict()})
-        return contact
-
 
 class BaseTestCase(unittest.TestCase):
 
     def tearDown(self):
+        self.jobs.executor.shutdown()
+        if self.write_queue is not None:
+            self.write_queue.close()
         self.db_session.close()
+        # The writer closes last, so it can checkpoint and remove the WAL.
+        self.read_engine.dispose()
         self.db_engine.dispose()
         json1_file.close()
 
     def setUp(self):
         super(BaseTestCase, self).setUp()
 
+        self.db_engine, self.read_engine = make_engines(url='sqlite:///tmp_contacts.db')
+        self.metrics = Metrics()
+
         self.app = falcon.API(
-            middleware=[Middleware()],
+            middleware=[MetricsMiddleware(self.metrics, self.db_engine, self.read_engine), CompressionMiddleware(), Middleware()],
         )
 
-        self.db_engine = create_engine('sqlite:///tmp_contacts.db')
         self.db_session = sessionmaker(bind=self.db_engine)()
-
-        self.app.add_route('/contacts', ContactCollectionResource(self.db_engine))
-        self.app.add_route('/contacts/{id}', ContactResource(self.db_engine))
-        self.app.add_route('/contacts/{id}/address', AddressResource(self.db_engine))
-        self.app.add_route('/addresses', AddressCollectionResource(self.db_engine))
-        self.app.add_route('/addresses/{id}', AddressResource(self.db_engine))
+        self.cache = ResponseCache()
+        self.jobs = ImportJobs(self.db_engine, cache=self.cache)
+        self.write_queue = self.make_write_queue()
+
+        self.app.add_route('/contacts', ContactCollectionResource(self.db_engine, cache=self.cache, read_engine=self.read_engine, write_queue=self.write_queue))
+        self.app.add_route('/contacts/search', ContactSearchResource(self.db_engine, read_engine=self.read_engine))
+        self.app.add_route('/contacts/export', ContactExportResource(self.db_engine, read_engine=self.read_engine))
+        self.app.add_route('/contacts/changes', ContactChangesResource(self.db_engine, read_engine=self.read_engine))
+        self.app.add_route('/contacts/import', ContactImportResource(self.jobs))
+        self.app.add_route('/contacts/import/{job_id}', ImportJobResource(self.jobs))
+        self.app.add_route('/contacts/{id}', ContactResource(self.db_engine, cache=self.cache, read_engine=self.read_engine, write_queue=self.write_queue))
+        self.app.add_route('/contacts/{id}/address', AddressResource(self.db_engine, cache=self.cache, read_engine=self.read_engine))
+        self.app.add_route('/addresses', AddressCollectionResource(self.db_engine, read_engine=self.read_engine))
+        self.app.add_route('/addresses/stats', AddressStatsResource(self.db_engine, read_engine=self.read_engine))
+        self.app.add_route('/addresses/{id}', AddressResource(self.db_engine, cache=self.cache, read_engine=self.read_engine))
+        self.app.add_route('/cache/stats', CacheStatsResource(self.cache))
+        self.app.add_route('/metrics', MetricsResource(self.metrics))
 
         Base.metadata.drop_all(self.db_engine)
         Base.metadata.create_all(self.db_engine)
 
         self.srmock = falcon.testing.StartResponseMock()
 
+    def make_write_queue(self):
+        return None
+
     def simulate_request(self, path, *args, **kwargs):
         env = falcon.testing.create_environ(path=path, **kwargs)
         return self.app(env, self.srmock)
 
+    def post_contacts(self, count, start=0):
+        post = [
+            {
+                "first_name": "Contact",
+                "last_name": str(number),
+                "email": "contact{0}@macalester.edu".format(number),
+                "address": {
+                    "street_address": "1600 Grand Avenue",
+                    "city": "St. Paul",
+                    "state": "MN",
+                    "post_code": "55105"
+                }
+            } for number in range(start, start + count)]
+        self.simulate_request('/contacts', method='POST', body=json.dumps(post), headers={'Content-Type': 'application/json'})
+
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+
+        for db_engine in [self.db_engine, self.read_engine]:
+            event.listen(db_engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            for db_engine in [self.db_engine, self.read_engine]:
+                event.remove(db_engine, 'before_cursor_execute', before_cursor_execute)
+
     def assertOK(self, response, body=None):
         self.assertEqual(self.srmock.status, '200 OK')
         if body is not None and isinstance(body, dict):